@@ -4,7 +4,7 @@ from keras.layers import Conv2D, Flatten, Dense, Dropout
 from keras.optimizers import Adam
 from keras.callbacks import EarlyStopping
 
-def build_brain_strain_cnn():
+def build_brain_strain_cnn(learning_rate=1e-6):
     model = Sequential()
     model.add(Conv2D(
         filters=32,
@@ -40,11 +40,12 @@ def build_brain_strain_cnn():
     model.add(Dense(1, activation='relu'))
     model.compile(
         loss='mse',
-        optimizer=Adam(learning_rate=1e-6),
+        optimizer=Adam(learning_rate=learning_rate),
         metrics=['mse']
     )
     
     return model
 
-model = build_brain_strain_cnn()
-model.summary()
+if __name__ == "__main__":
+    model = build_brain_strain_cnn()
+    model.summary()
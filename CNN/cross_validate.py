@@ -0,0 +1,257 @@
+"""
+Parallel grouped k-fold cross-validation of the brain strain CNN.
+
+Impacts are split into folds by group, so every impact of a group lands in the same fold.
+By default the group is the team, taken from the source HDF5 file name (<team>_game.h5 and
+<team>_training.h5 of preprocessing), so a player's game and training impacts never end up
+on both sides of a split. Finer groupings, such as players, can be given as a CSV of impact
+name and group. All six permutations of an impact always share its fold.
+
+Folds train in parallel worker processes, each pinned to its own block of CPU cores with
+TensorFlow limited to that many threads. Every worker memory-maps the same flat dataset
+(see preprocessing/flat_dataset.py), so the inputs are read from disk once and shared
+through the page cache. The per-fold test MSE and timings are aggregated in one report:
+
+    python preprocessing/flat_dataset.py data/flat/all data/*/*.h5
+    python CNN/cross_validate.py data/flat/all --folds 5 --epochs 20 --report reports/cv.json
+"""
+
+import json
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import get_context
+
+import numpy as np
+import pandas as pd
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "preprocessing"))
+from consolidated_h5 import PERM_NAMES
+from flat_dataset import FlatDataset, flat_paths
+
+SESSION_SUFFIXES = ("_game", "_training")
+
+
+def source_team(source):
+    """
+    Returns the team of a preprocessed HDF5 file from its name, <team>_game.h5 or
+    <team>_training.h5, or the file name without extension if it has no session suffix.
+    """
+    stem = os.path.splitext(os.path.basename(str(source)))[0]
+    for suffix in SESSION_SUFFIXES:
+        if stem.endswith(suffix):
+            return stem[:-len(suffix)]
+    return stem
+
+
+def row_groups(prefix, group_by=("team",), groups_csv=None):
+    """
+    Returns the group of every row of a flat dataset.
+
+    The default groups by team, so all impacts of a player share a fold. Grouping by
+    source alone would split a team's game and training files, and with them the
+    impacts of its players, across folds.
+
+    Args:
+        prefix (str): Path of the flat dataset without extension.
+        group_by (tuple): Sidecar columns whose combination is the group. "team" is
+            derived from the source column, see source_team.
+        groups_csv (str): CSV with name and group columns, overriding group_by. Impacts
+            missing from it are grouped by group_by.
+
+    Returns:
+        np.ndarray: Group label of every row.
+    """
+    table = pd.read_csv(flat_paths(prefix)[1])
+    if "team" not in table:
+        table["team"] = table["source"].map(source_team)
+    groups = table[list(group_by)].astype(str).agg("/".join, axis=1)
+    if groups_csv is not None:
+        mapping = pd.read_csv(groups_csv, dtype=str).set_index("name")["group"]
+        mapped = table["name"].astype(str).map(mapping)
+        groups = mapped.fillna(groups)
+    return groups.to_numpy()
+
+
+def grouped_kfold(groups, n_folds=5, seed=None):
+    """
+    Splits rows into folds without splitting a group, balancing the number of rows per
+    fold by assigning the largest groups first, each to the currently smallest fold.
+
+    Args:
+        groups (np.ndarray): Group of every row.
+        n_folds (int): Number of folds.
+        seed (int): Shuffles groups of equal size between folds, in order of appearance by default.
+
+    Returns:
+        list: (train rows, test rows) of every fold.
+    """
+    names, inverse, counts = np.unique(groups, return_inverse=True, return_counts=True)
+    if len(names) < n_folds:
+        raise ValueError(f"Cannot split {len(names)} groups into {n_folds} folds")
+
+    order = np.arange(len(names))
+    if seed is not None:
+        np.random.default_rng(seed).shuffle(order)
+    order = order[np.argsort(-counts[order], kind="stable")]
+
+    fold_of_group = np.empty(len(names), dtype=int)
+    fold_sizes = np.zeros(n_folds, dtype=int)
+    for group in order:
+        fold = int(np.argmin(fold_sizes))
+        fold_of_group[group] = fold
+        fold_sizes[fold] += counts[group]
+
+    fold_of_row = fold_of_group[inverse]
+    return [(np.flatnonzero(fold_of_row != fold), np.flatnonzero(fold_of_row == fold)) for fold in range(n_folds)]
+
+
+def split_cores(n_workers):
+    """
+    Splits the CPU cores available to this process into n_workers contiguous blocks.
+    """
+    cores = sorted(os.sched_getaffinity(0)) if hasattr(os, "sched_getaffinity") else list(range(os.cpu_count() or 1))
+    if n_workers > len(cores):
+        return [[cores[i % len(cores)]] for i in range(n_workers)]
+    return [[int(core) for core in block] for block in np.array_split(cores, n_workers)]
+
+
+def _init_worker(core_blocks):
+    # Pin this worker to a free block of cores before TensorFlow starts its thread pools
+    cores = core_blocks.get()
+    if hasattr(os, "sched_setaffinity"):
+        os.sched_setaffinity(0, cores)
+    os.environ["OMP_NUM_THREADS"] = str(len(cores))
+    import tensorflow as tf
+    tf.config.threading.set_intra_op_parallelism_threads(len(cores))
+    tf.config.threading.set_inter_op_parallelism_threads(min(len(cores), 2))
+
+
+def run_fold(prefix, fold, train_rows, test_rows, epochs=20, batch_size=192, learning_rate=1e-6,
+             label="ubric_score", seed=None):
+    """
+    Trains and tests one fold, in a worker process set up by _init_worker.
+
+    Returns:
+        dict: Fold index, cores, sizes, train loss, test MSE over permutations and over
+            impacts (mean prediction of the six permutations), and the train and test seconds.
+    """
+    from cnn_architecture import build_brain_strain_cnn
+
+    # Random rows per training batch, so an impact's permutations and a file's impacts are spread
+    # over the epoch; the test rows stay in file order, as the impact means rely on it
+    train_data = FlatDataset(prefix, batch_size, label, shuffle=True, seed=seed, rows=train_rows)
+    test_data = FlatDataset(prefix, batch_size, label, shuffle=False, rows=test_rows)
+
+    model = build_brain_strain_cnn(learning_rate)
+    start = time.perf_counter()
+    history = model.fit(train_data.generator(), steps_per_epoch=len(train_data), epochs=epochs, verbose=0)
+    train_seconds = time.perf_counter() - start
+
+    start = time.perf_counter()
+    predictions = np.concatenate([model.predict(x, verbose=0).ravel() for x, _ in test_data])
+    test_seconds = time.perf_counter() - start
+    y = test_data.y[test_data.rows]
+
+    # The export keeps the six permutations of an impact in adjacent rows
+    n_perms = len(PERM_NAMES)
+    impact_predictions = predictions.reshape(-1, n_perms).mean(axis=1)
+    impact_y = y[::n_perms]
+    return {
+        "fold": fold,
+        "cores": sorted(os.sched_getaffinity(0)) if hasattr(os, "sched_getaffinity") else None,
+        "train_rows": int(len(train_rows)),
+        "test_rows": int(len(test_rows)),
+        "train_loss": float(history.history["loss"][-1]),
+        "test_mse": float(np.nanmean((predictions - y) ** 2)),
+        "test_impact_mse": float(np.nanmean((impact_predictions - impact_y) ** 2)),
+        "train_seconds": train_seconds,
+        "test_seconds": test_seconds,
+    }
+
+
+def cross_validate(prefix, n_folds=5, epochs=20, batch_size=192, learning_rate=1e-6, label="ubric_score",
+                   group_by=("team",), groups_csv=None, workers=None, seed=None):
+    """
+    Runs grouped k-fold cross-validation with the folds in parallel worker processes.
+
+    Args:
+        prefix (str): Path of the flat dataset without extension.
+        n_folds (int): Number of folds.
+        epochs (int): Training epochs per fold.
+        batch_size (int): Rows per batch.
+        learning_rate (float): Adam learning rate.
+        label (str): Sidecar column used as the target.
+        group_by (tuple): Sidecar columns forming the groups, see row_groups.
+        groups_csv (str): CSV of impact name and group, see row_groups.
+        workers (int): Folds trained at once, defaults to n_folds.
+        seed (int): Seed of the fold assignment and shuffles.
+
+    Returns:
+        dict: Per-fold results, their mean and standard deviation, and the wall time.
+    """
+    folds = grouped_kfold(row_groups(prefix, group_by, groups_csv), n_folds, seed)
+    workers = min(workers or n_folds, n_folds)
+    context = get_context("spawn")
+    core_blocks = context.Queue()
+    for cores in split_cores(workers):
+        core_blocks.put(cores)
+
+    start = time.perf_counter()
+    # spawn, so no worker inherits TensorFlow thread pools or the affinity of another
+    with ProcessPoolExecutor(workers, context, _init_worker, (core_blocks,)) as pool:
+        futures = [
+            pool.submit(run_fold, prefix, fold, train_rows, test_rows, epochs, batch_size, learning_rate, label, seed)
+            for fold, (train_rows, test_rows) in enumerate(folds)
+        ]
+        results = [future.result() for future in futures]
+    wall_seconds = time.perf_counter() - start
+
+    summary = {}
+    for key in ["test_mse", "test_impact_mse", "train_seconds"]:
+        values = np.array([result[key] for result in results])
+        summary[key] = {"mean": float(values.mean()), "std": float(values.std())}
+    return {
+        "prefix": prefix,
+        "folds": results,
+        "summary": summary,
+        "workers": workers,
+        "wall_seconds": wall_seconds,
+        "fold_seconds_total": float(sum(result["train_seconds"] + result["test_seconds"] for result in results)),
+    }
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Parallel grouped k-fold cross-validation of the brain strain CNN")
+    parser.add_argument("prefix", type=str, help="Flat dataset written by preprocessing/flat_dataset.py")
+    parser.add_argument("--folds", type=int, default=5)
+    parser.add_argument("--epochs", type=int, default=20)
+    parser.add_argument("--batch_size", type=int, default=192)
+    parser.add_argument("--learning_rate", type=float, default=1e-6)
+    parser.add_argument("--label", type=str, default="ubric_score")
+    parser.add_argument("--group_by", type=str, nargs="+", default=["team"],
+                        help="Sidecar columns forming the groups, team (from the source file name) by default")
+    parser.add_argument("--groups_csv", type=str, default=None, help="CSV with name and group columns")
+    parser.add_argument("--workers", type=int, default=None, help="Folds trained at once, defaults to --folds")
+    parser.add_argument("--seed", type=int, default=None)
+    parser.add_argument("--report", type=str, default=None, help="Write the report to this JSON file")
+
+    args = parser.parse_args()
+
+    report = cross_validate(args.prefix, args.folds, args.epochs, args.batch_size, args.learning_rate, args.label,
+                            tuple(args.group_by), args.groups_csv, args.workers, args.seed)
+    for result in report["folds"]:
+        print(f"Fold {result['fold']}: test MSE {result['test_mse']:.6g} (impacts {result['test_impact_mse']:.6g}), "
+              f"{result['test_rows']} test rows, trained in {result['train_seconds']:.1f} s on cores {result['cores']}")
+    summary = report["summary"]
+    print(f"Test MSE {summary['test_mse']['mean']:.6g} +- {summary['test_mse']['std']:.6g}, "
+          f"wall time {report['wall_seconds']:.1f} s for {report['fold_seconds_total']:.1f} s of fold time")
+
+    if args.report:
+        os.makedirs(os.path.dirname(os.path.abspath(args.report)), exist_ok=True)
+        with open(args.report, "w") as f:
+            json.dump(report, f, indent=1)
+        print(f"Wrote {args.report}")
@@ -0,0 +1,236 @@
+"""
+Exports the brain strain CNN to TFLite for CPU inference, optionally quantized.
+
+    none      float32 weights and activations
+    float16   float16 weights, dequantized to float32 at load time
+    int8      int8 weights and activations, calibrated on preprocessed impacts
+
+Inputs and outputs stay float32 in every variant, so tflite_runner.TFLiteModel runs them
+all the same way. Each export is compared against the float Keras model on held-out
+impacts: per-impact predicted strain (mean over the six permutations) error, and the
+latency of scoring a single impact and the throughput of large batches:
+
+    python CNN/export_tflite.py model.keras exports/brain_strain \\
+        --calibration_h5 data/TeamA/TeamA_training.h5 --eval_h5 data/TeamB/TeamB_game.h5 \\
+        --quantization none float16 int8 --report exports/quantization.json
+
+The sample rate recorded for the model (see resample.write_model_sample_rate) is copied
+to every export, so scoring and serving the export resample impacts the same way.
+"""
+
+import json
+import os
+import sys
+import time
+
+import h5py
+import numpy as np
+import tensorflow as tf
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "preprocessing"))
+from consolidated_h5 import PERM_NAMES, is_consolidated
+from impact_loader import load_consolidated_rows, load_group_impacts
+from resample import model_metadata_path, read_model_sample_rate, write_model_sample_rate
+from score import load_model
+from tflite_runner import TFLiteModel
+
+QUANTIZATIONS = ("none", "float16", "int8")
+
+
+def sample_impacts(h5_paths, n_impacts=None, label="ubric_score", seed=0):
+    """
+    Loads the CNN inputs of a random sample of impacts from preprocessed HDF5 files.
+
+    Args:
+        h5_paths (list): Preprocessed HDF5 files, in either layout.
+        n_impacts (int): Number of impacts to sample, all by default.
+        label (str): Per-impact attribute or dataset returned as the label.
+        seed (int): Seed of the sample.
+
+    Returns:
+        tuple: (6 * impacts) x 1 x 3 x cnn_length float32 inputs, permutations of an
+            impact next to each other, and the label of each impact.
+    """
+    impacts = []
+    for path in h5_paths:
+        with h5py.File(path, "r") as hf:
+            if is_consolidated(hf):
+                impacts.extend((path, row) for row in range(len(hf["name"])))
+            else:
+                impacts.extend((path, name) for name in sorted(hf) if isinstance(hf[name], h5py.Group))
+    if not impacts:
+        raise ValueError(f"No impacts found in {h5_paths}")
+
+    rng = np.random.default_rng(seed)
+    if n_impacts is not None and n_impacts < len(impacts):
+        impacts = [impacts[i] for i in np.sort(rng.choice(len(impacts), n_impacts, replace=False))]
+
+    n_perms = len(PERM_NAMES)
+    xs = []
+    ys = []
+    for path in dict.fromkeys(path for path, _ in impacts):
+        keys = [key for p, key in impacts if p == path]
+        with h5py.File(path, "r") as hf:
+            if is_consolidated(hf):
+                x, y = load_consolidated_rows(hf, np.array(keys), label, np.float32)
+            else:
+                x, y = load_group_impacts(hf, keys, label, np.float32)
+        xs.append(x)
+        ys.append(y[::n_perms])
+    return np.concatenate(xs), np.concatenate(ys)
+
+
+def export_tflite(model, output_path, quantization="none", calibration=None):
+    """
+    Converts a Keras model to a TFLite file.
+
+    Args:
+        model (keras.Model): Trained brain strain CNN.
+        output_path (str): Path of the .tflite file to write.
+        quantization (str): One of QUANTIZATIONS.
+        calibration (np.ndarray): n x 1 x 3 x cnn_length inputs used to calibrate the
+            int8 activation ranges, required for int8.
+
+    Returns:
+        int: Size of the written file in bytes.
+    """
+    if quantization not in QUANTIZATIONS:
+        raise ValueError(f"Unknown quantization '{quantization}', expected one of {QUANTIZATIONS}")
+    if quantization == "int8" and calibration is None:
+        raise ValueError("int8 quantization needs calibration inputs")
+
+    converter = tf.lite.TFLiteConverter.from_keras_model(model)
+    if quantization == "float16":
+        converter.optimizations = [tf.lite.Optimize.DEFAULT]
+        converter.target_spec.supported_types = [tf.float16]
+    elif quantization == "int8":
+        calibration = np.asarray(calibration, dtype=np.float32)
+
+        def representative_dataset():
+            for i in range(len(calibration)):
+                yield [calibration[i:i + 1]]
+
+        converter.optimizations = [tf.lite.Optimize.DEFAULT]
+        converter.representative_dataset = representative_dataset
+        converter.target_spec.supported_ops = [tf.lite.OpsSet.TFLITE_BUILTINS_INT8]
+
+    tflite_model = converter.convert()
+    os.makedirs(os.path.dirname(os.path.abspath(output_path)), exist_ok=True)
+    with open(output_path, "wb") as f:
+        f.write(tflite_model)
+    return len(tflite_model)
+
+
+def time_predictions(model, x, batch_size=1024, n_single=200):
+    """
+    Times a model on one impact at a time (its six permutations, as the sideline scores
+    them) and on all inputs in large batches.
+
+    Returns:
+        dict: p50 and p99 single-impact latency in ms and batch throughput in impacts/s.
+    """
+    n_perms = len(PERM_NAMES)
+    single = x[:n_perms]
+    model.predict(single, verbose=0)
+    latencies = []
+    for _ in range(n_single):
+        start = time.perf_counter()
+        model.predict(single, verbose=0)
+        latencies.append(time.perf_counter() - start)
+
+    start = time.perf_counter()
+    model.predict(x, batch_size=batch_size, verbose=0)
+    elapsed = time.perf_counter() - start
+    latencies = np.array(latencies) * 1e3
+    return {
+        "single_p50_ms": float(np.percentile(latencies, 50)),
+        "single_p99_ms": float(np.percentile(latencies, 99)),
+        "batch_impacts_per_s": len(x) / n_perms / elapsed,
+    }
+
+
+def compare_models(models, x, y, batch_size=1024, n_single=200):
+    """
+    Compares models against the first one, the float Keras model.
+
+    Args:
+        models (dict): Name to model with a Keras-style predict, the reference first.
+        x (np.ndarray): Held-out inputs from sample_impacts.
+        y (np.ndarray): Labels of the held-out impacts.
+
+    Returns:
+        dict: Per model, the per-impact predicted strain error against the reference
+            (mean and max absolute, max relative to the reference range, correlation),
+            the mean absolute error against the labels and the timings of time_predictions.
+    """
+    n_perms = len(PERM_NAMES)
+    predictions = {
+        name: np.asarray(model.predict(x, batch_size=batch_size, verbose=0)).reshape(-1, n_perms).mean(axis=1)
+        for name, model in models.items()
+    }
+    reference = next(iter(predictions.values()))
+    spread = max(float(np.ptp(reference)), 1e-12)
+
+    report = {}
+    for name, model in models.items():
+        error = predictions[name] - reference
+        report[name] = {
+            "mean_abs_error": float(np.abs(error).mean()),
+            "max_abs_error": float(np.abs(error).max()),
+            "max_error_of_range": float(np.abs(error).max() / spread),
+            "correlation": float(np.corrcoef(predictions[name], reference)[0, 1]) if len(reference) > 1 else 1.0,
+            "label_mean_abs_error": float(np.nanmean(np.abs(predictions[name] - y))),
+        }
+        report[name].update(time_predictions(model, x, batch_size, n_single))
+        if isinstance(model, TFLiteModel):
+            report[name]["file_bytes"] = os.path.getsize(model.model_path)
+    return report
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Export the brain strain CNN to TFLite and compare it with the float model")
+    parser.add_argument("model_path", type=str, help="Saved Keras model or weights for build_brain_strain_cnn")
+    parser.add_argument("output_prefix", type=str, help="Exports are written to <output_prefix>_<quantization>.tflite")
+    parser.add_argument("--quantization", type=str, nargs="+", default=["int8"], choices=QUANTIZATIONS)
+    parser.add_argument("--calibration_h5", type=str, nargs="+", default=[], help="Preprocessed impacts for int8 calibration")
+    parser.add_argument("--n_calibration", type=int, default=128, help="Impacts sampled for calibration")
+    parser.add_argument("--eval_h5", type=str, nargs="+", default=[], help="Held-out preprocessed impacts for the comparison")
+    parser.add_argument("--n_eval", type=int, default=None, help="Impacts sampled for the comparison, all by default")
+    parser.add_argument("--threads", type=int, default=None, help="TensorFlow intra-op and TFLite interpreter threads")
+    parser.add_argument("--report", type=str, default=None, help="Write the comparison to this JSON file")
+
+    args = parser.parse_args()
+    if "int8" in args.quantization and not args.calibration_h5:
+        parser.error("int8 quantization needs --calibration_h5")
+
+    if args.threads:
+        tf.config.threading.set_intra_op_parallelism_threads(args.threads)
+
+    model = load_model(args.model_path)
+    calibration = None
+    if args.calibration_h5:
+        calibration, _ = sample_impacts(args.calibration_h5, args.n_calibration)
+
+    models = {"keras": model}
+    for quantization in args.quantization:
+        output_path = f"{args.output_prefix}_{quantization}.tflite"
+        size = export_tflite(model, output_path, quantization, calibration)
+        if os.path.exists(model_metadata_path(args.model_path)):
+            write_model_sample_rate(output_path, read_model_sample_rate(args.model_path))
+        print(f"Wrote {output_path} ({size / 1024:.0f} KB)")
+        models[quantization] = TFLiteModel(output_path, args.threads)
+
+    if args.eval_h5:
+        x, y = sample_impacts(args.eval_h5, args.n_eval, seed=1)
+        report = compare_models(models, x, y)
+        print(f"Compared on {len(y)} held-out impacts")
+        print(f"{'model':8s} {'MAE':>10s} {'max err':>10s} {'% range':>8s} {'corr':>8s} {'p50 ms':>8s} {'p99 ms':>8s} {'impacts/s':>10s}")
+        for name, row in report.items():
+            print(f"{name:8s} {row['mean_abs_error']:10.4g} {row['max_abs_error']:10.4g} {100 * row['max_error_of_range']:8.2f} "
+                  f"{row['correlation']:8.5f} {row['single_p50_ms']:8.2f} {row['single_p99_ms']:8.2f} {row['batch_impacts_per_s']:10.0f}")
+        if args.report:
+            with open(args.report, "w") as f:
+                json.dump(report, f, indent=1)
+            print(f"Wrote {args.report}")
@@ -0,0 +1,152 @@
+"""
+Streaming tf.data input pipeline over the preprocessed HDF5 files.
+
+Impacts are split into shards of shard_size impacts. Shards are shuffled, decoded in
+parallel and interleaved, and the samples pass through a bounded shuffle buffer before
+batching and prefetching, so memory use depends on shard_size, cycle_length and
+shuffle_buffer rather than on the size of the dataset:
+
+    dataset = make_dataset(["data/Team/Team_training.h5"], batch_size=32, seed=0)
+    model.fit(dataset, epochs=10)
+
+Both the per-group layout (perm_* datasets and ubric_score attrs) and the consolidated
+layout of preprocessing/consolidated_h5 are supported, including files that store only
+the canonical profile, which are augmented while decoding, and files with the ragged
+store, which are padded while decoding.
+"""
+
+import os
+import sys
+
+import h5py
+import numpy as np
+import tensorflow as tf
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "preprocessing"))
+from consolidated_h5 import PERM_NAMES, is_consolidated
+from impact_loader import load_consolidated_rows, load_group_impacts
+
+
+def list_shards(h5_paths, shard_size=64):
+    """
+    Splits the impacts of some HDF5 files into shards.
+
+    Args:
+        h5_paths (list): Paths to preprocessed HDF5 files, in either layout.
+        shard_size (int): Number of impacts per shard.
+
+    Returns:
+        tuple: List of (path, impacts) shards, where impacts are row indices in the
+            consolidated layout and group names in the per-group layout, and the
+            length of the CNN inputs.
+    """
+    shards = []
+    cnn_length = None
+    for path in h5_paths:
+        with h5py.File(path, "r") as hf:
+            if is_consolidated(hf):
+                impacts = np.arange(len(hf["name"]))
+                length = hf.attrs.get("cnn_length", hf["profiles"].shape[-1] if "profiles" in hf else None)
+            else:
+                impacts = sorted(name for name in hf if isinstance(hf[name], h5py.Group))
+                length = hf[impacts[0]][PERM_NAMES[0]].shape[-1] if impacts else None
+        if length is not None:
+            if cnn_length is not None and int(length) != cnn_length:
+                raise ValueError(f"{path} has CNN inputs of length {length}, expected {cnn_length}")
+            cnn_length = int(length)
+        for start in range(0, len(impacts), shard_size):
+            shards.append((path, impacts[start:start + shard_size]))
+    return shards, cnn_length
+
+
+def load_shard(shard, label="ubric_score", dtype=np.float32):
+    """
+    Reads and decodes one shard.
+
+    Args:
+        shard (tuple): (path, impacts) shard from list_shards.
+        label (str): Per-impact attribute or dataset used as the target.
+        dtype (np.dtype): dtype of the returned inputs and labels.
+
+    Returns:
+        tuple: (6 * impacts) x 1 x 3 x cnn_length inputs and the labels repeated for
+            each permutation.
+    """
+    path, impacts = shard
+    with h5py.File(path, "r") as hf:
+        if is_consolidated(hf):
+            x, y = load_consolidated_rows(hf, impacts, label, dtype)
+        else:
+            x, y = load_group_impacts(hf, impacts, label, dtype)
+    return x.astype(dtype, copy=False), y.astype(dtype)
+
+
+def make_dataset(h5_paths, batch_size=32, label="ubric_score", shard_size=64, shuffle_buffer=4096,
+                 cycle_length=None, num_shards=1, shard_index=0, seed=None, dtype=np.float32):
+    """
+    Builds a streaming tf.data.Dataset of (inputs, labels) batches.
+
+    Args:
+        h5_paths (list): Paths to preprocessed HDF5 files, in either layout.
+        batch_size (int): Number of samples (impact permutations) per batch.
+        label (str): Per-impact attribute or dataset used as the target.
+        shard_size (int): Number of impacts read and decoded together.
+        shuffle_buffer (int): Size of the sample shuffle buffer, 0 to keep the file order.
+        cycle_length (int): Number of shards decoded in parallel, defaults to the CPU count.
+        num_shards (int): Number of workers splitting the shards, e.g. for multi-worker training.
+        shard_index (int): Index of this worker.
+        seed (int): Seed of the shard and sample shuffles.
+        dtype (np.dtype): dtype of the inputs and labels.
+
+    Returns:
+        tf.data.Dataset: Batches of batch_size x 1 x 3 x cnn_length inputs and batch_size labels.
+    """
+    shards, cnn_length = list_shards(h5_paths, shard_size)
+    shards = shards[shard_index::num_shards]
+    if not shards:
+        raise ValueError(f"No impacts found in {h5_paths}")
+    tf_dtype = tf.as_dtype(dtype)
+    shuffle = shuffle_buffer > 0
+
+    def decode(i):
+        return load_shard(shards[i], label, dtype)
+
+    def read(i):
+        x, y = tf.numpy_function(decode, [i], [tf_dtype, tf_dtype])
+        x.set_shape([None, 1, 3, cnn_length])
+        y.set_shape([None])
+        return tf.data.Dataset.from_tensor_slices((x, y))
+
+    dataset = tf.data.Dataset.range(len(shards))
+    if shuffle:
+        dataset = dataset.shuffle(len(shards), seed=seed, reshuffle_each_iteration=True)
+    dataset = dataset.interleave(
+        read, cycle_length=cycle_length or os.cpu_count(),
+        num_parallel_calls=tf.data.AUTOTUNE, deterministic=not shuffle
+    )
+    if shuffle:
+        dataset = dataset.shuffle(shuffle_buffer, seed=seed, reshuffle_each_iteration=True)
+    return dataset.batch(batch_size).prefetch(tf.data.AUTOTUNE)
+
+
+if __name__ == "__main__":
+    import argparse
+    import time
+
+    parser = argparse.ArgumentParser(description="Measure the throughput of the streaming input pipeline")
+    parser.add_argument("h5_paths", type=str, nargs="+")
+    parser.add_argument("--batch_size", type=int, default=32)
+    parser.add_argument("--shard_size", type=int, default=64)
+    parser.add_argument("--shuffle_buffer", type=int, default=4096)
+    parser.add_argument("--cycle_length", type=int, default=None)
+
+    args = parser.parse_args()
+
+    dataset = make_dataset(args.h5_paths, args.batch_size, shard_size=args.shard_size,
+                           shuffle_buffer=args.shuffle_buffer, cycle_length=args.cycle_length)
+    start = time.perf_counter()
+    samples = 0
+    for x, y in dataset:
+        samples += int(x.shape[0])
+    elapsed = time.perf_counter() - start
+    print(f"Read {samples} samples in {elapsed:.2f} s ({samples / elapsed:.0f} samples/s)")
@@ -0,0 +1,101 @@
+"""
+Load generator for the local inference server (serve.py).
+
+Sends impacts from a directory of trajectory CSVs, or synthetic impacts, to /predict from
+concurrent client threads, one impact per request as the sideline tablets do, and reports
+client-side throughput and latency together with the server's /metrics:
+
+    python CNN/load_generator.py --url http://127.0.0.1:8500 --requests 2000 --concurrency 32
+"""
+
+import json
+import os
+import sys
+import time
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "preprocessing"))
+from score import find_trajectory_files
+from synthetic_impacts import synthetic_impact
+from trajectory_store import read_trajectory
+
+
+def make_payloads(root_dir=None, n_payloads=64, seed=0):
+    """
+    Returns encoded /predict request bodies, from the trajectory CSVs below root_dir or synthetic.
+    """
+    if root_dir is not None:
+        impacts = [read_trajectory(path) for path in find_trajectory_files(root_dir)[:n_payloads]]
+    else:
+        rng = np.random.default_rng(seed)
+        impacts = [synthetic_impact(rng) for _ in range(n_payloads)]
+    return [
+        json.dumps({"time": t.tolist(), "ang": profile.tolist()}).encode()
+        for t, profile in impacts
+    ]
+
+
+def _post(url, body):
+    request = urllib.request.Request(url, data=body, headers={"Content-Type": "application/json"})
+    start = time.perf_counter()
+    try:
+        with urllib.request.urlopen(request) as response:
+            response.read()
+        return time.perf_counter() - start, None
+    except Exception as e:
+        return time.perf_counter() - start, repr(e)
+
+
+def run_load(url, payloads, n_requests=1000, concurrency=16):
+    """
+    Sends n_requests /predict requests from concurrency client threads.
+
+    Returns:
+        dict: Client-side throughput, latency percentiles, errors and the server metrics.
+    """
+    predict_url = url.rstrip("/") + "/predict"
+    bodies = [payloads[i % len(payloads)] for i in range(n_requests)]
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        results = list(pool.map(lambda body: _post(predict_url, body), bodies))
+    elapsed = time.perf_counter() - start
+
+    latencies = np.array([latency for latency, error in results if error is None]) * 1e3
+    errors = [error for _, error in results if error is not None]
+    report = {
+        "requests": n_requests,
+        "concurrency": concurrency,
+        "errors": len(errors),
+        "elapsed_s": elapsed,
+        "requests_per_s": n_requests / elapsed,
+    }
+    if len(latencies):
+        report["latency_ms"] = {
+            "p50": float(np.percentile(latencies, 50)),
+            "p99": float(np.percentile(latencies, 99)),
+            "max": float(latencies.max()),
+        }
+    if errors:
+        report["first_error"] = errors[0]
+    with urllib.request.urlopen(url.rstrip("/") + "/metrics") as response:
+        report["server"] = json.loads(response.read())
+    return report
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Generate load against a local inference server")
+    parser.add_argument("--url", type=str, default="http://127.0.0.1:8500")
+    parser.add_argument("--root_dir", type=str, default=None, help="Send these trajectory CSVs instead of synthetic impacts")
+    parser.add_argument("--requests", type=int, default=1000)
+    parser.add_argument("--concurrency", type=int, default=16)
+
+    args = parser.parse_args()
+
+    payloads = make_payloads(args.root_dir)
+    print(json.dumps(run_load(args.url, payloads, args.requests, args.concurrency), indent=1))
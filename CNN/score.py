@@ -0,0 +1,217 @@
+"""
+Batch inference: scores every impact below a directory with one loaded model.
+
+Trajectory CSVs are read and preprocessed (conjugate transform and shift_and_pad of all
+six axis permutations, via augment_batch) by a thread pool while the model predicts the
+previous chunk. The predicted strain of an impact is the mean prediction over its six
+permutations. Results are written to a CSV next to the UBrIC score of each impact:
+
+    python CNN/score.py model.keras data/TeamA --output reports/TeamA_scores.csv
+
+With --metrics_cache, UBrIC scores are looked up in the persistent metrics cache (see
+preprocessing/metrics_cache.py), so rescoring a directory only computes new impacts.
+
+Impacts are resampled to the rate the model was trained at (see preprocessing/resample.py)
+before they are augmented, and --sample_rate must match it when that rate is recorded.
+UBrIC scores are computed on the recorded profiles, as in preprocessing.
+"""
+
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "preprocessing"))
+from augment_batch import PERMUTATIONS, augment_batch
+from calculate_ubric import calculate_ubric_batch
+from metrics_cache import DEFAULT_CACHE_PATH, MetricsCache
+from resample import resample_padded, resolve_sample_rate
+from trajectory_store import CACHE_DIRNAME, read_trajectory
+
+CNN_LENGTH = 2000
+TARGET_IDX = CNN_LENGTH // 2
+
+
+def find_trajectory_files(root_dir):
+    """
+    Returns the trajectory CSVs below root_dir. In a team/session tree only the CSVs in
+    trajectories folders are impacts; otherwise every CSV is.
+    """
+    all_files = []
+    trajectory_files = []
+    for dirpath, dirnames, filenames in os.walk(root_dir):
+        dirnames[:] = [d for d in dirnames if d != CACHE_DIRNAME]
+        for filename in filenames:
+            if filename.endswith(".csv"):
+                path = os.path.join(dirpath, filename)
+                all_files.append(path)
+                if os.path.basename(dirpath) == "trajectories":
+                    trajectory_files.append(path)
+    return sorted(trajectory_files or all_files)
+
+
+def load_model(model_path, num_threads=None):
+    """
+    Loads a trained model, either a saved Keras model (.keras or .h5), weights for
+    build_brain_strain_cnn (.weights.h5 or a TensorFlow checkpoint) or a TFLite export
+    (.tflite, see export_tflite.py), which runs without TensorFlow or Keras. num_threads
+    sets the interpreter threads of TFLite exports.
+    """
+    if model_path.endswith(".tflite"):
+        from tflite_runner import TFLiteModel
+        return TFLiteModel(model_path, num_threads)
+
+    from keras.models import load_model as keras_load_model
+    from cnn_architecture import build_brain_strain_cnn
+
+    if model_path.endswith(".keras") or (model_path.endswith(".h5") and not model_path.endswith(".weights.h5")):
+        return keras_load_model(model_path)
+    model = build_brain_strain_cnn()
+    model.load_weights(model_path)
+    return model
+
+
+def prepare_chunk(filepaths, pool, cache=None, sample_rate=None):
+    """
+    Reads a chunk of impacts and computes their UBrIC scores and CNN inputs.
+
+    Args:
+        filepaths (list): Trajectory CSVs of the chunk.
+        pool (ThreadPoolExecutor): Threads reading the CSVs.
+        cache (MetricsCache): Metrics cache of the UBrIC scores.
+        sample_rate (float): Resample the profiles to this rate [Hz] before augmenting
+            them, keeps the recorded rate by default.
+
+    Returns:
+        tuple: Paths of the readable impacts, their recorded lengths, UBrIC scores, their
+            (6 * impacts) x 1 x 3 x CNN_LENGTH float32 inputs, and (path, error) failures.
+    """
+    paths = []
+    trajectories = []
+    failures = []
+    for path, result in zip(filepaths, pool.map(_read, filepaths)):
+        if isinstance(result, Exception):
+            failures.append((path, repr(result)))
+        else:
+            paths.append(path)
+            trajectories.append(result)
+    if not paths:
+        return paths, np.empty(0, dtype=int), np.empty(0), np.empty((0, 1, 3, CNN_LENGTH), dtype=np.float32), failures
+
+    lengths = np.array([len(t) for t, _ in trajectories])
+    times = np.zeros((len(paths), lengths.max()))
+    profiles = np.zeros((len(paths), lengths.max(), 3))
+    for i, (t, profile) in enumerate(trajectories):
+        times[i, :lengths[i]] = t
+        profiles[i, :lengths[i]] = profile
+
+    ubric_scores = calculate_ubric_batch(profiles, times, lengths, cache=cache)
+    cnn_lengths = lengths
+    if sample_rate is not None:
+        profiles, cnn_lengths = resample_padded(times, profiles, sample_rate, lengths)
+    x = augment_batch(profiles, TARGET_IDX, CNN_LENGTH, cnn_lengths)
+    x = x.reshape(-1, 1, 3, CNN_LENGTH).astype(np.float32)
+    return paths, lengths, ubric_scores, x, failures
+
+
+def _read(path):
+    try:
+        return read_trajectory(path)
+    except Exception as e:
+        return e
+
+
+def score(model, filepaths, batch_size=1024, chunk_impacts=2048, workers=None, cache=None, sample_rate=None):
+    """
+    Scores impacts with a loaded model.
+
+    Args:
+        model (keras.Model): Trained brain strain CNN.
+        filepaths (list): Trajectory CSVs to score.
+        batch_size (int): Batch size of model.predict, in permutations.
+        chunk_impacts (int): Number of impacts preprocessed and predicted together.
+        workers (int): Number of threads reading and preprocessing impacts.
+        cache (MetricsCache): Metrics cache of the UBrIC scores.
+        sample_rate (float): Rate [Hz] the model was trained at, see prepare_chunk.
+
+    Returns:
+        tuple: DataFrame with one row per scored impact and a list of (path, error) failures.
+    """
+    n_perms = len(PERMUTATIONS)
+    results = []
+    failures = []
+    chunks = [filepaths[i:i + chunk_impacts] for i in range(0, len(filepaths), chunk_impacts)]
+
+    with ThreadPoolExecutor(max_workers=workers) as pool, ThreadPoolExecutor(max_workers=1) as prefetch:
+        # Preprocess the next chunk while the model predicts the current one
+        next_chunk = prefetch.submit(prepare_chunk, chunks[0], pool, cache, sample_rate) if chunks else None
+        for i in range(len(chunks)):
+            paths, lengths, ubric_scores, x, chunk_failures = next_chunk.result()
+            if i + 1 < len(chunks):
+                next_chunk = prefetch.submit(prepare_chunk, chunks[i + 1], pool, cache, sample_rate)
+            failures.extend(chunk_failures)
+            if not paths:
+                continue
+
+            predictions = model.predict(x, batch_size=batch_size, verbose=0).reshape(len(paths), n_perms)
+            results.append(pd.DataFrame({
+                "path": paths,
+                "impact": [os.path.splitext(os.path.basename(path))[0] for path in paths],
+                "n_samples": lengths,
+                "ubric_score": ubric_scores,
+                "predicted_strain": predictions.mean(axis=1),
+                "predicted_strain_std": predictions.std(axis=1),
+            }))
+
+    columns = ["path", "impact", "n_samples", "ubric_score", "predicted_strain", "predicted_strain_std"]
+    return (pd.concat(results, ignore_index=True) if results else pd.DataFrame(columns=columns)), failures
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Score every impact below a directory with a trained brain strain CNN")
+    parser.add_argument("model_path", type=str, help="Saved Keras model, weights for build_brain_strain_cnn or a .tflite export")
+    parser.add_argument("root_dir", type=str, help="Directory of trajectory CSVs or a team/session tree")
+    parser.add_argument("--output", type=str, default=None, help="Results CSV, defaults to <root_dir>_scores.csv")
+    parser.add_argument("--batch_size", type=int, default=1024)
+    parser.add_argument("--chunk_impacts", type=int, default=2048)
+    parser.add_argument("--workers", type=int, default=None, help="Threads reading and preprocessing impacts")
+    parser.add_argument("--threads", type=int, default=None, help="TensorFlow intra-op or TFLite interpreter threads")
+    parser.add_argument("--metrics_cache", type=str, nargs="?", const=DEFAULT_CACHE_PATH, default=None,
+                        help=f"Look UBrIC scores up in a metrics cache, {DEFAULT_CACHE_PATH} by default")
+    parser.add_argument("--sample_rate", type=float, default=None,
+                        help="Resample impacts to this rate [Hz], the rate recorded for the model by default")
+
+    args = parser.parse_args()
+    sample_rate = resolve_sample_rate(args.model_path, args.sample_rate)
+
+    if args.threads and not args.model_path.endswith(".tflite"):
+        import tensorflow as tf
+        tf.config.threading.set_intra_op_parallelism_threads(args.threads)
+
+    filepaths = find_trajectory_files(args.root_dir)
+    print(f"Found {len(filepaths)} impacts in {args.root_dir}")
+
+    model = load_model(args.model_path, args.threads)
+    cache = MetricsCache(args.metrics_cache) if args.metrics_cache else None
+    start = time.perf_counter()
+    results, failures = score(model, filepaths, args.batch_size, args.chunk_impacts, args.workers, cache, sample_rate)
+    elapsed = time.perf_counter() - start
+    if cache is not None:
+        session = cache.stats()["session"]
+        print(f"Metrics cache {args.metrics_cache}: {session['hits']} hits, {session['misses']} misses")
+        cache.close()
+
+    output = args.output or f"{os.path.normpath(args.root_dir)}_scores.csv"
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    results.to_csv(output, index=False)
+    print(f"Scored {len(results)} impacts in {elapsed:.1f} s ({len(results) / max(elapsed, 1e-9):.1f} impacts/s), wrote {output}")
+    if failures:
+        print(f"{len(failures)} impacts failed:")
+        for path, error in failures:
+            print(f"  {path}: {error}")
+        raise SystemExit(1)
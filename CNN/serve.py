@@ -0,0 +1,265 @@
+"""
+Local micro-batching inference server for brain strain predictions.
+
+Request handler threads preprocess each impact (conjugate transform, shift_and_pad and
+padding to CNN_LENGTH for all six permutations, via augment_batch) and queue it. A single
+batching thread coalesces queued impacts into one model.predict call per micro-batch,
+waiting at most max_wait_ms for a batch to fill up to max_batch_size impacts.
+
+Endpoints:
+
+    POST /predict   {"time": [...], "ang_x": [...], "ang_y": [...], "ang_z": [...]}
+                    -> {"predicted_strain": ..., "predicted_strain_std": ..., "ubric_score": ...}
+    GET  /metrics   request count, p50/p99 latency and batch-size statistics
+    GET  /health
+
+    python CNN/serve.py model.keras --port 8500 --max_batch_size 32 --max_wait_ms 5
+
+Impacts are resampled to the rate the model was trained at before they are augmented,
+as in score.py; --sample_rate must match that rate when it is recorded.
+"""
+
+import json
+import os
+import queue
+import sys
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import numpy as np
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "preprocessing"))
+from augment_batch import PERMUTATIONS, augment_batch
+from calculate_ubric import calculate_ubric_from_profile
+from resample import resample_profile, resolve_sample_rate
+from score import CNN_LENGTH, TARGET_IDX, load_model
+
+
+class Metrics:
+    """
+    Thread-safe request latency and batch-size statistics over the most recent requests.
+    """
+
+    def __init__(self, window=10000):
+        self.lock = threading.Lock()
+        self.latencies = deque(maxlen=window)
+        self.batch_sizes = deque(maxlen=window)
+        self.requests = 0
+        self.errors = 0
+        self.batches = 0
+
+    def record_request(self, latency, error=False):
+        with self.lock:
+            self.requests += 1
+            self.errors += int(error)
+            if not error:
+                self.latencies.append(latency)
+
+    def record_batch(self, size):
+        with self.lock:
+            self.batches += 1
+            self.batch_sizes.append(size)
+
+    def summary(self):
+        with self.lock:
+            latencies = np.array(self.latencies) * 1e3
+            batch_sizes = np.array(self.batch_sizes)
+            summary = {"requests": self.requests, "errors": self.errors, "batches": self.batches}
+        if len(latencies):
+            summary["latency_ms"] = {
+                "p50": float(np.percentile(latencies, 50)),
+                "p99": float(np.percentile(latencies, 99)),
+                "max": float(latencies.max()),
+            }
+        if len(batch_sizes):
+            summary["batch_size"] = {
+                "mean": float(batch_sizes.mean()),
+                "p50": float(np.percentile(batch_sizes, 50)),
+                "max": int(batch_sizes.max()),
+            }
+        return summary
+
+
+class MicroBatcher:
+    """
+    Coalesces preprocessed impacts into micro-batches for a single predict call each.
+
+    Args:
+        model (keras.Model): Trained brain strain CNN.
+        max_batch_size (int): Maximum number of impacts per predict call.
+        max_wait_ms (float): Maximum time the first impact of a batch waits for more.
+        metrics (Metrics): Records the size of every batch.
+    """
+
+    def __init__(self, model, max_batch_size=32, max_wait_ms=5.0, metrics=None):
+        self.model = model
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1e3
+        self.metrics = metrics or Metrics()
+        self.queue = queue.Queue()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def submit(self, cnn_inputs):
+        """
+        Queues the 6 x 1 x 3 x CNN_LENGTH inputs of one impact.
+
+        Returns:
+            Future: Resolves to the six permutation predictions of the impact.
+        """
+        future = Future()
+        self.queue.put((cnn_inputs, future))
+        return future
+
+    def _run(self):
+        n_perms = len(PERMUTATIONS)
+        while True:
+            batch = [self.queue.get()]
+            deadline = time.perf_counter() + self.max_wait
+            while len(batch) < self.max_batch_size:
+                remaining = deadline - time.perf_counter()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(self.queue.get(timeout=remaining))
+                except queue.Empty:
+                    break
+
+            self.metrics.record_batch(len(batch))
+            try:
+                x = np.concatenate([cnn_inputs for cnn_inputs, _ in batch])
+                predictions = np.asarray(self.model.predict(x, batch_size=len(x), verbose=0)).reshape(len(batch), n_perms)
+            except Exception as e:
+                for _, future in batch:
+                    future.set_exception(e)
+                continue
+            for (_, future), prediction in zip(batch, predictions):
+                future.set_result(prediction)
+
+
+def preprocess_request(payload, sample_rate=None):
+    """
+    Converts a /predict request body to the CNN inputs and UBrIC score of the impact.
+
+    Args:
+        payload (dict): time and ang_x, ang_y, ang_z lists, or ang as an N x 3 list.
+        sample_rate (float): Resample the profile to this rate [Hz] before augmenting it,
+            keeps the recorded rate by default.
+
+    Returns:
+        tuple: 6 x 1 x 3 x CNN_LENGTH float32 inputs and the UBrIC score.
+    """
+    if "ang" in payload:
+        profile = np.asarray(payload["ang"], dtype=float)
+    else:
+        profile = np.column_stack([np.asarray(payload[key], dtype=float) for key in ["ang_x", "ang_y", "ang_z"]])
+    time_vector = np.asarray(payload["time"], dtype=float)
+    if profile.ndim != 2 or profile.shape[1] != 3 or len(profile) != len(time_vector) or len(profile) < 2:
+        raise ValueError("Expected time and at least two samples of 3-axis angular acceleration of the same length")
+
+    ubric_score = calculate_ubric_from_profile(profile, time_vector)
+    if sample_rate is not None:
+        time_vector, profile = resample_profile(time_vector, profile, sample_rate)
+    cnn_inputs = augment_batch(profile[np.newaxis], TARGET_IDX, CNN_LENGTH)[0]
+    return cnn_inputs[:, np.newaxis].astype(np.float32), ubric_score
+
+
+def make_handler(batcher, metrics, sample_rate=None):
+    class PredictionHandler(BaseHTTPRequestHandler):
+        def _send_json(self, status, body):
+            data = json.dumps(body).encode()
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def do_GET(self):
+            if self.path == "/metrics":
+                self._send_json(200, metrics.summary())
+            elif self.path == "/health":
+                self._send_json(200, {"status": "ok"})
+            else:
+                self._send_json(404, {"error": f"Unknown path {self.path}"})
+
+        def do_POST(self):
+            if self.path != "/predict":
+                self._send_json(404, {"error": f"Unknown path {self.path}"})
+                return
+            start = time.perf_counter()
+            try:
+                payload = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))))
+                cnn_inputs, ubric_score = preprocess_request(payload, sample_rate)
+            except (ValueError, KeyError, TypeError) as e:
+                metrics.record_request(time.perf_counter() - start, error=True)
+                self._send_json(400, {"error": f"Missing field {e}" if isinstance(e, KeyError) else str(e)})
+                return
+            try:
+                predictions = batcher.submit(cnn_inputs).result()
+            except Exception as e:
+                metrics.record_request(time.perf_counter() - start, error=True)
+                self._send_json(500, {"error": repr(e)})
+                return
+            metrics.record_request(time.perf_counter() - start)
+            self._send_json(200, {
+                "predicted_strain": float(predictions.mean()),
+                "predicted_strain_std": float(predictions.std()),
+                "ubric_score": float(ubric_score),
+            })
+
+        def log_message(self, format, *args):
+            pass
+
+    return PredictionHandler
+
+
+class InferenceServer(ThreadingHTTPServer):
+    daemon_threads = True
+    # Sideline bursts open many connections at once
+    request_queue_size = 128
+
+
+def make_server(model, host="127.0.0.1", port=8500, max_batch_size=32, max_wait_ms=5.0, sample_rate=None):
+    """
+    Creates the inference server. Call serve_forever on the result to run it. sample_rate
+    is the rate [Hz] the model was trained at, see preprocess_request.
+
+    Returns:
+        InferenceServer: Server with its batcher and metrics as attributes.
+    """
+    metrics = Metrics()
+    batcher = MicroBatcher(model, max_batch_size, max_wait_ms, metrics)
+    server = InferenceServer((host, port), make_handler(batcher, metrics, sample_rate))
+    server.batcher = batcher
+    server.metrics = metrics
+    return server
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Serve brain strain predictions with micro-batching")
+    parser.add_argument("model_path", type=str, help="Saved Keras model, weights for build_brain_strain_cnn or a .tflite export")
+    parser.add_argument("--host", type=str, default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8500)
+    parser.add_argument("--max_batch_size", type=int, default=32)
+    parser.add_argument("--max_wait_ms", type=float, default=5.0)
+    parser.add_argument("--sample_rate", type=float, default=None,
+                        help="Resample impacts to this rate [Hz], the rate recorded for the model by default")
+
+    args = parser.parse_args()
+    sample_rate = resolve_sample_rate(args.model_path, args.sample_rate)
+
+    model = load_model(args.model_path)
+    server = make_server(model, args.host, args.port, args.max_batch_size, args.max_wait_ms, sample_rate)
+    print(f"Serving on http://{args.host}:{args.port} (max batch {args.max_batch_size}, max wait {args.max_wait_ms} ms)")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        print(json.dumps(server.metrics.summary(), indent=1))
@@ -0,0 +1,83 @@
+"""
+Lightweight runner for TFLite exports of the brain strain CNN (see export_tflite.py).
+
+Only needs a TFLite interpreter: the tflite-runtime or ai-edge-litert package, falling back
+to tf.lite when full TensorFlow happens to be installed. TFLiteModel has the predict
+signature of a Keras model, so score.py and serve.py run .tflite files unchanged:
+
+    python CNN/score.py brain_strain_int8.tflite data/TeamA --threads 4
+"""
+
+import numpy as np
+
+
+def _interpreter_class():
+    try:
+        from tflite_runtime.interpreter import Interpreter
+        return Interpreter
+    except ImportError:
+        pass
+    try:
+        from ai_edge_litert.interpreter import Interpreter
+        return Interpreter
+    except ImportError:
+        pass
+    try:
+        import tensorflow as tf
+        return tf.lite.Interpreter
+    except ImportError:
+        raise ImportError("Running .tflite models needs tflite-runtime, ai-edge-litert or tensorflow") from None
+
+
+class TFLiteModel:
+    """
+    Predicts with a TFLite model, resizing its batch dimension as needed.
+
+    Args:
+        model_path (str): Path to the .tflite file.
+        num_threads (int): Interpreter threads, defaults to the interpreter's choice.
+    """
+
+    def __init__(self, model_path, num_threads=None):
+        self.model_path = model_path
+        self.interpreter = _interpreter_class()(model_path=model_path, num_threads=num_threads)
+        self.input = self.interpreter.get_input_details()[0]
+        self.output = self.interpreter.get_output_details()[0]
+        self.input_shape = tuple(int(d) for d in self.input["shape"][1:])
+        self.batch = None
+
+    def _resize(self, batch):
+        if batch != self.batch:
+            self.interpreter.resize_tensor_input(self.input["index"], (batch,) + self.input_shape)
+            self.interpreter.allocate_tensors()
+            self.batch = batch
+
+    def predict(self, x, batch_size=None, verbose=0):
+        """
+        Predicts a batch of CNN inputs.
+
+        Args:
+            x (np.ndarray): n x 1 x 3 x cnn_length inputs.
+            batch_size (int): Inputs per interpreter call, all at once by default.
+            verbose (int): Ignored, for compatibility with keras.Model.predict.
+
+        Returns:
+            np.ndarray: n x 1 predictions.
+        """
+        x = np.ascontiguousarray(x, dtype=np.float32)
+        if x.shape[1:] != self.input_shape:
+            raise ValueError(f"Expected inputs of shape (n,) + {self.input_shape}, got {x.shape}")
+        batch_size = batch_size or len(x)
+        outputs = []
+        for start in range(0, len(x), batch_size):
+            chunk = x[start:start + batch_size]
+            self._resize(len(chunk))
+            self.interpreter.set_tensor(self.input["index"], chunk)
+            self.interpreter.invoke()
+            outputs.append(self.interpreter.get_tensor(self.output["index"]).copy())
+        if not outputs:
+            return np.empty((0, 1), dtype=np.float32)
+        return np.concatenate(outputs)
+
+    def __call__(self, x):
+        return self.predict(x)
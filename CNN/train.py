@@ -0,0 +1,278 @@
+"""
+Synchronous data-parallel CPU training of the brain strain CNN.
+
+Workers run MultiWorkerMirroredStrategy with ring all-reduce. Each worker reads its own
+share of the impact shards of the preprocessed HDF5 files (see input_pipeline.make_dataset)
+and computes the gradients of batch_size / workers samples per step. The training state
+is backed up to model_dir after every epoch, and a restarted run resumes from the last
+backup. The chief worker writes the trained model, the sample rate of its training files
+(see resample.write_model_sample_rate) and a history of losses and throughput:
+
+    # single process
+    python CNN/train.py data/*/*_training.h5 --model_dir runs/cnn --epochs 50
+    # four worker processes on this machine, each with a quarter of the cores
+    python CNN/train.py data/*/*_training.h5 --model_dir runs/cnn --local_workers 4
+    # one process per machine, the same cluster file on each
+    python CNN/train.py data/*/*_training.h5 --model_dir runs/cnn --cluster_config cluster.json --task_index 0
+
+The cluster file lists the workers, chief first: {"worker": ["node1:12345", "node2:12345"]}.
+model_dir must be on storage shared by all machines.
+"""
+
+import json
+import os
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+import tensorflow as tf
+from keras.callbacks import BackupAndRestore, Callback
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "preprocessing"))
+from cnn_architecture import build_brain_strain_cnn
+from consolidated_h5 import PERM_NAMES
+from input_pipeline import list_shards, make_dataset
+from resample import h5_paths_sample_rate, write_model_sample_rate
+
+HISTORY_NAME = "history.json"
+MODEL_NAME = "model.keras"
+
+
+def load_cluster_config(config_path):
+    """
+    Reads a cluster file of the form {"worker": ["host:port", ...]}.
+    """
+    with open(config_path) as f:
+        cluster = json.load(f)
+    if not cluster.get("worker"):
+        raise ValueError(f"{config_path} lists no workers")
+    return {"worker": list(cluster["worker"])}
+
+
+def set_tf_config(cluster, task_index):
+    """
+    Sets TF_CONFIG for this process, before the strategy is created.
+    """
+    if not 0 <= task_index < len(cluster["worker"]):
+        raise IndexError(f"Task index {task_index} out of range for {len(cluster['worker'])} workers")
+    os.environ["TF_CONFIG"] = json.dumps({"cluster": cluster, "task": {"type": "worker", "index": task_index}})
+
+
+def local_cluster(n_workers):
+    """
+    Returns a cluster of n_workers processes on localhost, on free ports.
+    """
+    sockets = []
+    for _ in range(n_workers):
+        sock = socket.socket()
+        sock.bind(("localhost", 0))
+        sockets.append(sock)
+    ports = [sock.getsockname()[1] for sock in sockets]
+    for sock in sockets:
+        sock.close()
+    return {"worker": [f"localhost:{port}" for port in ports]}
+
+
+def make_strategy():
+    """
+    Returns MultiWorkerMirroredStrategy when TF_CONFIG describes a cluster, otherwise
+    the default single-process strategy.
+    """
+    if "TF_CONFIG" not in os.environ:
+        return tf.distribute.get_strategy()
+    options = tf.distribute.experimental.CommunicationOptions(
+        implementation=tf.distribute.experimental.CommunicationImplementation.RING
+    )
+    return tf.distribute.MultiWorkerMirroredStrategy(communication_options=options)
+
+
+def is_chief():
+    if "TF_CONFIG" not in os.environ:
+        return True
+    task = json.loads(os.environ["TF_CONFIG"])["task"]
+    return task["index"] == 0
+
+
+def distributed_dataset(strategy, h5_paths, batch_size, shard_size, shuffle_buffer, seed):
+    """
+    Builds the dataset of every worker from its share of the impact shards.
+
+    Returns:
+        tuple: The distributed dataset, repeated indefinitely, and the number of samples
+            (impact permutations) in one epoch.
+    """
+    shards, _ = list_shards(h5_paths, shard_size)
+    n_samples = len(PERM_NAMES) * sum(len(impacts) for _, impacts in shards)
+
+    def dataset_fn(input_context):
+        return make_dataset(
+            h5_paths, input_context.get_per_replica_batch_size(batch_size),
+            shard_size=shard_size, shuffle_buffer=shuffle_buffer,
+            num_shards=input_context.num_input_pipelines, shard_index=input_context.input_pipeline_id,
+            seed=seed,
+        ).repeat()
+
+    return strategy.distribute_datasets_from_function(dataset_fn), n_samples
+
+
+class ThroughputHistory(Callback):
+    """
+    Records the duration and sample throughput of every epoch next to the logged metrics.
+    """
+
+    def __init__(self, samples_per_epoch):
+        super().__init__()
+        self.samples_per_epoch = samples_per_epoch
+        self.epochs = []
+
+    def on_epoch_begin(self, epoch, logs=None):
+        self.start = time.perf_counter()
+
+    def on_epoch_end(self, epoch, logs=None):
+        seconds = time.perf_counter() - self.start
+        entry = {"epoch": epoch, "seconds": seconds, "samples_per_s": self.samples_per_epoch / seconds}
+        entry.update({key: float(value) for key, value in (logs or {}).items()})
+        self.epochs.append(entry)
+
+
+def train(h5_paths, model_dir, epochs=50, batch_size=32, learning_rate=1e-6, scale_lr=False,
+          steps_per_epoch=None, val_h5_paths=None, shard_size=64, shuffle_buffer=4096, seed=None):
+    """
+    Trains the CNN on this worker. With TF_CONFIG set, every worker of the cluster runs
+    this with the same arguments.
+
+    Args:
+        h5_paths (list): Preprocessed HDF5 training files, in either layout, all
+            resampled to the same rate.
+        model_dir (str): Directory of the backups, the trained model and the history.
+        epochs (int): Number of epochs.
+        batch_size (int): Global batch size in samples, split evenly over the workers.
+        learning_rate (float): Adam learning rate.
+        scale_lr (bool): Multiply the learning rate by the number of workers, as the
+            global batch grows with them.
+        steps_per_epoch (int): Steps per epoch, defaults to one pass over the training samples.
+        val_h5_paths (list): Preprocessed HDF5 validation files.
+        shard_size (int): Number of impacts per shard of the input pipeline.
+        shuffle_buffer (int): Size of the sample shuffle buffer of every worker.
+        seed (int): Seed of the shard and sample shuffles.
+
+    Returns:
+        list: Per-epoch history of losses, duration and throughput.
+    """
+    strategy = make_strategy()
+    n_workers = strategy.num_replicas_in_sync
+    if batch_size % n_workers:
+        raise ValueError(f"Batch size {batch_size} is not divisible by {n_workers} workers")
+    # Inputs at one rate only, which scoring and serving must resample to
+    sample_rate = h5_paths_sample_rate(list(h5_paths) + list(val_h5_paths or []))
+
+    train_dataset, n_samples = distributed_dataset(strategy, h5_paths, batch_size, shard_size, shuffle_buffer, seed)
+    steps_per_epoch = steps_per_epoch or max(1, n_samples // batch_size)
+    validation = {}
+    if val_h5_paths:
+        val_dataset, n_val = distributed_dataset(strategy, val_h5_paths, batch_size, shard_size, 0, seed)
+        validation = {"validation_data": val_dataset, "validation_steps": max(1, n_val // batch_size)}
+
+    with strategy.scope():
+        model = build_brain_strain_cnn(learning_rate * n_workers if scale_lr else learning_rate)
+
+    history = ThroughputHistory(steps_per_epoch * batch_size)
+    callbacks = [BackupAndRestore(os.path.join(model_dir, "backup")), history]
+    if is_chief():
+        print(f"Training on {n_workers} workers: {n_samples} samples, {steps_per_epoch} steps of {batch_size} per epoch")
+    model.fit(train_dataset, epochs=epochs, steps_per_epoch=steps_per_epoch, callbacks=callbacks,
+              verbose=2 if is_chief() else 0, **validation)
+
+    # Every worker saves, as saving may need all of them, but only the chief's copy is kept
+    save_dir = model_dir if is_chief() else tempfile.mkdtemp()
+    os.makedirs(save_dir, exist_ok=True)
+    model.save(os.path.join(save_dir, MODEL_NAME))
+    if is_chief():
+        write_model_sample_rate(os.path.join(model_dir, MODEL_NAME), sample_rate)
+        # Keep the epochs of the runs this one resumed from
+        history_path = os.path.join(model_dir, HISTORY_NAME)
+        epochs_run = history.epochs
+        if os.path.exists(history_path) and epochs_run:
+            with open(history_path) as f:
+                previous = json.load(f)["epochs"]
+            epochs_run = [entry for entry in previous if entry["epoch"] < epochs_run[0]["epoch"]] + epochs_run
+        with open(history_path, "w") as f:
+            json.dump({"workers": n_workers, "batch_size": batch_size, "epochs": epochs_run}, f, indent=1)
+    else:
+        shutil.rmtree(save_dir, ignore_errors=True)
+    return history.epochs
+
+
+def launch_local_workers(args, n_workers):
+    """
+    Runs n_workers training processes on this machine, splitting the cores between them.
+
+    Returns:
+        int: 0 if every worker succeeded, else the first non-zero exit code.
+    """
+    threads = max(1, (os.cpu_count() or 1) // n_workers)
+    cluster_dir = tempfile.mkdtemp()
+    cluster_path = os.path.join(cluster_dir, "cluster.json")
+    with open(cluster_path, "w") as f:
+        json.dump(local_cluster(n_workers), f)
+
+    command = [sys.executable, os.path.abspath(__file__), *args.h5_paths, "--model_dir", args.model_dir,
+               "--epochs", str(args.epochs), "--batch_size", str(args.batch_size),
+               "--learning_rate", str(args.learning_rate), "--shard_size", str(args.shard_size),
+               "--shuffle_buffer", str(args.shuffle_buffer), "--cluster_config", cluster_path, "--threads", str(threads)]
+    for option in ["steps_per_epoch", "seed"]:
+        if getattr(args, option) is not None:
+            command += [f"--{option}", str(getattr(args, option))]
+    if args.val_h5:
+        command += ["--val_h5", *args.val_h5]
+    if args.scale_lr:
+        command.append("--scale_lr")
+
+    workers = [subprocess.Popen(command + ["--task_index", str(i)]) for i in range(n_workers)]
+    try:
+        codes = [worker.wait() for worker in workers]
+    finally:
+        # A failed worker blocks the others in their next all-reduce
+        for worker in workers:
+            if worker.poll() is None:
+                worker.kill()
+        shutil.rmtree(cluster_dir, ignore_errors=True)
+    return next((code for code in codes if code), 0)
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Data-parallel CPU training of the brain strain CNN")
+    parser.add_argument("h5_paths", type=str, nargs="+", help="Preprocessed HDF5 training files")
+    parser.add_argument("--model_dir", type=str, required=True, help="Backups, trained model and history")
+    parser.add_argument("--epochs", type=int, default=50)
+    parser.add_argument("--batch_size", type=int, default=32, help="Global batch size, split over the workers")
+    parser.add_argument("--learning_rate", type=float, default=1e-6)
+    parser.add_argument("--scale_lr", action="store_true", help="Scale the learning rate with the number of workers")
+    parser.add_argument("--steps_per_epoch", type=int, default=None)
+    parser.add_argument("--val_h5", type=str, nargs="+", default=[], help="Preprocessed HDF5 validation files")
+    parser.add_argument("--shard_size", type=int, default=64)
+    parser.add_argument("--shuffle_buffer", type=int, default=4096)
+    parser.add_argument("--seed", type=int, default=None)
+    parser.add_argument("--local_workers", type=int, default=None, help="Run this many worker processes on this machine")
+    parser.add_argument("--cluster_config", type=str, default=None, help="JSON cluster file, see the module docstring")
+    parser.add_argument("--task_index", type=int, default=0, help="Index of this worker in the cluster file")
+    parser.add_argument("--threads", type=int, default=None, help="TensorFlow intra-op threads of this worker")
+
+    args = parser.parse_args()
+
+    if args.local_workers and args.local_workers > 1:
+        raise SystemExit(launch_local_workers(args, args.local_workers))
+
+    if args.threads:
+        tf.config.threading.set_intra_op_parallelism_threads(args.threads)
+        tf.config.threading.set_inter_op_parallelism_threads(min(args.threads, 2))
+    if args.cluster_config:
+        set_tf_config(load_cluster_config(args.cluster_config), args.task_index)
+
+    train(args.h5_paths, args.model_dir, args.epochs, args.batch_size, args.learning_rate, args.scale_lr,
+          args.steps_per_epoch, args.val_h5, args.shard_size, args.shuffle_buffer, args.seed)
@@ -0,0 +1,389 @@
+"""
+Benchmark suite for the preprocessing and metrics hot paths.
+
+Times the per-impact functions on synthetic impacts at several lengths and sample rates,
+the full process_file of process_new_structure, and HDF5 write and read throughput of every
+layout at increasing numbers of impacts. Every benchmark is repeated, with the repeats of
+different benchmarks interleaved, and results are written as JSON. They can be compared
+against a stored baseline, failing when the fastest repeat of a benchmark got slower,
+relative to the speed of the machine during the run (see compare), than the tolerance
+plus the spread of its repeats:
+
+    python benchmarks/run_benchmarks.py --output benchmarks/baseline.json
+    python benchmarks/run_benchmarks.py --baseline benchmarks/baseline.json --output results.json
+
+The speed of the machine is measured by a fixed calibration kernel that does not call any
+repo code, timed along with every section. The comparison also fails when the machine
+itself ran slower than the tolerance, as its timings cannot be trusted then, unless
+--allow_machine_drift is passed. Baselines are only comparable on the same machine.
+"""
+
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime, timezone
+from functools import partial
+
+import h5py
+import numpy as np
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "preprocessing"))
+from calculate_damage import compute_damage_from_csv
+from calculate_ubric import calculate_ubric_from_profile
+from conjugate import conjugate_vrot_transform
+from consolidated_h5 import ConsolidatedWriter
+from impact_loader import load_consolidated_rows, load_group_impacts
+from preprocess import write_impact
+from process_new_structure import CNN_LENGTH, TARGET_IDX, prepare_impact, process_file
+from resample import resample_batch
+from resultant_val import resultant_val
+from shift_and_pad import shift_and_pad
+from synthetic_impacts import synthetic_impact, write_impact_csv
+from trajectory_store import ingest_directory, parse_trajectory_csv, read_trajectory
+
+# (samples, sample rate) of the per-impact benchmarks
+IMPACT_SIZES = [(500, 1000.0), (2000, 3200.0), (10000, 10000.0)]
+H5_COUNTS = [1, 1000]
+H5_COUNTS_FULL = [1, 1000, 100000]
+H5_LAYOUTS = ["groups", "consolidated", "canonical", "ragged"]
+# Canonical rate of the resampling benchmark [Hz]
+RESAMPLE_RATE = 1000.0
+# Benchmarks of the calibration kernel, one per section, named calibration/<section>
+CALIBRATION_PREFIX = "calibration/"
+_CALIBRATION_MATRIX = np.random.default_rng(0).standard_normal((192, 192))
+_CALIBRATION_ARRAY = np.random.default_rng(1).standard_normal(1 << 20)
+_CALIBRATION_PROFILE = np.random.default_rng(2).standard_normal((2000, 3))
+
+
+def calibration_kernel():
+    """
+    Fixed workload that does not touch repo code, so its timing only changes with the
+    speed of the machine. Like the benchmarks, it mixes BLAS, memory-bound passes over a
+    large array, many numpy calls on impact-sized arrays and pure Python.
+    """
+    product = _CALIBRATION_MATRIX @ _CALIBRATION_MATRIX
+    np.sort(np.sqrt(np.abs(product)).ravel())
+    np.cumsum(np.sqrt(np.abs(_CALIBRATION_ARRAY)))
+    for _ in range(50):
+        scaled = _CALIBRATION_PROFILE * 2.0
+        np.sqrt((scaled ** 2).sum(axis=1)).argmax()
+        np.diff(scaled, axis=0)
+    total = 0
+    for i in range(20000):
+        total += i * i
+    return total
+
+
+def time_calls(funcs, min_time=0.2, repeats=5):
+    """
+    Times several function calls. Each repeat calls every function enough times to run
+    for about min_time / repeats seconds. The repeats of the functions are interleaved,
+    so a slow drift in machine speed during the run affects every function alike rather
+    than whichever one was being timed.
+
+    Args:
+        funcs (dict): Functions without arguments by benchmark name.
+        min_time (float): Seconds spent timing each function.
+        repeats (int): Number of repeats per function.
+
+    Returns:
+        dict: Per benchmark, the median and minimum seconds per call over the repeats and
+            the number of calls.
+    """
+    numbers = {}
+    for name, func in funcs.items():
+        func()
+        start = time.perf_counter()
+        func()
+        once = max(time.perf_counter() - start, 1e-7)
+        numbers[name] = max(1, int(min_time / repeats / once))
+
+    per_call = {name: [] for name in funcs}
+    for _ in range(repeats):
+        for name, func in funcs.items():
+            number = numbers[name]
+            start = time.perf_counter()
+            for _ in range(number):
+                func()
+            per_call[name].append((time.perf_counter() - start) / number)
+    return {name: dict(_timings(per_call[name]), calls=numbers[name] * repeats) for name in funcs}
+
+
+def _timings(seconds):
+    return {"seconds": float(np.median(seconds)), "min_seconds": float(np.min(seconds)), "calls": len(seconds)}
+
+
+def benchmark_functions(tmp_dir, rng, min_time):
+    funcs = {f"{CALIBRATION_PREFIX}functions": calibration_kernel}
+    profiles = []
+    csv_paths = {}
+    for n_samples, fs in IMPACT_SIZES:
+        suffix = f"N{n_samples}_fs{int(fs)}"
+        t, profile = synthetic_impact(rng, n_samples, fs)
+        profiles.append(profile)
+        csv_path = os.path.join(tmp_dir, f"impact_{suffix}.csv")
+        write_impact_csv(csv_path, t, profile, rng)
+        csv_paths[suffix] = csv_path
+        conj = conjugate_vrot_transform(profile)
+        h5_path = os.path.join(tmp_dir, f"process_file_{suffix}.h5")
+
+        funcs[f"resultant_val/{suffix}"] = partial(resultant_val, profile)
+        funcs[f"conjugate_vrot_transform/{suffix}"] = partial(conjugate_vrot_transform, profile)
+        funcs[f"shift_and_pad/{suffix}"] = partial(shift_and_pad, conj, TARGET_IDX, CNN_LENGTH)
+        funcs[f"calculate_ubric_from_profile/{suffix}"] = partial(calculate_ubric_from_profile, profile, t)
+        funcs[f"parse_trajectory_csv/{suffix}"] = partial(parse_trajectory_csv, csv_path)
+        funcs[f"compute_damage_from_csv/{suffix}"] = partial(compute_damage_from_csv, csv_path)
+        funcs[f"process_file/{suffix}"] = partial(process_file, csv_path, h5_path, True, "Front", 0.5)
+
+    # All impact sizes as one batch of mixed sample rates
+    lengths = np.array([n_samples for n_samples, _ in IMPACT_SIZES])
+    batch = np.zeros((len(profiles), lengths.max(), 3))
+    for i, profile in enumerate(profiles):
+        batch[i, :len(profile)] = profile
+    rates = [fs for _, fs in IMPACT_SIZES]
+    funcs["resample_batch/mixed_rates"] = partial(resample_batch, batch, rates, RESAMPLE_RATE, lengths)
+
+    # Reads served from the binary trajectory cache, after every CSV is written
+    ingest_directory(tmp_dir)
+    for suffix, csv_path in csv_paths.items():
+        funcs[f"read_trajectory_cached/{suffix}"] = partial(read_trajectory, csv_path)
+    return time_calls(funcs, min_time)
+
+
+def _write_h5(h5_path, layout, impact, count, batch_size=256):
+    with h5py.File(h5_path, "w") as hf:
+        if layout == "groups":
+            for i in range(count):
+                write_impact(hf, dict(impact, group_name=f"impact_{i:06d}"), verbose=False)
+        else:
+            profile_store = "augmented" if layout == "consolidated" else layout
+            with ConsolidatedWriter(hf, batch_size, CNN_LENGTH, profile_store=profile_store) as writer:
+                for i in range(count):
+                    writer.add(dict(impact, group_name=f"impact_{i:06d}"))
+
+
+def _read_h5(h5_path, batch_size=256):
+    with h5py.File(h5_path, "r") as hf:
+        if "name" in hf:
+            n = len(hf["name"])
+            for start in range(0, n, batch_size):
+                load_consolidated_rows(hf, np.arange(start, min(start + batch_size, n)))
+        else:
+            names = sorted(hf)
+            for start in range(0, len(names), batch_size):
+                load_group_impacts(hf, names[start:start + batch_size])
+
+
+def benchmark_h5(tmp_dir, rng, counts, repeats=5):
+    """
+    Times writing and reading count impacts in every layout, repeats times each. Like
+    time_calls, a repeat runs the calibration kernel and every layout and count before
+    the next repeat starts.
+
+    Returns:
+        dict: Median and minimum seconds, impacts per second and bytes per impact per
+            layout and count, and the seconds of the calibration kernel.
+    """
+    t, profile = synthetic_impact(rng, 2000, 3200.0)
+    csv_path = os.path.join(tmp_dir, "h5_impact.csv")
+    write_impact_csv(csv_path, t, profile, rng)
+    impact = prepare_impact(csv_path, True, "Front", 0.5)
+
+    # Enough calibration calls per repeat to run for about 40 ms
+    calibration_kernel()
+    start = time.perf_counter()
+    calibration_kernel()
+    n_calibration = max(1, int(0.04 / max(time.perf_counter() - start, 1e-7)))
+    calibration_seconds = []
+
+    cases = [(layout, count) for layout in H5_LAYOUTS for count in counts]
+    write_seconds = {case: [] for case in cases}
+    read_seconds = {case: [] for case in cases}
+    sizes = {}
+    for _ in range(repeats):
+        start = time.perf_counter()
+        for _ in range(n_calibration):
+            calibration_kernel()
+        calibration_seconds.append((time.perf_counter() - start) / n_calibration)
+        for layout, count in cases:
+            h5_path = os.path.join(tmp_dir, f"bench_{layout}_{count}.h5")
+            start = time.perf_counter()
+            _write_h5(h5_path, layout, impact, count)
+            write_seconds[layout, count].append(time.perf_counter() - start)
+            sizes[layout, count] = os.path.getsize(h5_path)
+
+            start = time.perf_counter()
+            _read_h5(h5_path)
+            read_seconds[layout, count].append(time.perf_counter() - start)
+            os.remove(h5_path)
+
+    results = {f"{CALIBRATION_PREFIX}h5": dict(_timings(calibration_seconds), calls=n_calibration * repeats)}
+    for layout, count in cases:
+        # Impacts per second of the fastest repeat
+        write = _timings(write_seconds[layout, count])
+        read = _timings(read_seconds[layout, count])
+        results[f"h5_write/{layout}/{count}"] = dict(write, impacts_per_second=count / write["min_seconds"])
+        results[f"h5_read/{layout}/{count}"] = dict(
+            read, impacts_per_second=count / read["min_seconds"], bytes_per_impact=sizes[layout, count] / count
+        )
+    return results
+
+
+def machine_info():
+    try:
+        commit = subprocess.run(
+            ["git", "rev-parse", "HEAD"], capture_output=True, text=True, check=True,
+            cwd=os.path.dirname(os.path.abspath(__file__))
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {
+        "timestamp": datetime.now(timezone.utc).isoformat(),
+        "commit": commit,
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "h5py": h5py.__version__,
+        "platform": platform.platform(),
+        "processor": platform.processor(),
+        "cpu_count": os.cpu_count(),
+    }
+
+
+def run_benchmarks(min_time=0.2, h5_counts=H5_COUNTS, seed=0, h5_repeats=5):
+    """
+    Runs every benchmark in a temporary directory.
+
+    Returns:
+        dict: Machine info under "machine", the settings under "settings" and benchmark
+            timings under "results".
+    """
+    rng = np.random.default_rng(seed)
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        results = benchmark_functions(tmp_dir, rng, min_time)
+        results.update(benchmark_h5(tmp_dir, rng, h5_counts, h5_repeats))
+    settings = {"min_time": min_time, "h5_counts": list(h5_counts), "h5_repeats": h5_repeats, "seed": seed}
+    return {"machine": machine_info(), "settings": settings, "results": results}
+
+
+def _spread(result):
+    # Relative spread of the repeats, zero for single-shot results of older baselines
+    fastest = result.get("min_seconds", result["seconds"])
+    return result["seconds"] / fastest - 1
+
+
+def _section(name):
+    if name.startswith(CALIBRATION_PREFIX):
+        return name[len(CALIBRATION_PREFIX):]
+    return "h5" if name.startswith("h5_") else "functions"
+
+
+def compare(results, baseline, tolerance=0.2, absolute=False):
+    """
+    Compares results against a baseline on the fastest repeat of every benchmark, which
+    is the least affected by other load on the machine.
+
+    Virtual machines drift in speed by tens of percent between runs, which moves every
+    benchmark alike. Unless absolute is set, each ratio is therefore divided by the
+    ratio of the calibration kernel timed with its section, the speed factor of the
+    machine while that section ran. The kernel runs no repo code, so a slowdown shared
+    by every benchmark still counts as a regression. The function and HDF5 sections get
+    separate factors, as they run at different times; the kernel does not measure the
+    disk the HDF5 section is bound by. Baselines without the kernel get a factor of 1.0.
+    The tolerance of a benchmark is also widened by the larger relative spread (median
+    over fastest repeat) of the two runs, so benchmarks that are noisy on this machine
+    need a larger slowdown to fail.
+
+    Args:
+        results (dict): Output of run_benchmarks.
+        baseline (dict): Earlier output of run_benchmarks.
+        tolerance (float): Allowed relative slowdown of a benchmark without noise.
+        absolute (bool): Compare raw ratios, without the speed factor.
+
+    Returns:
+        tuple: (name, baseline seconds, current seconds, ratio, allowed ratio, regressed)
+            for every benchmark in both but the calibration kernels, and the speed factor
+            of every section (1.0 if absolute is set).
+    """
+    shared = [name for name in results["results"] if name in baseline["results"]]
+    fastest = {}
+    for name in shared:
+        previous = baseline["results"][name]
+        current = results["results"][name]
+        fastest[name] = (previous.get("min_seconds", previous["seconds"]), current.get("min_seconds", current["seconds"]))
+
+    ratios = {name: current / previous for name, (previous, current) in fastest.items()}
+    speed = {_section(name): 1.0 for name in shared}
+    if not absolute:
+        speed.update({_section(name): ratios[name] for name in shared if name.startswith(CALIBRATION_PREFIX)})
+
+    rows = []
+    for name in shared:
+        if name.startswith(CALIBRATION_PREFIX):
+            continue
+        previous_seconds, current_seconds = fastest[name]
+        ratio = ratios[name] / speed[_section(name)]
+        allowed = 1 + tolerance + max(_spread(baseline["results"][name]), _spread(results["results"][name]))
+        rows.append((name, previous_seconds, current_seconds, ratio, allowed, ratio > allowed))
+    return rows, speed
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Benchmark the preprocessing and metrics hot paths")
+    parser.add_argument("--output", type=str, default=None, help="Write the results to this JSON file")
+    parser.add_argument("--baseline", type=str, default=None, help="Compare against this earlier results file")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="Allowed relative slowdown")
+    parser.add_argument("--min_time", type=float, default=0.2, help="Seconds spent timing each function")
+    parser.add_argument("--h5_repeats", type=int, default=5, help="Repeats of every HDF5 write and read benchmark")
+    parser.add_argument("--absolute", action="store_true",
+                        help="Compare raw timings instead of timings relative to the machine speed factor")
+    parser.add_argument("--allow_machine_drift", action="store_true",
+                        help="Do not fail when the calibration kernel ran slower than the tolerance")
+    parser.add_argument("--full", action="store_true", help="Also benchmark HDF5 files of 100k impacts (needs ~30 GB of disk)")
+
+    args = parser.parse_args()
+
+    report = run_benchmarks(args.min_time, H5_COUNTS_FULL if args.full else H5_COUNTS, h5_repeats=args.h5_repeats)
+    for name, result in report["results"].items():
+        extra = f"  {result['impacts_per_second']:.0f} impacts/s" if "impacts_per_second" in result else ""
+        print(f"{name:55s} {result['seconds'] * 1e3:10.3f} ms{extra}")
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=1)
+        print(f"Wrote {args.output}")
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        baseline_settings = baseline.get("settings")
+        if baseline_settings is not None and baseline_settings != report["settings"]:
+            print(f"Warning: {args.baseline} was recorded with settings {baseline_settings}, "
+                  f"this run used {report['settings']}")
+        rows, speed = compare(report, baseline, args.tolerance, args.absolute)
+        regressions = [row for row in rows if row[5]]
+        print(f"\nCompared the fastest repeat of {len(rows)} benchmarks against {args.baseline}")
+        drift = []
+        if not args.absolute:
+            if not any(name.startswith(CALIBRATION_PREFIX) for name in baseline["results"]):
+                print(f"{args.baseline} has no calibration timings, comparing raw timings")
+            for section, factor in speed.items():
+                print(f"Machine speed factor of the {section} benchmarks x{factor:.2f}, their ratios below are relative to it")
+                if factor > 1 + args.tolerance:
+                    drift.append(section)
+        for name, previous, current, ratio, allowed, regressed in rows:
+            flag = "  REGRESSION" if regressed else ""
+            print(f"{name:55s} {previous * 1e3:10.3f} -> {current * 1e3:10.3f} ms  x{ratio:.2f} (allowed x{allowed:.2f}){flag}")
+        if drift:
+            print(f"The machine ran slower than x{1 + args.tolerance:.2f} during the {', '.join(drift)} benchmarks, "
+                  f"so their timings are unreliable" +
+                  ("" if args.allow_machine_drift else "; rerun on an idle machine or pass --allow_machine_drift"))
+        if regressions:
+            print(f"{len(regressions)} benchmarks regressed by more than their allowed slowdown")
+        if regressions or (drift and not args.allow_machine_drift):
+            raise SystemExit(1)
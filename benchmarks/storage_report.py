@@ -0,0 +1,186 @@
+"""
+Size and read throughput of the HDF5 storage settings (see preprocessing/h5_storage.py).
+
+Every source file is repacked with each dtype, filter and chunking setting, then read back
+the way training reads it: shuffled batches of single rows as impact_loader does, and
+contiguous shards as CNN/input_pipeline.py does for consolidated files. The report lists
+bytes per impact, impacts per second of both access patterns and the largest deviation of
+the loaded CNN inputs from the source file:
+
+    python benchmarks/storage_report.py data/TeamA/TeamA_training.h5 --output storage.json
+    python benchmarks/storage_report.py --synthetic 512
+
+Files are read right after they were written, so reads come from the page cache. On network
+storage read time grows with the bytes per impact, which the report lists separately.
+"""
+
+import json
+import os
+import sys
+import tempfile
+import time
+
+import h5py
+import numpy as np
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "preprocessing"))
+from consolidated_h5 import ConsolidatedWriter, is_consolidated, repack_h5
+from h5_storage import describe_storage, storage_options
+from impact_loader import load_consolidated_rows, load_group_impacts
+from preprocess import write_impact
+from process_new_structure import CNN_LENGTH, prepare_impact
+from synthetic_impacts import synthetic_impact, write_impact_csv
+
+# (dtype, compression, compression_level, shuffle) of each reported setting
+SETTINGS = [
+    ("float64", "none", 4, False),
+    ("float32", "none", 4, False),
+    ("float16", "none", 4, False),
+    ("float32", "lzf", 4, False),
+    ("float32", "lzf", 4, True),
+    ("float32", "gzip", 1, True),
+    ("float32", "gzip", 4, True),
+    ("float16", "gzip", 4, True),
+]
+CHUNK_IMPACTS = [1, 64]
+
+
+def write_synthetic_h5(h5_path, n_impacts, layout="consolidated", seed=0):
+    """
+    Writes n_impacts synthetic impacts to an H5 file with the default storage settings.
+    """
+    rng = np.random.default_rng(seed)
+    with tempfile.TemporaryDirectory() as tmp_dir, h5py.File(h5_path, "w") as hf:
+        writer = None
+        if layout != "groups":
+            profile_store = "augmented" if layout == "consolidated" else layout
+            writer = ConsolidatedWriter(hf, cnn_length=CNN_LENGTH, profile_store=profile_store)
+        for i in range(n_impacts):
+            csv_path = os.path.join(tmp_dir, f"impact_{i:06d}.csv")
+            t, profile = synthetic_impact(rng, int(rng.integers(500, 3000)))
+            write_impact_csv(csv_path, t, profile, rng)
+            impact = prepare_impact(csv_path, 1.0, "Front", np.nan, augment=layout not in ("canonical", "ragged"))
+            if writer is not None:
+                writer.add(impact)
+            else:
+                write_impact(hf, impact, verbose=False)
+        if writer is not None:
+            writer.close()
+
+
+def _batches(hf, batch_size, shuffle, rng):
+    if is_consolidated(hf):
+        order = np.arange(len(hf["name"]))
+    else:
+        order = np.array(sorted(hf))
+    if shuffle:
+        rng.shuffle(order)
+    return [order[i:i + batch_size] for i in range(0, len(order), batch_size)]
+
+
+def read_all(h5_path, batch_size, shuffle, seed=0):
+    """
+    Reads every impact of a file in batches of CNN inputs.
+
+    Returns:
+        tuple: Seconds taken and the inputs of every impact in file order, as float32.
+    """
+    rng = np.random.default_rng(seed)
+    inputs = {}
+    start = time.perf_counter()
+    with h5py.File(h5_path, "r") as hf:
+        consolidated = is_consolidated(hf)
+        for batch in _batches(hf, batch_size, shuffle, rng):
+            if consolidated:
+                x, _ = load_consolidated_rows(hf, batch, dtype=np.float32)
+                batch = np.sort(batch)
+            else:
+                x, _ = load_group_impacts(hf, list(batch), dtype=np.float32)
+            for i, key in enumerate(batch):
+                inputs[key] = x[6 * i:6 * i + 6]
+    seconds = time.perf_counter() - start
+    return seconds, np.stack([inputs[key] for key in sorted(inputs)])
+
+
+def storage_report(h5_paths, settings=SETTINGS, chunk_impacts=CHUNK_IMPACTS, batch_size=32, shard_size=64):
+    """
+    Repacks every file with every setting and measures its size and read throughput.
+
+    Returns:
+        list: One dict per file and setting.
+    """
+    rows = []
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for h5_path in h5_paths:
+            with h5py.File(h5_path, "r") as hf:
+                consolidated = is_consolidated(hf)
+                n = len(hf["name"]) if consolidated else len(hf)
+            if n == 0:
+                print(f"Skipping empty file {h5_path}")
+                continue
+            _, reference = read_all(h5_path, shard_size, shuffle=False)
+
+            for setting in settings:
+                storage = storage_options(*setting)
+                for chunk in (chunk_impacts if consolidated else [None]):
+                    out_path = os.path.join(tmp_dir, "repacked.h5")
+                    repack_h5(h5_path, out_path, storage, chunk or 1)
+                    size = os.path.getsize(out_path)
+
+                    random_seconds, x = read_all(out_path, batch_size, shuffle=True)
+                    row = {
+                        "file": h5_path,
+                        "storage": describe_storage(storage),
+                        "chunk_impacts": chunk,
+                        "impacts": n,
+                        "bytes_per_impact": size / n,
+                        "random_impacts_per_s": n / random_seconds,
+                        "max_abs_error": float(np.abs(x - reference).max()),
+                    }
+                    if consolidated:
+                        shard_seconds, _ = read_all(out_path, shard_size, shuffle=False)
+                        row["shard_impacts_per_s"] = n / shard_seconds
+                    rows.append(row)
+                    os.remove(out_path)
+    return rows
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Report the size and read throughput of the HDF5 storage settings")
+    parser.add_argument("h5_paths", type=str, nargs="*")
+    parser.add_argument("--synthetic", type=int, default=0, help="Also report a file of this many synthetic impacts")
+    parser.add_argument("--layout", type=str, default="consolidated", choices=["groups", "consolidated", "canonical", "ragged"],
+                        help="Layout of the synthetic file")
+    parser.add_argument("--batch_size", type=int, default=32, help="Impacts per shuffled batch")
+    parser.add_argument("--shard_size", type=int, default=64, help="Impacts per contiguous shard")
+    parser.add_argument("--output", type=str, default=None, help="Write the report to this JSON file")
+
+    args = parser.parse_args()
+    if not args.h5_paths and not args.synthetic:
+        parser.error("Give H5 files or --synthetic")
+
+    with tempfile.TemporaryDirectory() as synthetic_dir:
+        h5_paths = list(args.h5_paths)
+        if args.synthetic:
+            synthetic_path = os.path.join(synthetic_dir, f"synthetic_{args.layout}.h5")
+            write_synthetic_h5(synthetic_path, args.synthetic, args.layout)
+            h5_paths.append(synthetic_path)
+        report = storage_report(h5_paths, batch_size=args.batch_size, shard_size=args.shard_size)
+
+    print(f"{'storage':24s} {'chunk':>5s} {'KB/impact':>10s} {'random/s':>10s} {'shard/s':>10s} {'max error':>10s}")
+    h5_path = None
+    for row in report:
+        if row["file"] != h5_path:
+            h5_path = row["file"]
+            print(f"{h5_path}: {row['impacts']} impacts")
+        shard = f"{row['shard_impacts_per_s']:10.0f}" if "shard_impacts_per_s" in row else f"{'-':>10s}"
+        chunk = "-" if row["chunk_impacts"] is None else str(row["chunk_impacts"])
+        print(f"{row['storage']:24s} {chunk:>5s} {row['bytes_per_impact'] / 1024:10.1f} "
+              f"{row['random_impacts_per_s']:10.0f} {shard} {row['max_abs_error']:10.3g}")
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=1)
+        print(f"Wrote {args.output}")
@@ -0,0 +1,89 @@
+"""
+Scaling benchmark of data-parallel CPU training (CNN/train.py) on this machine.
+
+Runs train.py with 1, 2, 4 and 8 local worker processes for a fixed number of steps,
+keeping the batch of every worker constant (the global batch grows with the workers),
+and reports the training throughput of the last epoch, the speedup over one worker and
+the parallel efficiency:
+
+    python benchmarks/training_scaling.py data/TeamA/TeamA_training.h5 --output scaling.json
+
+The first epoch includes graph tracing and worker startup, so run at least two.
+"""
+
+import json
+import os
+import subprocess
+import sys
+import tempfile
+
+TRAIN_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "CNN", "train.py")
+WORKER_COUNTS = [1, 2, 4, 8]
+
+
+def run_training(h5_paths, n_workers, model_dir, per_worker_batch=32, epochs=2, steps_per_epoch=50):
+    """
+    Runs train.py with n_workers local workers.
+
+    Returns:
+        dict: The training history written by the chief.
+    """
+    command = [sys.executable, TRAIN_SCRIPT, *h5_paths, "--model_dir", model_dir,
+               "--epochs", str(epochs), "--steps_per_epoch", str(steps_per_epoch),
+               "--batch_size", str(per_worker_batch * n_workers), "--seed", "0"]
+    if n_workers > 1:
+        command += ["--local_workers", str(n_workers)]
+    subprocess.run(command, check=True)
+    with open(os.path.join(model_dir, "history.json")) as f:
+        return json.load(f)
+
+
+def scaling_benchmark(h5_paths, worker_counts=WORKER_COUNTS, per_worker_batch=32, epochs=2, steps_per_epoch=50):
+    """
+    Trains with every worker count in turn.
+
+    Returns:
+        list: Per worker count, the samples per second of the last epoch, speedup and efficiency.
+    """
+    rows = []
+    for n_workers in worker_counts:
+        with tempfile.TemporaryDirectory() as model_dir:
+            history = run_training(h5_paths, n_workers, model_dir, per_worker_batch, epochs, steps_per_epoch)
+        rows.append({
+            "workers": n_workers,
+            "batch_size": history["batch_size"],
+            "samples_per_s": history["epochs"][-1]["samples_per_s"],
+            "loss": history["epochs"][-1].get("loss"),
+        })
+    # Relative to the smallest run, normally a single worker
+    base = rows[0]
+    for row in rows:
+        row["speedup"] = row["samples_per_s"] / base["samples_per_s"]
+        row["efficiency"] = row["speedup"] * base["workers"] / row["workers"]
+    return rows
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Benchmark data-parallel CPU training at increasing worker counts")
+    parser.add_argument("h5_paths", type=str, nargs="+")
+    parser.add_argument("--workers", type=int, nargs="+", default=WORKER_COUNTS)
+    parser.add_argument("--per_worker_batch", type=int, default=32)
+    parser.add_argument("--epochs", type=int, default=2)
+    parser.add_argument("--steps_per_epoch", type=int, default=50)
+    parser.add_argument("--output", type=str, default=None, help="Write the results to this JSON file")
+
+    args = parser.parse_args()
+
+    rows = scaling_benchmark(args.h5_paths, args.workers, args.per_worker_batch, args.epochs, args.steps_per_epoch)
+    print(f"CPUs: {os.cpu_count()}")
+    print(f"{'workers':>7s} {'batch':>6s} {'samples/s':>10s} {'speedup':>8s} {'efficiency':>10s}")
+    for row in rows:
+        print(f"{row['workers']:7d} {row['batch_size']:6d} {row['samples_per_s']:10.0f} "
+              f"{row['speedup']:8.2f} {row['efficiency']:10.1%}")
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump({"cpu_count": os.cpu_count(), "results": rows}, f, indent=1)
+        print(f"Wrote {args.output}")
@@ -0,0 +1,205 @@
+"""
+Batched augmentation kernel. Produces the CNN inputs for all six axis permutations
+of a batch of impacts in one vectorized pass, matching the per-call path
+
+    conj_profile = conjugate_vrot_transform(profile[:, perm])
+    padded_profile = shift_and_pad(conj_profile, target_idx, cnn_length)
+    cnn_input = padded_profile.T
+
+bit for bit.
+
+Original MATLAB implementation can be found here: https://github.com/Jilab-biomechanics/CNN-brain-strains
+"""
+
+import itertools
+import math
+
+import numpy as np
+
+PERMUTATIONS = list(itertools.permutations([0, 1, 2]))
+
+# vec2ang squares numpy scalars, which goes through libm pow rather than numpy's
+# array square; math.pow reproduces the scalar result exactly
+_pow = np.vectorize(math.pow, otypes=[float])
+
+
+def _resultant(val):
+    # Same operation order as resultant_val, so argmax ties break identically.
+    # val is ... x 3 x N
+    return np.sqrt(val[..., 0, :] ** 2 + val[..., 1, :] ** 2 + val[..., 2, :] ** 2)
+
+
+def _conjugate_chunk(profiles, lengths, peak_idx=None):
+    # Returns the conjugated permutations, B x 6 x 3 x N, and the peak index of each.
+    # With peak_idx (B,), that sample is used as the peak instead of the argmax
+    B, N, _ = profiles.shape
+    n_perms = len(PERMUTATIONS)
+    valid = (np.arange(N) < lengths[:, np.newaxis])[:, np.newaxis, :]
+
+    # All permutations at once, channels first: B x 6 x 3 x N
+    profiles = profiles.transpose(0, 2, 1)
+    permuted = profiles[:, PERMUTATIONS, :]
+
+    # conjugate_vrot_transform: rotation axis at the peak resultant. Addition is
+    # commutative, so the resultant of a permutation only depends on which axis is
+    # added last and three sums cover all six permutations
+    sq = profiles ** 2
+    res = np.sqrt(np.stack([sq[:, 1] + sq[:, 2] + sq[:, 0], sq[:, 0] + sq[:, 2] + sq[:, 1], sq[:, 0] + sq[:, 1] + sq[:, 2]], axis=1))
+    res = np.where(valid, res, -1.0)
+    if peak_idx is None:
+        peak_loc = np.argmax(res, axis=-1)[:, [perm[2] for perm in PERMUTATIONS]]
+    else:
+        peak_loc = np.repeat(np.asarray(peak_idx)[:, np.newaxis], n_perms, axis=1)
+    peak = permuted[np.arange(B)[:, np.newaxis], np.arange(n_perms)[np.newaxis, :], :, peak_loc]
+    norm = np.sqrt((peak[..., np.newaxis, :] @ peak[..., :, np.newaxis])[..., 0, 0])
+    rot_axis = peak / norm[..., np.newaxis]
+
+    # vec2ang
+    theta = np.degrees(np.arctan2(rot_axis[..., 1], rot_axis[..., 0]))
+    alpha = np.degrees(np.arctan2(rot_axis[..., 2], np.sqrt(_pow(rot_axis[..., 0], 2) + _pow(rot_axis[..., 1], 2))))
+
+    # conjugate_rotational_axis and ang2vec
+    theta_new = np.where(theta >= 0, 180 - theta, -180 - theta)
+    alpha_new = -alpha
+    rot_axis_conj = np.stack([
+        np.cos(np.radians(alpha_new)) * np.cos(np.radians(theta_new)),
+        np.cos(np.radians(alpha_new)) * np.sin(np.radians(theta_new)),
+        np.sin(np.radians(alpha_new)),
+    ], axis=-1)
+    flip = (theta < -90) | (theta > 90)
+    rot_axis_conj = np.where(flip[..., np.newaxis], rot_axis_conj, rot_axis)
+
+    sv = rot_axis_conj / rot_axis
+    permuted *= sv[..., np.newaxis]
+
+    if peak_idx is not None:
+        return permuted, peak_loc
+
+    # Peak of the transformed profile, which shift_and_pad moves to target_idx
+    res = np.where(valid, _resultant(permuted), -1.0)
+    return permuted, np.argmax(res, axis=-1)
+
+
+def _augment_chunk(profiles, lengths, target_idx, cnn_length, out, peak_idx=None):
+    B, N, _ = profiles.shape
+    n_perms = len(PERMUTATIONS)
+    permuted, peak_idx = _conjugate_chunk(profiles, lengths, peak_idx)
+
+    # shift_and_pad as a gather: output sample j takes input sample j - start,
+    # clipped to the first and last valid samples
+    start = np.maximum(target_idx - peak_idx, 0)
+    src = np.arange(cnn_length) - start[..., np.newaxis]
+    np.clip(src, 0, (lengths - 1)[:, np.newaxis, np.newaxis], out=src)
+
+    # Flat indices into the B x 6 x 3 x N buffer, gathered straight into the output
+    row_offsets = np.arange(B * n_perms * 3).reshape(B, n_perms, 3, 1) * N
+    np.take(permuted.reshape(-1), row_offsets + src[:, :, np.newaxis, :], out=out)
+
+
+def augment_batch(profiles, target_idx, cnn_length, lengths=None, out=None, chunk_size=16, peak_idx=None):
+    """
+    Computes the CNN inputs for all axis permutations of a batch of impacts.
+
+    Args:
+        profiles (np.ndarray): B x N x 3 array of angular acceleration profiles.
+        target_idx (int): Target index to center the peak resultant value.
+        cnn_length (int): Desired length of the output time series.
+        lengths (np.ndarray): Number of valid samples per impact (B,), for ragged
+            batches padded to a common N. Defaults to N.
+        out (np.ndarray): Optional preallocated, C-contiguous float64 B x 6 x 3 x cnn_length
+            output buffer.
+        chunk_size (int): Number of impacts processed per pass, bounds temporary memory.
+        peak_idx (np.ndarray): Sample of every impact (B,) used as the peak for the
+            rotation axis and the shift, instead of the peak resultant. For segments that
+            may hold more than one impact, such as those of stream_detector.
+
+    Returns:
+        np.ndarray: B x 6 x 3 x cnn_length CNN inputs, permutations in PERMUTATIONS order.
+    """
+    profiles = np.asarray(profiles, dtype=float)
+    B, N, _ = profiles.shape
+    lengths = np.full(B, N) if lengths is None else np.asarray(lengths, dtype=int)
+    if out is None:
+        out = np.empty((B, len(PERMUTATIONS), 3, cnn_length))
+
+    for start in range(0, B, chunk_size):
+        end = min(start + chunk_size, B)
+        _augment_chunk(profiles[start:end], lengths[start:end], target_idx, cnn_length, out[start:end],
+                       None if peak_idx is None else np.asarray(peak_idx)[start:end])
+    return out
+
+
+def ragged_batch(profiles, target_idx, cnn_length, lengths=None, chunk_size=16):
+    """
+    Computes the transformed permutations of a batch of impacts without padding them:
+    only the samples shift_and_pad keeps, starting at the first sample and ending at the
+    last one or where the CNN input ends. The padding repeats the first and last kept
+    samples, so pad_ragged rebuilds the augment_batch output from these bit for bit.
+
+    Args:
+        profiles (np.ndarray): B x N x 3 array of angular acceleration profiles.
+        target_idx (int): Target index to center the peak resultant value.
+        cnn_length (int): Length of the CNN input time series.
+        lengths (np.ndarray): Number of valid samples per impact (B,), defaults to N.
+        chunk_size (int): Number of impacts processed per pass, bounds temporary memory.
+
+    Returns:
+        tuple: 3 x total samples of every impact and permutation, concatenated in
+            impact and then PERMUTATIONS order, and the number of samples (B x 6) and
+            peak index (B x 6) of every permutation.
+    """
+    profiles = np.asarray(profiles, dtype=float)
+    B, N, _ = profiles.shape
+    lengths = np.full(B, N) if lengths is None else np.asarray(lengths, dtype=int)
+
+    blocks = []
+    kept = np.empty((B, len(PERMUTATIONS)), dtype=int)
+    peaks = np.empty((B, len(PERMUTATIONS)), dtype=int)
+    for start in range(0, B, chunk_size):
+        end = min(start + chunk_size, B)
+        permuted, peak_idx = _conjugate_chunk(profiles[start:end], lengths[start:end])
+        kept[start:end] = np.minimum(lengths[start:end, np.newaxis], cnn_length - np.maximum(target_idx - peak_idx, 0))
+        peaks[start:end] = peak_idx
+        for i in range(end - start):
+            for p in range(len(PERMUTATIONS)):
+                blocks.append(permuted[i, p, :, :kept[start + i, p]])
+    samples = np.concatenate(blocks, axis=1) if blocks else np.empty((3, 0))
+    return samples, kept, peaks
+
+
+def pad_ragged(samples, offsets, lengths, peak_idx, target_idx, cnn_length, out=None):
+    """
+    Rebuilds the padded CNN inputs from ragged samples with one vectorized gather, the
+    inverse of ragged_batch.
+
+    Args:
+        samples (np.ndarray): 3 x total ragged samples.
+        offsets (np.ndarray): Start of every impact in samples (B,); its permutations follow
+            each other.
+        lengths (np.ndarray): Number of samples of every permutation (B x 6).
+        peak_idx (np.ndarray): Peak index of every permutation (B x 6).
+        target_idx (int): Target index of the peak.
+        cnn_length (int): Length of the CNN input time series.
+        out (np.ndarray): Optional preallocated, C-contiguous B x 6 x 3 x cnn_length output
+            buffer of the dtype of samples.
+
+    Returns:
+        np.ndarray: B x 6 x 3 x cnn_length CNN inputs, permutations in PERMUTATIONS order.
+    """
+    lengths = np.asarray(lengths, dtype=np.int64)
+    B, n_perms = lengths.shape
+    if out is None:
+        out = np.empty((B, n_perms, 3, cnn_length), dtype=samples.dtype)
+    if B == 0:
+        return out
+
+    perm_offsets = np.asarray(offsets, dtype=np.int64)[:, np.newaxis] + np.cumsum(lengths, axis=1) - lengths
+    start = np.maximum(target_idx - np.asarray(peak_idx, dtype=np.int64), 0)
+    src = np.arange(cnn_length) - start[..., np.newaxis]
+    np.clip(src, 0, (lengths - 1)[..., np.newaxis], out=src)
+    src += perm_offsets[..., np.newaxis]
+
+    # Flat indices into the 3 x total samples
+    channel_offsets = (np.arange(3) * samples.shape[1]).reshape(1, 1, 3, 1)
+    np.take(np.ascontiguousarray(samples).reshape(-1), channel_offsets + src[:, :, np.newaxis, :], out=out)
+    return out
@@ -5,9 +5,10 @@ Comments should describe the steps taken to compute UBrIC as per the paper.
 Paper can be found here: https://doi.org/10.1007/s10439-018-2015-9"""
 
 import numpy as np
-import pandas as pd
 import math
 from scipy.integrate import cumulative_trapezoid
+from metrics_cache import acceleration_hash, metric_key
+from trajectory_store import read_trajectory
 
 
 # Critical values for UBrIC calculation (from Table 4 in the reference paper)
@@ -102,29 +103,148 @@ def calculate_ubric_from_profile(profile, time):
     ubric_score = compute_ubric(acc_values, vel_values)
     return ubric_score
 
-def read_impact(path):
+# Element-wise math.exp / math.pow so the batch path reproduces the scalar
+# per-impact arithmetic bit for bit (numpy's SIMD exp/pow can differ by an ulp)
+_exp = np.vectorize(math.exp, otypes=[float])
+_pow = np.vectorize(math.pow, otypes=[float])
+
+def peak_values_batch(profiles, time, lengths=None):
+    """
+    Computes the peak acceleration and peak velocity for a batch of impacts
+    with a single integration pass over all impacts and axes.
+
+    Args:
+        profiles (np.ndarray): B x N x 3 array of angular acceleration (x, y, z).
+        time (np.ndarray): Shared time vector (N,) or per-impact times (B, N).
+        lengths (np.ndarray): Number of valid samples per impact (B,). Samples past
+            an impact's length are ignored. Defaults to N.
+    Returns:
+        a_vals (np.ndarray): B x 3 peak absolute acceleration.
+        w_vals (np.ndarray): B x 3 peak absolute velocity.
+    """
+    # Work on B x 3 x N so integration and peaks run along contiguous memory
+    acc_values = np.swapaxes(np.asarray(profiles, dtype=float), 1, 2).copy()
+    time = np.asarray(time, dtype=float)
+    if time.ndim == 2:
+        time = time[:, np.newaxis, :]
+
+    vel_values = cumulative_trapezoid(acc_values, time, axis=-1, initial=0)
+
+    acc_abs = np.abs(acc_values, out=acc_values)
+    vel_abs = np.abs(vel_values, out=vel_values)
+    if lengths is not None:
+        # Absolute values are non-negative, so zeroing padded samples leaves the peaks unchanged
+        padded = np.arange(acc_abs.shape[-1]) >= np.asarray(lengths)[:, np.newaxis]
+        padded = np.broadcast_to(padded[:, np.newaxis, :], acc_abs.shape)
+        acc_abs[padded] = 0.0
+        vel_abs[padded] = 0.0
+
+    return np.max(acc_abs, axis=-1), np.max(vel_abs, axis=-1)
+
+def ubric_from_peaks(a_vals, w_vals, w_cr=None, a_cr=None, r_norm=None):
+    """
+    Applies the critical value normalization and r-norm (Equation 2) to peak
+    values of a batch of impacts. Peaks can be computed once with
+    peak_values_batch and rescored whenever the critical values are revised.
+
+    Args:
+        a_vals (np.ndarray): B x 3 peak absolute acceleration.
+        w_vals (np.ndarray): B x 3 peak absolute velocity.
+        w_cr (np.ndarray): Critical velocities, defaults to w_cr_MPS.
+        a_cr (np.ndarray): Critical accelerations, defaults to a_cr_MPS.
+        r_norm (float): Norm exponent, defaults to r.
+    Returns:
+        ubric (np.ndarray): UBrIC score per impact (B,).
+    """
+    w_cr = w_cr_MPS if w_cr is None else np.asarray(w_cr)
+    a_cr = a_cr_MPS if a_cr is None else np.asarray(a_cr)
+    r_norm = r if r_norm is None else r_norm
+
+    w_prime = w_vals / w_cr
+    a_prime = a_vals / a_cr
+
+    # Vectorized ubric_term for all impacts and axes
+    ratio = a_prime / w_prime
+    terms = w_prime + (a_prime - w_prime) * _exp(-(ratio))
+
+    ubric = _pow(
+        _pow(terms[:, 0], r_norm) + _pow(terms[:, 1], r_norm) + _pow(terms[:, 2], r_norm),
+        1 / r_norm,
+    )
+    return np.maximum(ubric, 0)
+
+def ubric_params(w_cr=None, a_cr=None, r_norm=None):
+    """
+    Returns the critical values and norm exponent a UBrIC score depends on, with the
+    defaults filled in, as the parameter set of its metrics cache key.
+    """
+    return {
+        "w_cr": [float(v) for v in (w_cr_MPS if w_cr is None else w_cr)],
+        "a_cr": [float(v) for v in (a_cr_MPS if a_cr is None else a_cr)],
+        "r": float(r if r_norm is None else r_norm),
+    }
+
+def calculate_ubric_batch(profiles, time, lengths=None, w_cr=None, a_cr=None, r_norm=None, cache=None):
+    """
+    Computes UBrIC scores for a batch of angular acceleration profiles.
+    Matches calculate_ubric_from_profile applied to each impact exactly.
+
+    Args:
+        profiles (np.ndarray): B x N x 3 array of angular acceleration (x, y, z).
+        time (np.ndarray): Shared time vector (N,) or per-impact times (B, N).
+        lengths (np.ndarray): Number of valid samples per impact (B,). Defaults to N.
+        w_cr (np.ndarray): Critical velocities, defaults to w_cr_MPS.
+        a_cr (np.ndarray): Critical accelerations, defaults to a_cr_MPS.
+        r_norm (float): Norm exponent, defaults to r.
+        cache (MetricsCache): Metrics cache, only the impacts it misses are computed.
+    Returns:
+        ubric_scores (np.ndarray): UBrIC score per impact (B,).
+    """
+    if cache is None:
+        a_vals, w_vals = peak_values_batch(profiles, time, lengths)
+        return ubric_from_peaks(a_vals, w_vals, w_cr, a_cr, r_norm)
+
+    profiles = np.asarray(profiles, dtype=float)
+    time = np.asarray(time, dtype=float)
+    B, N, _ = profiles.shape
+    lengths = np.full(B, N) if lengths is None else np.asarray(lengths, dtype=int)
+    times = time if time.ndim == 2 else np.broadcast_to(time, (B, N))
+
+    # Keyed on the valid samples only, so padding does not change the key
+    params = ubric_params(w_cr, a_cr, r_norm)
+    keys = [
+        metric_key("ubric", acceleration_hash(times[b, :lengths[b]], profiles[b, :lengths[b]]), params)
+        for b in range(B)
+    ]
+    hits = cache.get_many(keys)
+    ubric_scores = np.array([hits.get(key, np.nan) for key in keys])
+
+    missed = np.array([b for b, key in enumerate(keys) if key not in hits], dtype=int)
+    if len(missed):
+        ubric_scores[missed] = calculate_ubric_batch(
+            profiles[missed], time[missed] if time.ndim == 2 else time, lengths[missed], w_cr, a_cr, r_norm
+        )
+        for b in missed:
+            cache.put(keys[b], "ubric", ubric_scores[b])
+    return ubric_scores
+
+def read_impact(path, cache=None):
     """
     Reads a CSV file containing time series data for angular acceleration,
     computes angular velocity, and calculates the UBrIC score.
     Args:
         path (str): Path to the CSV file.
+        cache (MetricsCache): Metrics cache to look the score up in.
     Returns:
         ubric_score (float): Computed UBrIC score.
     """
-    df = pd.read_csv(path)
-    df = df.rename(columns={"Unnamed: 0": "time"})
-    time_col = "time"
-    
-    time = df[time_col].astype(float).to_numpy()
+    # Time in the first column, angular acceleration profile (N x 3)
+    time, profile = read_trajectory(path)
     
     # Calculate sampling frequency, assuming uniform sampling
     freq = 1 / (time[1] - time[0])
-
-    acc_x = df["ang_x"].astype(float).to_numpy()
-    acc_y = df["ang_y"].astype(float).to_numpy()
-    acc_z = df["ang_z"].astype(float).to_numpy()
-    
-    # Reconstruct profile (N x 3) to use the shared function
-    profile = np.column_stack((acc_x, acc_y, acc_z))
     
+    if cache is not None:
+        return cache.get_or_compute("ubric", time, profile, ubric_params(),
+                                    lambda: calculate_ubric_from_profile(profile, time))
     return calculate_ubric_from_profile(profile, time)
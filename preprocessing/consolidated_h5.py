@@ -0,0 +1,412 @@
+"""
+Consolidated HDF5 layout for preprocessed impacts.
+
+Instead of one group with six small datasets per impact, every impact is a row in a few
+large resizable, chunked datasets:
+
+    profiles         (n, 6, 3, cnn_length)  all six permutations, in PERM_NAMES order
+    pred             (n,)                   metadata prediction, NaN if unknown
+    impact_location  (n, 29)                one-hot impact location
+    ubric_score      (n,)                   UBrIC computed from the profile
+    ubric_hitiq      (n,)                   UBrIC from the metadata, NaN if unknown
+    name             (n,)                   impact name (the group name in the per-group layout)
+
+With profile_store="canonical" the six augmented copies are not stored. profiles is replaced by
+
+    raw_profiles     (n, max_length, 3)     raw angular acceleration profile, zero padded
+    length           (n,)                   number of valid samples of each raw profile
+
+and the CNN inputs are generated at load time with augment_batch (see impact_loader), which
+cuts the stored size about 6x.
+
+With profile_store="ragged" the six transformed permutations are stored without their
+padding, concatenated in one ragged array:
+
+    samples          (3, total)             samples shift_and_pad keeps of every permutation
+    offset           (n,)                   start of each impact in samples, permutations in a row
+    length           (n, 6)                 number of samples of each permutation
+    peak_idx         (n, 6)                 peak index of each permutation
+
+The padding only repeats the first and last kept samples, so impact_loader rebuilds the
+CNN inputs with a single gather (augment_batch.pad_ragged), identical to the augmented
+store, and short impacts take a fraction of the space of their padded CNN inputs.
+Rewritten impacts leave their old samples behind until remove or repack_h5 compacts them.
+
+Rows are appended in bulk batches by ConsolidatedWriter. convert_group_layout converts an
+existing per-group file, and repack_h5 rewrites a file of either layout with other storage
+settings (dtype, compression and chunking of the profiles, see h5_storage).
+"""
+
+import itertools
+
+import h5py
+import numpy as np
+from augment_batch import ragged_batch
+from h5_storage import dataset_kwargs, is_filtered
+from link_metadata import IMPACT_LOCATIONS
+
+AXES_LABELS = ["x", "y", "z"]
+PERM_NAMES = [
+    "perm_" + "".join(AXES_LABELS[p] for p in perm)
+    for perm in itertools.permutations([0, 1, 2])
+]
+LAYOUT_NAME = "consolidated"
+PROFILE_STORES = ("augmented", "canonical", "ragged")
+COLUMNS = ["pred", "impact_location", "ubric_score", "ubric_hitiq", "name"]
+
+
+def is_consolidated(hf):
+    """
+    Returns True if an open HDF5 file uses the consolidated layout.
+    """
+    return hf.attrs.get("layout") == LAYOUT_NAME
+
+
+def profile_datasets(hf):
+    """
+    Returns the names of the per-impact profile datasets of a consolidated file.
+    """
+    profile_store = hf.attrs.get("profile_store", "augmented")
+    if profile_store == "canonical":
+        return ["raw_profiles", "length"]
+    if profile_store == "ragged":
+        return ["offset", "length", "peak_idx"]
+    return ["profiles"]
+
+
+def create_consolidated_datasets(hf, cnn_length=2000, chunk_impacts=1, profile_store="augmented", target_idx=None,
+                                 storage=None):
+    """
+    Creates the empty, resizable datasets of the consolidated layout.
+
+    Args:
+        hf (h5py.File): HDF5 file opened for writing.
+        cnn_length (int): Length of each CNN input time series.
+        chunk_impacts (int): Number of impacts per chunk of the profiles dataset.
+        profile_store (str): "augmented" to store all six CNN inputs, "canonical"
+            to store only the raw profile, or "ragged" to store the CNN inputs unpadded.
+        target_idx (int): Index the peak is shifted to, defaults to cnn_length // 2.
+        storage (dict): dtype and filters of the profile datasets (see h5_storage),
+            float64 without filters by default.
+    """
+    if profile_store not in PROFILE_STORES:
+        raise ValueError(f"Unknown profile store '{profile_store}', expected one of {PROFILE_STORES}")
+
+    n_perms = len(PERM_NAMES)
+    hf.attrs["layout"] = LAYOUT_NAME
+    hf.attrs["perm_names"] = PERM_NAMES
+    hf.attrs["profile_store"] = profile_store
+    hf.attrs["cnn_length"] = cnn_length
+    hf.attrs["target_idx"] = cnn_length // 2 if target_idx is None else target_idx
+    hf.attrs["chunk_impacts"] = chunk_impacts
+    profile_kwargs = dataset_kwargs(storage)
+    if profile_store == "canonical":
+        hf.create_dataset(
+            "raw_profiles", shape=(0, cnn_length, 3), maxshape=(None, None, 3),
+            chunks=(chunk_impacts, cnn_length, 3), **profile_kwargs
+        )
+        hf.create_dataset("length", shape=(0,), maxshape=(None,), chunks=(4096,), dtype="i8")
+    elif profile_store == "ragged":
+        hf.create_dataset(
+            "samples", shape=(3, 0), maxshape=(3, None), chunks=(3, chunk_impacts * cnn_length), **profile_kwargs
+        )
+        hf.create_dataset("offset", shape=(0,), maxshape=(None,), chunks=(4096,), dtype="i8")
+        hf.create_dataset("length", shape=(0, n_perms), maxshape=(None, n_perms), chunks=(4096, n_perms), dtype="i4")
+        hf.create_dataset("peak_idx", shape=(0, n_perms), maxshape=(None, n_perms), chunks=(4096, n_perms), dtype="i4")
+    else:
+        hf.create_dataset(
+            "profiles", shape=(0, n_perms, 3, cnn_length), maxshape=(None, n_perms, 3, cnn_length),
+            chunks=(chunk_impacts, n_perms, 3, cnn_length), **profile_kwargs
+        )
+    hf.create_dataset("pred", shape=(0,), maxshape=(None,), chunks=(4096,), dtype="f8")
+    hf.create_dataset(
+        "impact_location", shape=(0, len(IMPACT_LOCATIONS)), maxshape=(None, len(IMPACT_LOCATIONS)),
+        chunks=(4096, len(IMPACT_LOCATIONS)), dtype="i1"
+    )
+    hf.create_dataset("ubric_score", shape=(0,), maxshape=(None,), chunks=(4096,), dtype="f8")
+    hf.create_dataset("ubric_hitiq", shape=(0,), maxshape=(None,), chunks=(4096,), dtype="f8")
+    hf.create_dataset("name", shape=(0,), maxshape=(None,), chunks=(4096,), dtype=h5py.string_dtype())
+
+
+def _to_float(value):
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return np.nan
+
+
+class ConsolidatedWriter:
+    """
+    Buffers prepared impacts and appends them to the consolidated datasets in batches.
+    Impacts whose name is already in the file overwrite their existing row.
+
+    Impacts are dicts with a group_name, attrs (pred, impact_location, ubric_score and
+    optionally ubric_hitiq), datasets keyed by PERM_NAMES and the raw profile, as produced
+    by prepare_impact. profile_store=None keeps the store of an existing file and
+    creates new files with the augmented store. chunk_impacts and storage only apply to
+    new files, existing files keep theirs (rewrite them with repack_h5).
+    """
+
+    def __init__(self, hf, batch_size=256, cnn_length=2000, chunk_impacts=1, profile_store=None, storage=None):
+        self.hf = hf
+        self.batch_size = batch_size
+        if not is_consolidated(hf):
+            if len(hf) > 0:
+                raise ValueError(f"{hf.filename} already uses the per-group layout, convert it with convert_group_layout first")
+            create_consolidated_datasets(hf, cnn_length, chunk_impacts, profile_store or "augmented", storage=storage)
+        self.profile_store = hf.attrs.get("profile_store", "augmented")
+        if profile_store is not None and profile_store != self.profile_store:
+            raise ValueError(f"{hf.filename} stores {self.profile_store} profiles, not {profile_store}")
+        self.rows = {name.decode() if isinstance(name, bytes) else name: i for i, name in enumerate(hf["name"][:])}
+        self.buffer = []
+
+    def add(self, impact):
+        self.buffer.append(impact)
+        if len(self.buffer) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        if not self.buffer:
+            return
+
+        # Later duplicates in the batch win, as with rewriting a group
+        batch = {}
+        for impact in self.buffer:
+            batch[impact["group_name"]] = impact
+        self.buffer = []
+
+        names = list(batch)
+        if self.profile_store == "canonical":
+            columns = self._canonical_columns([batch[name]["profile"] for name in names])
+        elif self.profile_store == "ragged":
+            columns = self._ragged_columns([batch[name]["profile"] for name in names])
+        else:
+            columns = {"profiles": np.stack([
+                np.concatenate([batch[name]["datasets"][perm] for perm in PERM_NAMES], axis=0)
+                for name in names
+            ])}
+        columns.update({
+            "pred": np.array([_to_float(batch[name]["attrs"].get("pred")) for name in names]),
+            "impact_location": np.stack([batch[name]["attrs"]["impact_location"] for name in names]),
+            "ubric_score": np.array([_to_float(batch[name]["attrs"].get("ubric_score")) for name in names]),
+            "ubric_hitiq": np.array([_to_float(batch[name]["attrs"].get("ubric_hitiq")) for name in names]),
+            "name": np.array(names, dtype=object),
+        })
+
+        existing = [i for i, name in enumerate(names) if name in self.rows]
+        new = [i for i, name in enumerate(names) if name not in self.rows]
+
+        for i in existing:
+            row = self.rows[names[i]]
+            for key, values in columns.items():
+                self.hf[key][row] = values[i]
+
+        if new:
+            start = self.hf["name"].shape[0]
+            end = start + len(new)
+            for key, values in columns.items():
+                self.hf[key].resize(end, axis=0)
+                self.hf[key][start:end] = values[new]
+            for offset, i in enumerate(new):
+                self.rows[names[i]] = start + offset
+
+    def _canonical_columns(self, profiles):
+        # Widen the raw profile dataset if this batch holds a longer impact
+        lengths = np.array([len(profile) for profile in profiles])
+        raw = self.hf["raw_profiles"]
+        if lengths.max() > raw.shape[1]:
+            raw.resize(lengths.max(), axis=1)
+
+        raw_profiles = np.zeros((len(profiles), raw.shape[1], 3))
+        for i, profile in enumerate(profiles):
+            raw_profiles[i, :len(profile)] = profile
+        return {"raw_profiles": raw_profiles, "length": lengths}
+
+    def _ragged_columns(self, profiles):
+        # Append the unpadded samples of the batch; rows point to them by offset
+        lengths = np.array([len(profile) for profile in profiles])
+        padded = np.zeros((len(profiles), lengths.max(), 3))
+        for i, profile in enumerate(profiles):
+            padded[i, :len(profile)] = profile
+        samples, kept, peak_idx = ragged_batch(
+            padded, int(self.hf.attrs["target_idx"]), int(self.hf.attrs["cnn_length"]), lengths
+        )
+
+        dataset = self.hf["samples"]
+        start = dataset.shape[1]
+        dataset.resize(start + samples.shape[1], axis=1)
+        dataset[:, start:] = samples
+        sizes = kept.sum(axis=1)
+        offsets = start + np.cumsum(sizes) - sizes
+        return {"offset": offsets, "length": kept, "peak_idx": peak_idx}
+
+    def remove(self, names):
+        """
+        Removes impacts by name and compacts the datasets, moving the remaining rows
+        forward in batches so the file never holds two copies of the profiles.
+        """
+        self.flush()
+        remove = {name for name in names if name in self.rows}
+        if not remove:
+            return
+
+        n = self.hf["name"].shape[0]
+        keep = np.ones(n, dtype=bool)
+        keep[[self.rows[name] for name in remove]] = False
+        kept_rows = np.flatnonzero(keep)
+        first_removed = int(np.argmin(keep))
+
+        keys = profile_datasets(self.hf) + COLUMNS
+        for start in range(first_removed, len(kept_rows), self.batch_size):
+            src = kept_rows[start:start + self.batch_size]
+            for key in keys:
+                self.hf[key][start:start + len(src)] = self.hf[key][src]
+        for key in keys:
+            self.hf[key].resize(len(kept_rows), axis=0)
+        if self.profile_store == "ragged":
+            self._compact_samples()
+
+        self.rows = {name.decode() if isinstance(name, bytes) else name: i for i, name in enumerate(self.hf["name"][:])}
+
+    def _compact_samples(self):
+        # Move the samples of every row forward over those of removed or rewritten impacts.
+        # Going by increasing offset, every block moves towards the start, so the blocks
+        # still to be moved are never overwritten
+        samples = self.hf["samples"]
+        offsets = self.hf["offset"][:]
+        sizes = self.hf["length"][:].sum(axis=1)
+        new_offsets = np.empty_like(offsets)
+        end = 0
+        for row in np.argsort(offsets, kind="stable"):
+            if offsets[row] != end:
+                samples[:, end:end + sizes[row]] = samples[:, offsets[row]:offsets[row] + sizes[row]]
+            new_offsets[row] = end
+            end += sizes[row]
+        samples.resize(end, axis=1)
+        self.hf["offset"][:] = new_offsets
+
+    def close(self):
+        self.flush()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+
+def read_group_impact(group):
+    """
+    Reads one impact from the per-group layout into the dict format used by ConsolidatedWriter.
+    """
+    return {
+        "group_name": group.name.lstrip("/"),
+        "attrs": dict(group.attrs),
+        "datasets": {perm: group[perm][()] for perm in PERM_NAMES},
+    }
+
+
+def convert_group_layout(src_path, dst_path, batch_size=256, chunk_impacts=1, storage=None):
+    """
+    Converts an HDF5 file in the per-group layout (one group with six perm_* datasets
+    per impact) to the consolidated layout.
+
+    Args:
+        src_path (str): Path to the per-group HDF5 file.
+        dst_path (str): Path to the consolidated HDF5 file to write.
+        batch_size (int): Number of impacts appended per batch.
+        chunk_impacts (int): Number of impacts per chunk of the profiles dataset.
+        storage (dict): dtype and filters of the profiles (see h5_storage).
+
+    Returns:
+        int: Number of converted impacts.
+    """
+    count = 0
+    with h5py.File(src_path, "r") as src, h5py.File(dst_path, "w") as dst:
+        group_names = [name for name in src if isinstance(src[name], h5py.Group)]
+        if not group_names:
+            return 0
+        cnn_length = src[group_names[0]][PERM_NAMES[0]].shape[-1]
+        with ConsolidatedWriter(dst, batch_size, cnn_length, chunk_impacts, storage=storage) as writer:
+            for name in group_names:
+                writer.add(read_group_impact(src[name]))
+                count += 1
+    return count
+
+
+def repack_h5(src_path, dst_path, storage=None, chunk_impacts=1, batch_size=256):
+    """
+    Rewrites an impact HDF5 file in the same layout with other storage settings.
+
+    Args:
+        src_path (str): Path to the HDF5 file, in either layout.
+        dst_path (str): Path to the HDF5 file to write.
+        storage (dict): dtype and filters of the profiles (see h5_storage).
+        chunk_impacts (int): Number of impacts per chunk of the consolidated profiles.
+        batch_size (int): Number of impacts copied per batch.
+
+    Returns:
+        int: Number of copied impacts.
+    """
+    with h5py.File(src_path, "r") as src, h5py.File(dst_path, "w") as dst:
+        if not is_consolidated(src):
+            kwargs = dataset_kwargs(storage)
+            for name, group in src.items():
+                out = dst.create_group(name)
+                for key, value in group.attrs.items():
+                    out.attrs[key] = value
+                for dataset_name, dataset in group.items():
+                    chunks = dataset.shape if storage is not None and is_filtered(storage) else None
+                    out.create_dataset(dataset_name, data=dataset[()], chunks=chunks, **kwargs)
+            return len(src)
+
+        profile_store = src.attrs.get("profile_store", "augmented")
+        create_consolidated_datasets(
+            dst, int(src.attrs["cnn_length"]), chunk_impacts, profile_store, int(src.attrs["target_idx"]), storage
+        )
+        n = len(src["name"])
+        keys = profile_datasets(src) + COLUMNS
+        if profile_store == "canonical":
+            dst["raw_profiles"].resize(src["raw_profiles"].shape[1], axis=1)
+        for key in keys:
+            dst[key].resize(n, axis=0)
+        for start in range(0, n, batch_size):
+            end = min(start + batch_size, n)
+            for key in keys:
+                dst[key][start:end] = src[key][start:end]
+        if profile_store == "ragged":
+            # Copy the samples of the rows only, in row order, dropping those of rewritten impacts
+            offsets = src["offset"][:]
+            sizes = src["length"][:].sum(axis=1)
+            dst["samples"].resize(int(sizes.sum()), axis=1)
+            dst["offset"][:] = np.cumsum(sizes) - sizes
+            position = 0
+            for start in range(0, n, batch_size):
+                rows = range(start, min(start + batch_size, n))
+                block = np.concatenate([src["samples"][:, offsets[row]:offsets[row] + sizes[row]] for row in rows], axis=1)
+                dst["samples"][:, position:position + block.shape[1]] = block
+                position += block.shape[1]
+        return n
+
+
+if __name__ == "__main__":
+    import argparse
+
+    from h5_storage import add_storage_arguments, storage_from_args
+
+    parser = argparse.ArgumentParser(description="Convert a per-group impact HDF5 file to the consolidated layout")
+    parser.add_argument("src_h5", type=str)
+    parser.add_argument("dst_h5", type=str)
+    parser.add_argument("--batch_size", type=int, default=256)
+    parser.add_argument("--repack", action="store_true", help="Keep the layout and only change the storage settings")
+    add_storage_arguments(parser)
+
+    args = parser.parse_args()
+
+    storage = storage_from_args(args)
+    if args.repack:
+        count = repack_h5(args.src_h5, args.dst_h5, storage, args.chunk_impacts, args.batch_size)
+        print(f"Repacked {count} impacts from {args.src_h5} to {args.dst_h5}")
+    else:
+        count = convert_group_layout(args.src_h5, args.dst_h5, args.batch_size, args.chunk_impacts, storage)
+        print(f"Converted {count} impacts from {args.src_h5} to {args.dst_h5}")
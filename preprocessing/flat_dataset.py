@@ -0,0 +1,240 @@
+"""
+Flat, memory-mapped training dataset.
+
+export_flat_dataset writes the CNN inputs of any preprocessed HDF5 files (per-group or
+consolidated layout) into one contiguous float32 .npy file of shape (n, 1, 3, cnn_length),
+the input shape of build_brain_strain_cnn, with one row per impact permutation, and a
+sidecar CSV holding the source file, impact name, permutation and labels of every row.
+
+FlatDataset memory-maps the .npy file, which is shared through the page cache by every
+process training on the same file. Training batches gather random rows, read in file
+order; unshuffled batches, e.g. for evaluation, are zero-copy views of the mapped file:
+
+    dataset = FlatDataset("data/flat/train", batch_size=192, seed=0)
+    model.fit(dataset.generator(), steps_per_epoch=len(dataset), epochs=10)
+"""
+
+import math
+import os
+
+import h5py
+import numpy as np
+import pandas as pd
+from consolidated_h5 import PERM_NAMES, is_consolidated
+from impact_loader import load_consolidated_rows, load_group_impacts
+from link_metadata import IMPACT_LOCATIONS
+
+
+def flat_paths(prefix):
+    """
+    Returns the paths of the input array and sidecar table of a flat dataset.
+    """
+    return f"{prefix}.npy", f"{prefix}.csv"
+
+
+def _location_names(encoded):
+    """
+    Returns the location name of every row of one-hot encoded impact locations (n, L).
+    Rows without a set element, written by one_hot_encode for a location it does not
+    know, are "Unknown" rather than the first location argmax would pick.
+    """
+    encoded = np.atleast_2d(encoded)
+    names = np.asarray(IMPACT_LOCATIONS, dtype=object)[np.argmax(encoded, axis=1)]
+    names[~encoded.any(axis=1)] = "Unknown"
+    return names
+
+
+def _impact_table(hf):
+    """
+    Returns the name and labels of every impact of an HDF5 file, in file order.
+    """
+    if is_consolidated(hf):
+        table = pd.DataFrame({
+            "name": [n.decode() if isinstance(n, bytes) else n for n in hf["name"][:]],
+            "pred": hf["pred"][:],
+            "ubric_score": hf["ubric_score"][:],
+            "ubric_hitiq": hf["ubric_hitiq"][:],
+            "impact_location": _location_names(hf["impact_location"][:]),
+        })
+        return table
+
+    rows = []
+    for name in sorted(name for name in hf if isinstance(hf[name], h5py.Group)):
+        attrs = hf[name].attrs
+        row = {"name": name}
+        for key in ["pred", "ubric_score", "ubric_hitiq"]:
+            try:
+                row[key] = float(attrs[key])
+            except (KeyError, TypeError, ValueError):
+                row[key] = np.nan
+        row["impact_location"] = _location_names(attrs["impact_location"])[0] if "impact_location" in attrs else None
+        rows.append(row)
+    return pd.DataFrame(rows, columns=["name", "pred", "ubric_score", "ubric_hitiq", "impact_location"])
+
+
+def export_flat_dataset(h5_paths, prefix, chunk_impacts=256):
+    """
+    Exports the CNN inputs of preprocessed HDF5 files to a flat float32 dataset.
+
+    Args:
+        h5_paths (list): Paths to preprocessed HDF5 files, in either layout.
+        prefix (str): Output path without extension; writes prefix.npy and prefix.csv.
+        chunk_impacts (int): Number of impacts read and written at a time.
+
+    Returns:
+        int: Number of rows (impact permutations) written.
+    """
+    n_perms = len(PERM_NAMES)
+    tables = []
+    cnn_length = None
+    for path in h5_paths:
+        with h5py.File(path, "r") as hf:
+            table = _impact_table(hf)
+            if len(table) == 0:
+                tables.append(table)
+                continue
+            if is_consolidated(hf):
+                length = hf.attrs.get("cnn_length", hf["profiles"].shape[-1] if "profiles" in hf else None)
+            else:
+                length = hf[table["name"].iloc[0]][PERM_NAMES[0]].shape[-1]
+        if cnn_length is not None and int(length) != cnn_length:
+            raise ValueError(f"{path} has CNN inputs of length {length}, expected {cnn_length}")
+        cnn_length = int(length)
+        tables.append(table)
+
+    n_rows = n_perms * sum(len(table) for table in tables)
+    if cnn_length is None:
+        raise ValueError(f"No impacts found in {h5_paths}")
+
+    data_path, table_path = flat_paths(prefix)
+    os.makedirs(os.path.dirname(os.path.abspath(data_path)), exist_ok=True)
+    tmp_data_path = f"{data_path}.{os.getpid()}.tmp.npy"
+    x = np.lib.format.open_memmap(tmp_data_path, mode="w+", dtype=np.float32, shape=(n_rows, 1, 3, cnn_length))
+
+    row = 0
+    for path, table in zip(h5_paths, tables):
+        with h5py.File(path, "r") as hf:
+            consolidated = is_consolidated(hf)
+            for start in range(0, len(table), chunk_impacts):
+                stop = min(start + chunk_impacts, len(table))
+                if consolidated:
+                    chunk, _ = load_consolidated_rows(hf, np.arange(start, stop), dtype=np.float32)
+                else:
+                    chunk, _ = load_group_impacts(hf, list(table["name"].iloc[start:stop]), dtype=np.float32)
+                x[row:row + len(chunk)] = chunk
+                row += len(chunk)
+    x.flush()
+    del x
+
+    sidecar = pd.concat([
+        table.loc[table.index.repeat(n_perms)].assign(source=path, perm=PERM_NAMES * len(table))
+        for path, table in zip(h5_paths, tables)
+    ], ignore_index=True)
+    sidecar = sidecar[["source", "name", "perm", "pred", "ubric_score", "ubric_hitiq", "impact_location"]]
+
+    tmp_table_path = f"{table_path}.{os.getpid()}.tmp"
+    sidecar.to_csv(tmp_table_path, index=False)
+    os.replace(tmp_data_path, data_path)
+    os.replace(tmp_table_path, table_path)
+    return n_rows
+
+
+class FlatDataset:
+    """
+    Memory-mapped flat dataset.
+
+    With shuffle=True, every epoch draws a new permutation of the rows, and each batch
+    gathers its rows from the mapped file in sorted order, so reads move forward through
+    the file. The export keeps the six permutations of an impact and the impacts of a file
+    in adjacent rows, so shuffling whole batches would keep them together every epoch.
+
+    With shuffle="batches", the batches are contiguous row ranges in a shuffled order,
+    returned as views of the mapped file without copying, and with shuffle=False they
+    are the same ranges in file order, e.g. for evaluation.
+
+    With rows, only those rows are used, e.g. the training rows of a cross-validation
+    fold. Unshuffled batches of rows that are contiguous in the file are still views;
+    other batches are gathered from the mapped file.
+
+    Args:
+        prefix (str): Path of the dataset without extension, as passed to export_flat_dataset.
+        batch_size (int): Number of rows per batch.
+        label (str): Sidecar column used as the target.
+        shuffle (bool or str): True to shuffle the rows every epoch, "batches" to only
+            shuffle the order of the contiguous batches, False to keep the file order.
+        seed (int): Seed of the shuffle.
+        rows (np.ndarray): Indices of the rows to use, all rows by default.
+    """
+
+    def __init__(self, prefix, batch_size=192, label="ubric_score", shuffle=True, seed=None, rows=None):
+        data_path, table_path = flat_paths(prefix)
+        self.x = np.load(data_path, mmap_mode="r")
+        self.table = pd.read_csv(table_path)
+        if len(self.table) != len(self.x):
+            raise ValueError(f"{table_path} has {len(self.table)} rows, expected {len(self.x)}")
+        self.y = self.table[label].to_numpy(dtype=np.float32)
+        self.rows = None if rows is None else np.sort(np.asarray(rows, dtype=np.int64))
+        self.n_rows = len(self.x) if self.rows is None else len(self.rows)
+        if shuffle not in (True, False, "batches"):
+            print(f"Unknown shuffle mode {shuffle!r}, expected True, False or 'batches'")
+            raise ValueError(f"Unknown shuffle mode {shuffle!r}")
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.rng = np.random.default_rng(seed)
+        self.order = np.arange(len(self))
+        self.row_order = None
+        self.on_epoch_end()
+
+    def __len__(self):
+        return math.ceil(self.n_rows / self.batch_size)
+
+    def __getitem__(self, i):
+        if not 0 <= i < len(self):
+            raise IndexError(f"Batch {i} out of range for {len(self)} batches")
+        if self.row_order is not None:
+            rows = np.sort(self.row_order[i * self.batch_size:(i + 1) * self.batch_size])
+            if self.rows is not None:
+                rows = self.rows[rows]
+            return self.x[rows], self.y[rows]
+
+        start = self.order[i] * self.batch_size
+        stop = start + self.batch_size
+        if self.rows is None:
+            return self.x[start:stop], self.y[start:stop]
+        rows = self.rows[start:stop]
+        if rows[-1] - rows[0] + 1 == len(rows):
+            return self.x[rows[0]:rows[-1] + 1], self.y[rows[0]:rows[-1] + 1]
+        return self.x[rows], self.y[rows]
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    def on_epoch_end(self):
+        if self.shuffle == "batches":
+            self.rng.shuffle(self.order)
+        elif self.shuffle:
+            self.row_order = self.rng.permutation(self.n_rows)
+
+    def generator(self):
+        """
+        Yields batches indefinitely, reshuffling after every epoch, for model.fit
+        with steps_per_epoch=len(dataset).
+        """
+        while True:
+            yield from self
+            self.on_epoch_end()
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Export preprocessed HDF5 files to a flat memory-mapped dataset")
+    parser.add_argument("prefix", type=str, help="Output path without extension")
+    parser.add_argument("h5_paths", type=str, nargs="+")
+    parser.add_argument("--chunk_impacts", type=int, default=256)
+
+    args = parser.parse_args()
+
+    n_rows = export_flat_dataset(args.h5_paths, args.prefix, args.chunk_impacts)
+    print(f"Wrote {n_rows} rows to {flat_paths(args.prefix)[0]}")
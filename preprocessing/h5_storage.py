@@ -0,0 +1,100 @@
+"""
+Storage settings of the preprocessed profile datasets in the HDF5 outputs.
+
+Profiles are written as float64 without filters by default. The model trains in float32,
+so float32 storage halves the files without changing the training inputs, and float16
+quarters them at about three significant digits. Canonical raw profiles stored as
+float16 can move the peak that shift_and_pad centers on by a sample. The shifted and
+padded CNN inputs end in long runs of the edge values, which the gzip and lzf filters
+compress well, especially after the byte shuffle filter groups the bytes of neighbouring
+values.
+
+Chunks of the consolidated layout hold chunk_impacts impacts. Keep it at 1 for shuffled
+batches of single rows (impact_loader) and set it to a divisor of the shard size for
+contiguous shard reads (CNN/input_pipeline.py), so every read decompresses only what it
+returns. benchmarks/storage_report.py measures the size and read throughput of each setting.
+"""
+
+import numpy as np
+
+STORAGE_DTYPES = ("float64", "float32", "float16")
+COMPRESSIONS = ("none", "gzip", "lzf")
+
+
+def storage_options(dtype="float64", compression="none", compression_level=4, shuffle=False):
+    """
+    Validates and collects the storage settings of the profile datasets.
+
+    Args:
+        dtype (str): One of STORAGE_DTYPES.
+        compression (str): One of COMPRESSIONS.
+        compression_level (int): gzip level from 0 to 9, ignored by lzf.
+        shuffle (bool): Apply the byte shuffle filter before compression.
+
+    Returns:
+        dict: The settings, for dataset_kwargs.
+    """
+    if dtype not in STORAGE_DTYPES:
+        raise ValueError(f"Unknown storage dtype '{dtype}', expected one of {STORAGE_DTYPES}")
+    if compression not in COMPRESSIONS:
+        raise ValueError(f"Unknown compression '{compression}', expected one of {COMPRESSIONS}")
+    if compression == "gzip" and not 0 <= compression_level <= 9:
+        raise ValueError(f"gzip compression level must be between 0 and 9, got {compression_level}")
+    return {"dtype": dtype, "compression": compression, "compression_level": compression_level, "shuffle": shuffle}
+
+
+DEFAULT_STORAGE = storage_options()
+
+
+def is_filtered(storage):
+    """
+    Returns True if the settings apply an HDF5 filter, which needs a chunked dataset.
+    """
+    return storage["compression"] != "none" or storage["shuffle"]
+
+
+def dataset_kwargs(storage=None):
+    """
+    Returns the create_dataset keyword arguments (dtype and filters) of the storage settings.
+    """
+    storage = DEFAULT_STORAGE if storage is None else storage
+    kwargs = {"dtype": np.dtype(storage["dtype"])}
+    if storage["compression"] != "none":
+        kwargs["compression"] = storage["compression"]
+        if storage["compression"] == "gzip":
+            kwargs["compression_opts"] = storage["compression_level"]
+    if storage["shuffle"]:
+        kwargs["shuffle"] = True
+    return kwargs
+
+
+def describe_storage(storage):
+    """
+    Returns a short name of the storage settings, such as "float32-gzip4-shuffle".
+    """
+    name = storage["dtype"]
+    if storage["compression"] == "gzip":
+        name += f"-gzip{storage['compression_level']}"
+    elif storage["compression"] == "lzf":
+        name += "-lzf"
+    if storage["shuffle"]:
+        name += "-shuffle"
+    return name
+
+
+def add_storage_arguments(parser):
+    """
+    Adds the storage options to an argparse parser.
+    """
+    parser.add_argument("--dtype", type=str, default="float64", choices=STORAGE_DTYPES, help="dtype of the stored profiles")
+    parser.add_argument("--compression", type=str, default="none", choices=COMPRESSIONS)
+    parser.add_argument("--compression_level", type=int, default=4, help="gzip level from 0 to 9")
+    parser.add_argument("--shuffle_filter", action="store_true", help="Apply the byte shuffle filter before compression")
+    parser.add_argument("--chunk_impacts", type=int, default=1, help="Impacts per chunk of the consolidated profiles")
+
+
+def storage_from_args(args):
+    """
+    Returns the storage settings of options added by add_storage_arguments.
+    """
+    return storage_options(args.dtype, args.compression, args.compression_level, args.shuffle_filter)
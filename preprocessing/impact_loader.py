@@ -0,0 +1,199 @@
+"""
+Batch loader for consolidated impact files (see consolidated_h5).
+
+Files with profile_store="canonical" only hold the raw profile of each impact. The six
+permuted, conjugated and shifted CNN inputs are generated per batch with augment_batch,
+which matches conjugate_vrot_transform followed by shift_and_pad bit for bit, so the
+model sees exactly the inputs the augmented store would have given it. Files with the
+ragged store hold the transformed permutations without their padding; each batch is read
+as a few contiguous runs of samples and padded with one gather (augment_batch.pad_ragged),
+again matching the augmented store bit for bit. Files with the augmented store are read
+as is.
+
+Batches are (x, y) with x of shape (6 * impacts, 1, 3, cnn_length), the input shape of
+build_brain_strain_cnn, and y the impact label repeated for each permutation:
+
+    loader = ImpactLoader(["data/Team/Team_training.h5"], batch_size=32, seed=0)
+    model.fit(loader.generator(), steps_per_epoch=len(loader), epochs=10)
+"""
+
+import math
+
+import h5py
+import numpy as np
+from augment_batch import augment_batch, pad_ragged
+from consolidated_h5 import PERM_NAMES, is_consolidated
+
+
+def read_ragged_samples(hf, rows):
+    """
+    Reads the ragged samples of some rows of a file with the ragged store, one read per
+    run of rows whose samples are adjacent.
+
+    Args:
+        hf (h5py.File): Open consolidated HDF5 file with profile_store="ragged".
+        rows (np.ndarray): Sorted row indices.
+
+    Returns:
+        tuple: 3 x total samples of the rows, in row order, their offsets into them and
+            the lengths (rows x 6) and peak indices (rows x 6) of their permutations.
+    """
+    offsets = hf["offset"][rows]
+    lengths = hf["length"][rows]
+    peak_idx = hf["peak_idx"][rows]
+    sizes = lengths.sum(axis=1)
+    ends = offsets + sizes
+
+    # A new run starts wherever a row's samples do not follow the previous row's
+    run_starts = np.flatnonzero(np.r_[True, offsets[1:] != ends[:-1]])
+    run_ends = np.r_[run_starts[1:], len(rows)]
+    samples = np.concatenate([
+        hf["samples"][:, offsets[first]:ends[last - 1]] for first, last in zip(run_starts, run_ends)
+    ], axis=1) if len(rows) else np.empty((3, 0), dtype=hf["samples"].dtype)
+    return samples, np.cumsum(sizes) - sizes, lengths, peak_idx
+
+
+def load_consolidated_rows(hf, rows, label="ubric_score", dtype=np.float64):
+    """
+    Loads the CNN inputs and labels of some impacts of a consolidated file, augmenting
+    canonical profiles and padding ragged ones on the fly.
+
+    Args:
+        hf (h5py.File): Open consolidated HDF5 file.
+        rows (np.ndarray): Row indices of the impacts.
+        label (str): Per-impact dataset used as the target.
+        dtype (np.dtype): dtype of the returned inputs.
+
+    Returns:
+        tuple: (6 * len(rows)) x 1 x 3 x cnn_length inputs, permutations of an impact
+            in PERM_NAMES order, and the labels repeated for each permutation.
+    """
+    # h5py reads rows in increasing order only
+    rows = np.sort(rows)
+    n_perms = len(PERM_NAMES)
+
+    if hf.attrs.get("profile_store", "augmented") == "canonical":
+        lengths = hf["length"][rows]
+        # Reduced precision profiles are augmented in float64, like freshly read ones
+        profiles = hf["raw_profiles"][rows, :lengths.max()].astype(np.float64, copy=False)
+        cnn_length = int(hf.attrs["cnn_length"])
+        x = augment_batch(profiles, int(hf.attrs["target_idx"]), cnn_length, lengths)
+    elif hf.attrs.get("profile_store") == "ragged":
+        samples, offsets, lengths, peak_idx = read_ragged_samples(hf, rows)
+        cnn_length = int(hf.attrs["cnn_length"])
+        # Cast the few stored samples rather than the padded batch
+        samples = samples.astype(dtype, copy=False)
+        x = pad_ragged(samples, offsets, lengths, peak_idx, int(hf.attrs["target_idx"]), cnn_length)
+    else:
+        x = hf["profiles"][rows]
+        cnn_length = x.shape[-1]
+
+    x = x.reshape(len(rows) * n_perms, 1, 3, cnn_length).astype(dtype, copy=False)
+    y = np.repeat(hf[label][rows], n_perms, axis=0)
+    return x, y
+
+
+def load_group_impacts(hf, names, label="ubric_score", dtype=np.float64):
+    """
+    Loads the CNN inputs and labels of some impacts of a per-group file.
+
+    Args:
+        hf (h5py.File): Open HDF5 file with one group of perm_* datasets per impact.
+        names (list): Group names of the impacts.
+        label (str): Group attribute used as the target.
+        dtype (np.dtype): dtype of the returned inputs.
+
+    Returns:
+        tuple: (6 * len(names)) x 1 x 3 x cnn_length inputs, permutations of an impact
+            in PERM_NAMES order, and the labels repeated for each permutation.
+    """
+    x = np.stack([hf[name][perm][()] for name in names for perm in PERM_NAMES]).astype(dtype, copy=False)
+    y = np.repeat([float(hf[name].attrs[label]) for name in names], len(PERM_NAMES))
+    return x, y
+
+
+class ImpactLoader:
+    """
+    Loads batches of CNN inputs and labels from one or more consolidated HDF5 files.
+
+    Args:
+        h5_paths (list): Paths to consolidated HDF5 files.
+        batch_size (int): Number of impacts per batch, each giving six CNN inputs.
+        label (str): Per-impact dataset used as the target, e.g. "ubric_score" or "pred".
+        shuffle (bool): Shuffle the impacts every epoch.
+        seed (int): Seed of the shuffle.
+        dtype (np.dtype): dtype of the returned inputs. float64 matches the stored
+            inputs exactly.
+    """
+
+    def __init__(self, h5_paths, batch_size=32, label="ubric_score", shuffle=True, seed=None, dtype=np.float64):
+        self.batch_size = batch_size
+        self.label = label
+        self.shuffle = shuffle
+        self.dtype = dtype
+        self.rng = np.random.default_rng(seed)
+
+        self.files = []
+        for h5_path in h5_paths:
+            hf = h5py.File(h5_path, "r")
+            if not is_consolidated(hf):
+                hf.close()
+                self.close()
+                raise ValueError(f"{h5_path} is not in the consolidated layout, convert it with convert_group_layout first")
+            self.files.append(hf)
+
+        # (file index, row) of every impact
+        self.index = np.concatenate([
+            np.stack([np.full(len(hf["name"]), i), np.arange(len(hf["name"]))], axis=1)
+            for i, hf in enumerate(self.files)
+        ]) if self.files else np.empty((0, 2), dtype=int)
+        self.order = np.arange(len(self.index))
+        self.on_epoch_end()
+
+    def __len__(self):
+        return math.ceil(len(self.index) / self.batch_size)
+
+    def __getitem__(self, i):
+        if not 0 <= i < len(self):
+            raise IndexError(f"Batch {i} out of range for {len(self)} batches")
+        batch = self.index[self.order[i * self.batch_size:(i + 1) * self.batch_size]]
+
+        xs = []
+        ys = []
+        for file_idx in np.unique(batch[:, 0]):
+            rows = batch[batch[:, 0] == file_idx, 1]
+            x, y = self.load_rows(self.files[file_idx], rows)
+            xs.append(x)
+            ys.append(y)
+        return np.concatenate(xs), np.concatenate(ys)
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    def on_epoch_end(self):
+        if self.shuffle:
+            self.rng.shuffle(self.order)
+
+    def generator(self):
+        """
+        Yields batches indefinitely, reshuffling after every epoch, for model.fit
+        with steps_per_epoch=len(loader).
+        """
+        while True:
+            yield from self
+            self.on_epoch_end()
+
+    def load_rows(self, hf, rows):
+        return load_consolidated_rows(hf, rows, self.label, self.dtype)
+
+    def close(self):
+        for hf in self.files:
+            hf.close()
+        self.files = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
@@ -0,0 +1,198 @@
+"""
+Lightweight run instrumentation: per-stage timers, per-team and per-session counters,
+failures and optional cProfile capture of a single impact, written as a JSON run report.
+
+A disabled Instrumentation (the NULL instance) hands out one shared no-op context manager
+and returns immediately from every other call, so instrumented code costs next to nothing
+when no report is requested.
+"""
+
+import cProfile
+import io
+import json
+import os
+import pstats
+import threading
+import time
+import traceback
+from contextlib import nullcontext
+from datetime import datetime, timezone
+
+_NO_OP = nullcontext()
+
+
+class _StageTimer:
+    __slots__ = ("instrumentation", "name", "start")
+
+    def __init__(self, instrumentation, name):
+        self.instrumentation = instrumentation
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.instrumentation.add_time(self.name, time.perf_counter() - self.start)
+        return False
+
+
+class Instrumentation:
+    """
+    Collects stage timings, counters and failures of a run.
+
+    Args:
+        enabled (bool): Record anything at all.
+        profile_target (str): Impact name or trajectory path whose processing is captured
+            with cProfile, see profile.
+    """
+
+    def __init__(self, enabled=True, profile_target=None):
+        self.enabled = enabled
+        self.profile_target = profile_target
+        self.stages = {}
+        self.counters = {}
+        self.failures = []
+        self.profile_stats = None
+        self.started = datetime.now(timezone.utc).isoformat()
+        self.start = time.perf_counter()
+        self.lock = threading.Lock()
+
+    def stage(self, name):
+        """
+        Returns a context manager adding the time spent in it to stage name. Safe to use
+        from several threads, whose times add up, so stage shares can exceed 100%.
+        """
+        if not self.enabled:
+            return _NO_OP
+        return _StageTimer(self, name)
+
+    def add_time(self, name, seconds, calls=1):
+        """
+        Adds seconds over calls to stage name, e.g. as timed in a worker process.
+        """
+        if not self.enabled:
+            return
+        with self.lock:
+            stage = self.stages.get(name)
+            if stage is None:
+                self.stages[name] = [seconds, calls]
+            else:
+                stage[0] += seconds
+                stage[1] += calls
+
+    def merge(self, stages, profile_stats=None):
+        """
+        Adds the stages and profile of another Instrumentation, e.g. one returned by a
+        worker process.
+        """
+        for name, (seconds, calls) in stages.items():
+            self.add_time(name, seconds, calls)
+        if self.enabled and profile_stats is not None and self.profile_stats is None:
+            self.profile_stats = profile_stats
+
+    def count(self, team, session, key, n=1):
+        """
+        Adds n to counter key of a team's session.
+        """
+        if not self.enabled:
+            return
+        counters = self.counters.setdefault(team, {}).setdefault(session, {})
+        counters[key] = counters.get(key, 0) + n
+
+    def failure(self, filepath, error):
+        """
+        Records a failed impact with its error and traceback. An error raised in a worker
+        process includes the traceback from the worker.
+        """
+        if not self.enabled:
+            return
+        trace = "".join(traceback.format_exception(type(error), error, error.__traceback__))
+        self.failures.append({"file": filepath, "error": repr(error), "traceback": trace})
+
+    def is_profile_target(self, filepath):
+        """
+        Returns whether the impact in filepath is the profile target, given as the path,
+        file name or impact name (file name without extension), and none was captured yet.
+        """
+        if not self.enabled or self.profile_target is None or self.profile_stats is not None:
+            return False
+        base_name = os.path.basename(filepath)
+        return self.profile_target in (filepath, base_name, os.path.splitext(base_name)[0])
+
+    def profile(self, filepath):
+        """
+        Returns a context manager capturing a cProfile of the impact in filepath if it is the
+        profile target (see is_profile_target). Only the first match is captured.
+        """
+        if not self.is_profile_target(filepath):
+            return _NO_OP
+        return _ProfileCapture(self, filepath)
+
+    def report(self):
+        """
+        Returns the run report as a JSON-serializable dict.
+        """
+        elapsed = time.perf_counter() - self.start
+        totals = {}
+        for sessions in self.counters.values():
+            for counters in sessions.values():
+                for key, value in counters.items():
+                    totals[key] = totals.get(key, 0) + value
+        stages = {
+            name: {"seconds": seconds, "calls": calls, "mean_ms": 1e3 * seconds / calls, "share": seconds / elapsed if elapsed else 0.0}
+            for name, (seconds, calls) in sorted(self.stages.items(), key=lambda item: -item[1][0])
+        }
+        return {
+            "started": self.started,
+            "elapsed_seconds": elapsed,
+            "stages": stages,
+            "totals": totals,
+            "counters": self.counters,
+            "failures": self.failures,
+            "profile": self.profile_stats,
+        }
+
+    def summary(self):
+        """
+        Returns a printable table of the stage timings and the counter totals.
+        """
+        report = self.report()
+        lines = [f"Run took {report['elapsed_seconds']:.2f} s"]
+        for name, stage in report["stages"].items():
+            lines.append(f"  {name:20s} {stage['seconds']:10.3f} s {stage['calls']:8d} calls "
+                         f"{stage['mean_ms']:10.3f} ms/call {stage['share']:7.1%}")
+        lines.append("  " + ", ".join(f"{key} {value}" for key, value in sorted(report["totals"].items())))
+        if report["failures"]:
+            lines.append(f"  {len(report['failures'])} failures, see the report")
+        return "\n".join(lines)
+
+    def write(self, report_path):
+        """
+        Writes the run report to a JSON file.
+        """
+        os.makedirs(os.path.dirname(os.path.abspath(report_path)), exist_ok=True)
+        with open(report_path, "w") as f:
+            json.dump(self.report(), f, indent=1, default=str)
+
+
+class _ProfileCapture:
+    def __init__(self, instrumentation, filepath):
+        self.instrumentation = instrumentation
+        self.filepath = filepath
+        self.profiler = cProfile.Profile()
+
+    def __enter__(self):
+        self.profiler.enable()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.profiler.disable()
+        stream = io.StringIO()
+        stats = pstats.Stats(self.profiler, stream=stream)
+        stats.sort_stats("cumulative").print_stats(30)
+        self.instrumentation.profile_stats = {"file": self.filepath, "top_cumulative": stream.getvalue()}
+        return False
+
+
+NULL = Instrumentation(enabled=False)
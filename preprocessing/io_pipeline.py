@@ -0,0 +1,81 @@
+"""
+Bounded three-stage pipeline overlapping disk reads, computation and writes.
+
+A thread pool reads the inputs, a process pool computes on them and the calling thread
+consumes the results, e.g. writing them to HDF5 files that only it has open. At most
+queue_size items wait in each of the read and compute queues, so memory stays bounded
+however many items there are, and results come out in input order, so the output does
+not depend on the number of threads or processes:
+
+    with ProcessPoolExecutor(4, get_context("spawn")) as pool:
+        for path, _, result, error in pipelined(paths, read, compute, pool):
+            write(result)
+"""
+
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+_END = object()
+
+
+def pipelined(items, read, compute, pool=None, read_threads=8, queue_size=64):
+    """
+    Reads and computes every item ahead of the consumer.
+
+    Args:
+        items (iterable): Inputs, consumed lazily in this thread.
+        read (callable): Called in a reader thread with an item. Returns a value passed
+            through to the consumer and a tuple of arguments of compute, or None as
+            arguments to skip the computation.
+        compute (callable): Called in pool with the arguments returned by read. Must be
+            picklable, i.e. a module-level function.
+        pool (Executor): Pool running compute, computes in this thread when None.
+        read_threads (int): Number of reader threads.
+        queue_size (int): Maximum number of items queued for reading and for computing.
+
+    Yields:
+        tuple: (item, value returned by read, result of compute, exception) for every
+            item in input order. The exception is that raised by read or compute, else None.
+    """
+    items = iter(items)
+    reads = deque()
+    computes = deque()
+    exhausted = False
+    with ThreadPoolExecutor(read_threads) as readers:
+        try:
+            while True:
+                while not exhausted and len(reads) < queue_size:
+                    item = next(items, _END)
+                    if item is _END:
+                        exhausted = True
+                    else:
+                        reads.append((item, readers.submit(read, item)))
+
+                # Pass finished reads on to the pool; only wait for a read when nothing is computing
+                while reads and len(computes) < queue_size and (reads[0][1].done() or not computes):
+                    item, future = reads.popleft()
+                    try:
+                        value, args = future.result()
+                    except Exception as e:
+                        computes.append((item, None, None, e))
+                        continue
+                    if args is not None and pool is not None:
+                        args = pool.submit(compute, *args)
+                    computes.append((item, value, args, None))
+
+                if not computes:
+                    return
+                item, value, args, error = computes.popleft()
+                result = None
+                if args is not None:
+                    try:
+                        result = compute(*args) if pool is None else args.result()
+                    except Exception as e:
+                        error = e
+                yield item, value, result, error
+        finally:
+            for _, future in reads:
+                future.cancel()
+            for _, _, args, _ in computes:
+                if hasattr(args, "cancel"):
+                    args.cancel()
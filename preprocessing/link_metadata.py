@@ -1,6 +1,7 @@
 import pandas as pd
 import re
 import os
+import pickle
 import numpy as np
 
 # List of all possible impact locations
@@ -13,10 +14,140 @@ IMPACT_LOCATIONS = [
     'Top Right', 'Unknown'
 ]
 
+METADATA_DIR = os.path.join('data', 'metadata')
+METADATA_INDEX_PATH = os.path.join(METADATA_DIR, '.metadata_index.pkl')
+
+# Index loaded for this run, see load_metadata_index
+_metadata_index = None
+
+def metadata_sources(metadata_dir=METADATA_DIR):
+    """
+    Lists the metadata CSV files for every suffix in the order get_metadata searches them:
+    the base metadata_{suffix}.csv first, then metadata_{suffix}_1.csv, metadata_{suffix}_2.csv, ...
+    up to the first missing number.
+
+    Args:
+        metadata_dir (str): Directory containing the metadata CSV files.
+
+    Returns:
+        dict: Mapping of suffix to its ordered list of metadata file paths.
+    """
+    if not os.path.isdir(metadata_dir):
+        return {}
+
+    suffixes = set()
+    for f in os.listdir(metadata_dir):
+        match = re.match(r'metadata_(g\d+|tw\d+)(?:_\d+)?\.csv$', f)
+        if match:
+            suffixes.add(match.group(1))
+
+    sources = {}
+    for suffix in sorted(suffixes):
+        paths = []
+        base_path = os.path.join(metadata_dir, f"metadata_{suffix}.csv")
+        if os.path.exists(base_path):
+            paths.append(base_path)
+        i = 1
+        while os.path.exists(os.path.join(metadata_dir, f"metadata_{suffix}_{i}.csv")):
+            paths.append(os.path.join(metadata_dir, f"metadata_{suffix}_{i}.csv"))
+            i += 1
+        sources[suffix] = paths
+    return sources
+
+def _source_mtimes(sources):
+    return {path: os.stat(path).st_mtime_ns for paths in sources.values() for path in paths}
+
+def _index_metadata_rows(index, suffix, metadata_df, pred_value):
+    """
+    Adds the rows of one metadata file to the index. Instances are numbered within the file,
+    and keys already taken by an earlier file are kept, matching the search order of get_metadata.
+    """
+    if pred_value is not None:
+        metadata_df = metadata_df[metadata_df['pred'] == pred_value]
+    metadata_df = metadata_df.dropna(subset=['team_code', 'id'])
+    instances = metadata_df.groupby(['team_code', 'id'], sort=False).cumcount().to_numpy()
+
+    rows = zip(
+        metadata_df['team_code'], metadata_df['id'], instances,
+        metadata_df['pred'].to_numpy(), metadata_df['impact_location'].to_numpy(), metadata_df['ubric'].to_numpy()
+    )
+    for team_code, id_str, instance, pred_val, impact_location, ubric_score in rows:
+        key = (suffix, pred_value, team_code, id_str, int(instance))
+        index.setdefault(key, (pred_val, impact_location, ubric_score))
+
+def build_metadata_index(metadata_dir=METADATA_DIR):
+    """
+    Reads every metadata CSV once and builds a lookup table keyed by
+    (suffix, pred, team_code, id, instance) holding the pred, impact_location and ubric values.
+
+    Args:
+        metadata_dir (str): Directory containing the metadata CSV files.
+
+    Returns:
+        dict: The metadata index.
+    """
+    index = {}
+    for suffix, paths in metadata_sources(metadata_dir).items():
+        for path in paths:
+            metadata_df = pd.read_csv(path, dtype={'id': str, 'team_code': str})
+            if os.path.basename(path) == f"metadata_{suffix}.csv":
+                # The base file is always filtered by pred, so pred=None never matches it
+                pred_values = [True, False]
+            else:
+                pred_values = [None, True, False]
+            for pred_value in pred_values:
+                _index_metadata_rows(index, suffix, metadata_df, pred_value)
+    return index
+
+def load_metadata_index(metadata_dir=METADATA_DIR, index_path=None, refresh=False):
+    """
+    Returns the metadata index for this run. The index is persisted to disk and rebuilt only
+    when the set of metadata CSV files or any of their modification times change. The source
+    files are checked once per run, when the index is first loaded, or again if refresh is set.
+
+    Args:
+        metadata_dir (str): Directory containing the metadata CSV files.
+        index_path (str): Path of the persisted index, defaults to .metadata_index.pkl in metadata_dir.
+        refresh (bool): Re-check the source files even if the index is already loaded.
+
+    Returns:
+        dict: The metadata index.
+    """
+    global _metadata_index
+
+    if index_path is None:
+        index_path = os.path.join(metadata_dir, os.path.basename(METADATA_INDEX_PATH))
+
+    if _metadata_index is not None and _metadata_index['index_path'] == index_path and not refresh:
+        return _metadata_index['index']
+
+    mtimes = _source_mtimes(metadata_sources(metadata_dir))
+
+    cached = None
+    if os.path.exists(index_path):
+        try:
+            with open(index_path, 'rb') as f:
+                cached = pickle.load(f)
+        except Exception as e:
+            print(f"Warning: Could not read metadata index {index_path}: {e}")
+
+    if cached is None or cached['mtimes'] != mtimes:
+        cached = {'mtimes': mtimes, 'index': build_metadata_index(metadata_dir)}
+        if os.path.isdir(metadata_dir):
+            # Write then rename so concurrent runs never read a partial index
+            tmp_path = f"{index_path}.{os.getpid()}.tmp"
+            with open(tmp_path, 'wb') as f:
+                pickle.dump(cached, f, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp_path, index_path)
+
+    _metadata_index = {'index_path': index_path, 'mtimes': mtimes, 'index': cached['index']}
+    return cached['index']
+
 def get_metadata(impact_filepath):
     """
     Parses an impact file path to find the corresponding metadata entry and return the 'pred' and 'ubric' values.
     It handles cases where metadata is split across multiple files and filters by prediction value based on the directory.
+    Lookups go through the metadata index built by load_metadata_index.
 
     Args:
         impact_filepath (str): The path to the impact data file.
@@ -42,54 +173,17 @@ def get_metadata(impact_filepath):
     team_code_str, id_str, suffix, instance_str = match.groups()
     instance = int(instance_str) if instance_str else 0
 
-    # Try base metadata file first
-    metadata_filename = f"metadata_{suffix}.csv"
-    metadata_filepath = os.path.join('data', 'metadata', metadata_filename)
-
-    if os.path.exists(metadata_filepath):
-        metadata_df = pd.read_csv(metadata_filepath, dtype={'id': str, 'team_code': str})
-        metadata_df = metadata_df[metadata_df['pred'] == pred_value_to_find]
-
-        matching_rows = metadata_df[(metadata_df['team_code'] == team_code_str) & (metadata_df['id'] == id_str)]
-        if instance < len(matching_rows):
-            pred_val = matching_rows.iloc[instance]['pred']
-            impact_location = matching_rows.iloc[instance]['impact_location']
-            ubric_score = matching_rows.iloc[instance]['ubric']
-            
-            # One-hot encode the impact location
-            encoded_location = one_hot_encode(impact_location, IMPACT_LOCATIONS)
-            
-            return pred_val, encoded_location, ubric_score
-
-    # If not found, check for numbered suffixes
-    i = 1
-    while True:
-        metadata_filename_numbered = f"metadata_{suffix}_{i}.csv"
-        metadata_filepath_numbered = os.path.join('data', 'metadata', metadata_filename_numbered)
-        if not os.path.exists(metadata_filepath_numbered):
-            # No more numbered files to check
-            break
-
-        metadata_df = pd.read_csv(metadata_filepath_numbered, dtype={'id': str, 'team_code': str})
-
-        # Filter by pred value if specified
-        if pred_value_to_find is not None:
-            metadata_df = metadata_df[metadata_df['pred'] == pred_value_to_find]
-
-        matching_rows = metadata_df[(metadata_df['team_code'] == team_code_str) & (metadata_df['id'] == id_str)]
-
-        if instance < len(matching_rows):
-            pred_val = matching_rows.iloc[instance]['pred']
-            impact_location = matching_rows.iloc[instance]['impact_location']
-            ubric_score = matching_rows.iloc[instance]['ubric']
-            # One-hot encode the impact location
-            encoded_location = one_hot_encode(impact_location, IMPACT_LOCATIONS)
-
-            return pred_val, encoded_location, ubric_score
-        
-        i += 1
-    
-    raise IndexError(f"Instance {instance} not found for team_code {team_code_str} and id {id_str} in any metadata file for {suffix} with pred={pred_value_to_find}")
+    index = load_metadata_index()
+    entry = index.get((suffix, pred_value_to_find, team_code_str, id_str, instance))
+    if entry is None:
+        raise IndexError(f"Instance {instance} not found for team_code {team_code_str} and id {id_str} in any metadata file for {suffix} with pred={pred_value_to_find}")
+
+    pred_val, impact_location, ubric_score = entry
+
+    # One-hot encode the impact location
+    encoded_location = one_hot_encode(impact_location, IMPACT_LOCATIONS)
+
+    return pred_val, encoded_location, ubric_score
 
 def one_hot_encode(location, locations_list):
     """
@@ -0,0 +1,81 @@
+"""
+Manifest of preprocessed impacts for incremental, resumable runs.
+
+For every impact written to an HDF5 file the manifest records a content hash of its
+trajectory CSV, its metadata row and the preprocessing parameters. A re-run only
+processes impacts whose hash changed or that are not in the manifest yet, and removes
+impacts that are in the manifest but no longer in the data.
+"""
+
+import hashlib
+import json
+import os
+
+import numpy as np
+import pandas as pd
+
+MANIFEST_VERSION = 1
+
+
+def load_manifest(manifest_path):
+    """
+    Loads a manifest, or returns an empty one if it does not exist yet.
+
+    Args:
+        manifest_path (str): Path to the manifest JSON file.
+
+    Returns:
+        dict: Mapping of HDF5 path to a mapping of group name to content hash.
+    """
+    if not os.path.exists(manifest_path):
+        return {}
+    with open(manifest_path) as f:
+        manifest = json.load(f)
+    if manifest.get("version") != MANIFEST_VERSION:
+        print(f"Ignoring manifest {manifest_path} with unsupported version {manifest.get('version')}")
+        return {}
+    return manifest["impacts"]
+
+
+def save_manifest(impacts, manifest_path):
+    """
+    Atomically writes a manifest, so an interrupted run never leaves a partial file.
+
+    Args:
+        impacts (dict): Mapping of HDF5 path to a mapping of group name to content hash.
+        manifest_path (str): Path to the manifest JSON file.
+    """
+    tmp_path = f"{manifest_path}.{os.getpid()}.tmp"
+    with open(tmp_path, "w") as f:
+        json.dump({"version": MANIFEST_VERSION, "impacts": impacts}, f, indent=1, sort_keys=True)
+    os.replace(tmp_path, manifest_path)
+
+
+def _json_value(value):
+    if isinstance(value, (float, np.floating)) and np.isnan(value):
+        return None
+    if isinstance(value, np.generic):
+        return value.item()
+    return value if isinstance(value, (str, int, float, bool)) or value is None else str(value)
+
+
+def impact_hash(trajectory_file, metadata_row, params):
+    """
+    Computes the content hash of one impact.
+
+    Args:
+        trajectory_file (str): Path to the trajectory CSV.
+        metadata_row (pd.Series): Metadata row of the impact.
+        params (dict): Preprocessing parameters that affect the output.
+
+    Returns:
+        str: Hex digest of the trajectory bytes, metadata row and parameters.
+    """
+    h = hashlib.sha256()
+    with open(trajectory_file, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            h.update(block)
+    row = {str(k): _json_value(v) for k, v in pd.Series(metadata_row).items()}
+    h.update(json.dumps(row, sort_keys=True).encode())
+    h.update(json.dumps(params, sort_keys=True).encode())
+    return h.hexdigest()
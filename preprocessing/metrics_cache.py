@@ -0,0 +1,291 @@
+"""
+Persistent cache of derived impact metrics (UBrIC, DAMAGE) in a local SQLite file.
+
+Entries are keyed by a hash of the time vector and angular acceleration profile together
+with the metric's parameters (critical values and r of UBrIC, mass, stiffness, damping,
+beta and solver of DAMAGE), so reports, retraining and re-exports that touch an impact
+again reuse its metrics, and changing a parameter or the data misses the cache instead
+of returning a stale value:
+
+    with MetricsCache("data/metrics_cache.sqlite") as cache:
+        damage = compute_damage(acc, t, cache=cache)
+        ubric_scores = calculate_ubric_batch(profiles, times, lengths, cache=cache)
+        print(cache.stats())
+
+The cache holds at most max_entries metrics and evicts the least recently used ones
+beyond that. Hits, misses and evictions are counted per instance and summed over every
+process in the file. Worker processes open their own MetricsCache on the same file:
+SQLite in WAL mode lets them read concurrently while writes are serialized, and every
+instance buffers its inserts and last-used updates and writes them in one transaction
+every flush_every operations and on close.
+"""
+
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+
+import numpy as np
+
+DEFAULT_CACHE_PATH = os.path.join("data", "metrics_cache.sqlite")
+DEFAULT_MAX_ENTRIES = 1_000_000
+CACHE_VERSION = 1
+STAT_NAMES = ("hits", "misses", "evictions")
+
+
+def acceleration_hash(time, profile):
+    """
+    Returns the hex digest of a time vector (N,) and N x 3 angular acceleration profile.
+    """
+    h = hashlib.sha256()
+    for array in (time, profile):
+        array = np.ascontiguousarray(array, dtype=np.float64)
+        h.update(str(array.shape).encode())
+        h.update(array.tobytes())
+    return h.hexdigest()
+
+
+def metric_key(metric, accel_hash, params):
+    """
+    Returns the cache key of a metric of an impact under a parameter set.
+
+    Args:
+        metric (str): Metric name, e.g. "ubric" or "damage".
+        accel_hash (str): acceleration_hash of the impact.
+        params (dict): JSON-serializable parameters the metric depends on.
+    """
+    payload = json.dumps({"metric": metric, "params": params}, sort_keys=True)
+    return hashlib.sha256(f"{accel_hash}:{payload}".encode()).hexdigest()
+
+
+class MetricsCache:
+    """
+    SQLite-backed LRU cache of scalar impact metrics. Safe to share between the threads
+    of a process; every process opens its own instance.
+
+    Args:
+        path (str): Path to the SQLite file, created if missing.
+        max_entries (int): Number of cached metrics kept, least recently used evicted first.
+        flush_every (int): Buffered inserts and last-used updates written per transaction.
+        timeout (float): Seconds to wait for another process's write lock.
+    """
+
+    def __init__(self, path=DEFAULT_CACHE_PATH, max_entries=DEFAULT_MAX_ENTRIES, flush_every=256, timeout=60.0):
+        self.path = path
+        self.max_entries = max_entries
+        self.flush_every = flush_every
+        self.timeout = timeout
+        self.lock = threading.Lock()
+        self.counts = dict.fromkeys(STAT_NAMES, 0)
+        self._unflushed = dict.fromkeys(STAT_NAMES, 0)
+        self._puts = {}
+        self._touches = {}
+        self._connection = None
+        self._pid = None
+        self._connect()
+
+    def _connect(self):
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        connection = sqlite3.connect(self.path, timeout=self.timeout, isolation_level=None, check_same_thread=False)
+        connection.execute("PRAGMA journal_mode=WAL")
+        connection.execute("PRAGMA synchronous=NORMAL")
+        with connection:
+            connection.execute("BEGIN IMMEDIATE")
+            version = connection.execute("PRAGMA user_version").fetchone()[0]
+            if version not in (0, CACHE_VERSION):
+                connection.execute("DROP TABLE IF EXISTS metrics")
+                connection.execute("DROP TABLE IF EXISTS stats")
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS metrics "
+                "(key TEXT PRIMARY KEY, metric TEXT NOT NULL, value REAL, last_used REAL NOT NULL)"
+            )
+            connection.execute("CREATE INDEX IF NOT EXISTS metrics_last_used ON metrics (last_used)")
+            connection.execute("CREATE TABLE IF NOT EXISTS stats (name TEXT PRIMARY KEY, value INTEGER NOT NULL)")
+            connection.execute(f"PRAGMA user_version = {CACHE_VERSION}")
+        self._connection = connection
+        self._pid = os.getpid()
+
+    def _db(self):
+        # A connection inherited through fork must not be used by the child
+        if self._pid != os.getpid():
+            self._puts.clear()
+            self._touches.clear()
+            self.counts = dict.fromkeys(STAT_NAMES, 0)
+            self._unflushed = dict.fromkeys(STAT_NAMES, 0)
+            self._connect()
+        return self._connection
+
+    def get_many(self, keys):
+        """
+        Looks up some keys.
+
+        Returns:
+            dict: Cached value of every key that was hit. NaN metrics are cached as NaN.
+        """
+        keys = list(keys)
+        found = {}
+        with self.lock:
+            db = self._db()
+            pending = [key for key in keys if key not in self._puts]
+            found.update({key: self._puts[key][1] for key in keys if key in self._puts})
+            # Stay below SQLite's limit on query parameters
+            for start in range(0, len(pending), 500):
+                chunk = pending[start:start + 500]
+                rows = db.execute(
+                    f"SELECT key, value FROM metrics WHERE key IN ({','.join('?' * len(chunk))})", chunk
+                ).fetchall()
+                found.update({key: np.nan if value is None else value for key, value in rows})
+
+            now = time.time()
+            for key in found:
+                self._touches[key] = now
+            self._add_counts(hits=len(found), misses=len(keys) - len(found))
+            self._maybe_flush()
+        return found
+
+    def get(self, key):
+        """
+        Returns the cached value of key, or None on a miss.
+        """
+        return self.get_many([key]).get(key)
+
+    def put(self, key, metric, value):
+        """
+        Caches value under key. Written with the next flush.
+        """
+        with self.lock:
+            self._db()
+            self._puts[key] = (metric, float(value), time.time())
+            self._maybe_flush()
+
+    def get_or_compute(self, metric, time_vector, profile, params, compute):
+        """
+        Returns a metric of one impact from the cache, or computes and caches it.
+
+        Args:
+            metric (str): Metric name.
+            time_vector (np.ndarray): Time vector (N,).
+            profile (np.ndarray): N x 3 angular acceleration profile.
+            params (dict): Parameters the metric depends on.
+            compute (callable): Called without arguments on a miss, returns the metric.
+        """
+        key = metric_key(metric, acceleration_hash(time_vector, profile), params)
+        value = self.get(key)
+        if value is None:
+            value = compute()
+            self.put(key, metric, value)
+        return value
+
+    def _add_counts(self, **counts):
+        for name, n in counts.items():
+            self.counts[name] += n
+            self._unflushed[name] += n
+
+    def _maybe_flush(self):
+        if len(self._puts) + len(self._touches) >= self.flush_every:
+            self._flush()
+
+    def flush(self):
+        """
+        Writes buffered inserts, last-used updates and counts, then evicts the least
+        recently used metrics beyond max_entries.
+        """
+        with self.lock:
+            self._db()
+            self._flush()
+
+    def _flush(self):
+        db = self._connection
+        with db:
+            db.execute("BEGIN IMMEDIATE")
+            db.executemany(
+                "INSERT OR REPLACE INTO metrics (key, metric, value, last_used) VALUES (?, ?, ?, ?)",
+                [(key, metric, None if np.isnan(value) else value, used) for key, (metric, value, used) in self._puts.items()],
+            )
+            db.executemany(
+                "UPDATE metrics SET last_used = MAX(last_used, ?) WHERE key = ?",
+                [(used, key) for key, used in self._touches.items()],
+            )
+            excess = db.execute("SELECT COUNT(*) FROM metrics").fetchone()[0] - self.max_entries
+            if excess > 0:
+                db.execute(
+                    "DELETE FROM metrics WHERE key IN (SELECT key FROM metrics ORDER BY last_used LIMIT ?)", (excess,)
+                )
+                self._add_counts(evictions=excess)
+            db.executemany(
+                "INSERT INTO stats (name, value) VALUES (?, ?) ON CONFLICT (name) DO UPDATE SET value = value + excluded.value",
+                list(self._unflushed.items()),
+            )
+        self._puts.clear()
+        self._touches.clear()
+        self._unflushed = dict.fromkeys(STAT_NAMES, 0)
+
+    def stats(self):
+        """
+        Returns the number of cached metrics per metric, the hits, misses and evictions of
+        this instance and the totals of every process that used the file.
+        """
+        with self.lock:
+            db = self._db()
+            self._flush()
+            entries = dict(db.execute("SELECT metric, COUNT(*) FROM metrics GROUP BY metric").fetchall())
+            totals = dict.fromkeys(STAT_NAMES, 0)
+            totals.update(dict(db.execute("SELECT name, value FROM stats").fetchall()))
+            counts = dict(self.counts)
+        lookups = counts["hits"] + counts["misses"]
+        total_lookups = totals["hits"] + totals["misses"]
+        return {
+            "path": self.path,
+            "entries": entries,
+            "max_entries": self.max_entries,
+            "session": dict(counts, hit_rate=counts["hits"] / lookups if lookups else None),
+            "total": dict(totals, hit_rate=totals["hits"] / total_lookups if total_lookups else None),
+        }
+
+    def clear(self):
+        """
+        Removes every cached metric and resets the counts.
+        """
+        with self.lock:
+            db = self._db()
+            self._puts.clear()
+            self._touches.clear()
+            self.counts = dict.fromkeys(STAT_NAMES, 0)
+            self._unflushed = dict.fromkeys(STAT_NAMES, 0)
+            with db:
+                db.execute("BEGIN IMMEDIATE")
+                db.execute("DELETE FROM metrics")
+                db.execute("DELETE FROM stats")
+
+    def close(self):
+        if self._connection is None:
+            return
+        with self.lock:
+            if self._pid == os.getpid():
+                self._flush()
+                self._connection.close()
+            self._connection = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Show or clear the derived metrics cache")
+    parser.add_argument("--cache", type=str, default=DEFAULT_CACHE_PATH)
+    parser.add_argument("--clear", action="store_true", help="Remove every cached metric")
+
+    args = parser.parse_args()
+
+    with MetricsCache(args.cache) as cache:
+        if args.clear:
+            cache.clear()
+            print(f"Cleared {args.cache}")
+        print(json.dumps(cache.stats(), indent=1))
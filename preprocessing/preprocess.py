@@ -15,28 +15,30 @@ import os
 
 import h5py
 import numpy as np
-import pandas as pd
-from conjugate import conjugate_vrot_transform
-from shift_and_pad import shift_and_pad
+from augment_batch import augment_batch
 from calculate_ubric import calculate_ubric_from_profile
+from h5_storage import dataset_kwargs, is_filtered
 from link_metadata import get_metadata
+from resample import record_sample_rate, resample_profile
+from trajectory_store import read_trajectory
 
-def process_file(filepath, output_h5_path):
+def prepare_impact(filepath, augment=True, sample_rate=None):
     """
-    Processes a single input CSV file and saves all its augmented
-    permutations to a single HDF5 file.
+    Reads a single input CSV file and computes all its augmented permutations
+    without touching any HDF5 file, so it can run in a worker process.
 
     Args:
         filepath (str): Path to the input CSV file.
-        output_h5_path (str): Path to the output HDF5 file.
+        augment (bool): Compute the permutation datasets. Not needed when only the
+            canonical profile is stored.
+        sample_rate (float): Resample the profile to this rate [Hz] before augmenting
+            and storing it, keeps the recorded rate by default.
+
+    Returns:
+        dict: Group name, group attributes, the per-permutation datasets and the raw profile.
     """
-    df = pd.read_csv(filepath)
+    time, profile = read_trajectory(filepath)
     
-    # Calculate sampling frequency
-    time = df.iloc[:, 0].astype(float).to_numpy()
-    fs = 1 / (time[1] - time[0])
-    
-    profile = df.iloc[:, [4, 5, 6]].to_numpy()
     cnn_length = 2000
     axes_permutations = list(itertools.permutations([0, 1, 2]))
     axes_labels = ["x", "y", "z"]
@@ -45,28 +47,91 @@ def process_file(filepath, output_h5_path):
     group_name, _ = os.path.splitext(base_name)
 
     # Get metadata prediction and ubric score
-    pred, impact_location = get_metadata(filepath)
+    pred, impact_location, _ = get_metadata(filepath)
     ubric_score = calculate_ubric_from_profile(profile, time)
-    with h5py.File(output_h5_path, "a") as hf:
-        if group_name in hf:
-            del hf[group_name]
-        group = hf.create_group(group_name)
-        group.attrs["pred"] = pred
-        group.attrs["impact_location"] = impact_location
-        group.attrs["ubric_score"] = ubric_score
-        print(f"Processing {filepath}")
 
+    # Same rate for every CNN input, whatever the device recorded at
+    if sample_rate is not None:
+        time, profile = resample_profile(time, profile, sample_rate)
+
+    # Conjugate transform and shift_and_pad for all permutations in one pass
+    datasets = {}
+    if augment:
+        cnn_inputs = augment_batch(profile[np.newaxis], target_idx, cnn_length)[0]
         for i, perm in enumerate(axes_permutations):
-            permuted = profile[:, perm]
-            conj_profile = conjugate_vrot_transform(permuted)
-            padded_profile = shift_and_pad(conj_profile, target_idx, cnn_length)
-            cnn_input = padded_profile.T[np.newaxis, :, :]
+            cnn_input = cnn_inputs[i][np.newaxis, :, :]
             perm_name = "".join([axes_labels[p] for p in perm])
-            dataset_name = f"perm_{perm_name}"
-            group.create_dataset(dataset_name, data=cnn_input)
+            datasets[f"perm_{perm_name}"] = cnn_input
+
+    return {
+        "group_name": group_name,
+        "attrs": {
+            "pred": pred,
+            "impact_location": impact_location,
+            "ubric_score": ubric_score,
+        },
+        "datasets": datasets,
+        "profile": profile,
+    }
+
+
+def write_impact(hf, impact, verbose=True, storage=None):
+    """
+    Writes an impact prepared by prepare_impact to an open HDF5 file,
+    replacing any existing group of the same name.
+
+    Args:
+        hf (h5py.File): HDF5 file opened for writing.
+        impact (dict): Output of prepare_impact.
+        verbose (bool): Print each saved dataset.
+        storage (dict): dtype and filters of the datasets (see h5_storage), float64
+            without filters by default. Filtered datasets are stored as one chunk.
+    """
+    kwargs = dataset_kwargs(storage)
+    group_name = impact["group_name"]
+    if group_name in hf:
+        del hf[group_name]
+    group = hf.create_group(group_name)
+    for key, value in impact["attrs"].items():
+        group.attrs[key] = value
+    for dataset_name, cnn_input in impact["datasets"].items():
+        chunks = cnn_input.shape if storage is not None and is_filtered(storage) else None
+        group.create_dataset(dataset_name, data=cnn_input, chunks=chunks, **kwargs)
+        if verbose:
             print(f"Saved dataset '{dataset_name}'")
 
 
+def process_file(filepath, output_h5_path, sample_rate=None):
+    """
+    Processes a single input CSV file and saves all its augmented
+    permutations to a single HDF5 file.
+
+    Args:
+        filepath (str): Path to the input CSV file.
+        output_h5_path (str): Path to the output HDF5 file.
+        sample_rate (float): Resample the profile to this rate [Hz] first. Must match
+            the rate of the impacts already in the file (see resample.record_sample_rate).
+    """
+    impact = prepare_impact(filepath, sample_rate=sample_rate)
+    with h5py.File(output_h5_path, "a") as hf:
+        record_sample_rate(hf, sample_rate)
+        print(f"Processing {filepath}")
+        write_impact(hf, impact)
+
+
+def default_output_h5_path(filepath):
+    """
+    Returns the shared HDF5 output file for an impact, based on whether the
+    file name marks it as a game (_g) or training (_tw) impact.
+    """
+    base_name = os.path.basename(filepath)
+    if "_g" in base_name:
+        return "data/impact_data_game.h5"
+    elif "_tw" in base_name:
+        return "data/impact_data_training.h5"
+    return None
+
+
 if __name__ == "__main__":
     import argparse
 
@@ -75,14 +140,11 @@ if __name__ == "__main__":
     parser.add_argument(
         "--output_h5", type=str, default=None
     )
+    parser.add_argument("--sample_rate", type=float, default=None, help="Resample the profile to this rate [Hz]")
 
     args = parser.parse_args()
     
     output_h5_path = args.output_h5
     if output_h5_path is None:
-        base_name = os.path.basename(args.filepath)
-        if "_g" in base_name:
-            output_h5_path = "data/impact_data_game.h5"
-        elif "_tw" in base_name:
-            output_h5_path = "data/impact_data_training.h5"
-    process_file(args.filepath, output_h5_path)
+        output_h5_path = default_output_h5_path(args.filepath)
+    process_file(args.filepath, output_h5_path, args.sample_rate)
@@ -1,26 +1,148 @@
 import os
-import subprocess
+from concurrent.futures import ProcessPoolExecutor
 
+import h5py
+from consolidated_h5 import ConsolidatedWriter
+from h5_storage import add_storage_arguments, storage_from_args
+from io_pipeline import pipelined
+from link_metadata import load_metadata_index
+from preprocess import default_output_h5_path, prepare_impact, write_impact
+from resample import record_sample_rate
+from trajectory_store import ingest_directory
 
-def process_all_files():
-    raw_data_dir = "data/pred_true/impact_data"
-
-    if not os.path.exists(raw_data_dir):
-        print(f"Directory not found: {raw_data_dir}")
-        return
 
+def find_impact_files(raw_data_dir):
+    """
+    Returns the paths of all impact CSV files below raw_data_dir.
+    """
+    filepaths = []
     for root, dirs, files in os.walk(raw_data_dir):
         for filename in files:
             if filename.endswith(".csv"):
-                filepath = os.path.join(root, filename)
-                command = [
-                    "python",
-                    "preprocessing/preprocess.py",
-                    filepath,
-                ]
-                print(f"Executing: {' '.join(command)}")
-                subprocess.run(command, check=True)
+                filepaths.append(os.path.join(root, filename))
+    return sorted(filepaths)
+
+
+def process_all_files(raw_data_dir="data/pred_true/impact_data", workers=None, layout="groups", storage=None, chunk_impacts=1,
+                      sample_rate=None):
+    """
+    Preprocesses every impact CSV below raw_data_dir in a single process pool.
+
+    Workers first parse new or changed CSVs into the binary trajectory cache,
+    one directory per task, then read the impacts and compute the augmented
+    permutations. All HDF5 writes happen in this process, so each shared
+    output file is only ever open once. At most a few impacts per worker are in
+    flight, so memory does not grow with the number of files, and impacts are
+    written in file order, so the output does not depend on scheduling.
+
+    Args:
+        raw_data_dir (str): Directory to search for impact CSV files.
+        workers (int): Number of worker processes, defaults to the CPU count.
+        layout (str): "groups" for one group per impact, "consolidated" for the
+            chunked layout of consolidated_h5, "canonical" for the chunked layout
+            storing only the raw profile, augmented at load time by impact_loader, or
+            "ragged" for the chunked layout storing the CNN inputs without their padding.
+        storage (dict): dtype and filters of the profiles of new files (see h5_storage).
+        chunk_impacts (int): Number of impacts per chunk of new consolidated files.
+        sample_rate (float): Resample every profile to this rate [Hz] before augmenting it.
+            Must match the rate of the impacts already in the output files.
+
+    Returns:
+        tuple: Number of processed files and a list of (filepath, error) failures.
+    """
+    if not os.path.exists(raw_data_dir):
+        print(f"Directory not found: {raw_data_dir}")
+        return 0, []
+
+    filepaths = find_impact_files(raw_data_dir)
+    consolidated = layout in ("consolidated", "canonical", "ragged")
+    profile_store = "augmented" if layout == "consolidated" else layout
+
+    # Build or load the metadata index once, before the workers start
+    load_metadata_index()
+    print(f"Found {len(filepaths)} impact files, processing with {workers or os.cpu_count()} workers")
+
+    processed = 0
+    failures = []
+    open_files = {}
+    writers = {}
+    try:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            csv_dirs = sorted({os.path.dirname(filepath) for filepath in filepaths})
+            for csv_dir, future in [(d, pool.submit(ingest_directory, d)) for d in csv_dirs]:
+                try:
+                    future.result()
+                except OSError as e:
+                    print(f"Could not write trajectory cache for {csv_dir}: {e}")
+
+            augment = layout not in ("canonical", "ragged")
+
+            def read(filepath):
+                output_h5_path = default_output_h5_path(filepath)
+                if output_h5_path is None:
+                    return None, None
+                return output_h5_path, (filepath, augment, sample_rate)
+
+            # In file order, with a bounded number of impacts waiting to be written
+            queue_size = 4 * (workers or os.cpu_count() or 1)
+            for filepath, output_h5_path, impact, error in pipelined(filepaths, read, prepare_impact, pool,
+                                                                     read_threads=1, queue_size=queue_size):
+                if output_h5_path is None and error is None:
+                    failures.append((filepath, "cannot determine output HDF5 file from file name"))
+                    continue
+                try:
+                    if error is not None:
+                        raise error
+                    if output_h5_path not in open_files:
+                        hf = h5py.File(output_h5_path, "a")
+                        try:
+                            record_sample_rate(hf, sample_rate)
+                        except ValueError:
+                            hf.close()
+                            raise
+                        open_files[output_h5_path] = hf
+                        if consolidated:
+                            writers[output_h5_path] = ConsolidatedWriter(
+                                open_files[output_h5_path], chunk_impacts=chunk_impacts,
+                                profile_store=profile_store, storage=storage
+                            )
+                    print(f"Processing {filepath}")
+                    if consolidated:
+                        writers[output_h5_path].add(impact)
+                    else:
+                        write_impact(open_files[output_h5_path], impact, storage=storage)
+                    processed += 1
+                except Exception as e:
+                    print(f"Error processing {filepath}: {e}")
+                    failures.append((filepath, repr(e)))
+    finally:
+        for writer in writers.values():
+            writer.close()
+        for hf in open_files.values():
+            hf.close()
+
+    print(f"Processed {processed} of {len(filepaths)} files")
+    if failures:
+        print(f"{len(failures)} files failed:")
+        for filepath, error in failures:
+            print(f"  {filepath}: {error}")
+
+    return processed, failures
 
 
 if __name__ == "__main__":
-    process_all_files()
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Process all impact files for CNN input")
+    parser.add_argument("--raw_data_dir", type=str, default="data/pred_true/impact_data")
+    parser.add_argument("--workers", type=int, default=None)
+    parser.add_argument("--layout", type=str, default="groups", choices=["groups", "consolidated", "canonical", "ragged"])
+    parser.add_argument("--sample_rate", type=float, default=None, help="Resample every profile to this rate [Hz]")
+    add_storage_arguments(parser)
+
+    args = parser.parse_args()
+
+    _, failures = process_all_files(args.raw_data_dir, args.workers, args.layout, storage_from_args(args), args.chunk_impacts,
+                                    args.sample_rate)
+    if failures:
+        raise SystemExit(1)
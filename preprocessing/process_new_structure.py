@@ -4,9 +4,18 @@ import h5py
 import numpy as np
 import pandas as pd
 import re
-from conjugate import conjugate_vrot_transform
-from shift_and_pad import shift_and_pad
+from augment_batch import augment_batch
 from calculate_ubric import calculate_ubric_from_profile
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import get_context
+from consolidated_h5 import ConsolidatedWriter, is_consolidated
+from h5_storage import add_storage_arguments, storage_from_args
+from instrumentation import NULL, Instrumentation
+from io_pipeline import pipelined
+from manifest import impact_hash, load_manifest, save_manifest
+from preprocess import write_impact
+from resample import record_sample_rate, resample_profile
+from trajectory_store import ingest_directory, read_trajectory
 
 # List of all possible impact locations (from link_metadata.py)
 IMPACT_LOCATIONS = [
@@ -18,6 +27,15 @@ IMPACT_LOCATIONS = [
     'Top Right', 'Unknown'
 ]
 
+# Preprocessing parameters, recorded in the manifest so changing them reprocesses every impact
+CNN_LENGTH = 2000
+TARGET_IDX = CNN_LENGTH // 2
+
+MANIFEST_PATH = os.path.join("data", "preprocess_manifest.json")
+
+# Number of processed impacts between manifest saves
+CHECKPOINT_EVERY = 100
+
 def one_hot_encode(location, locations_list):
     """
     One-hot encodes a single location string into a vector.
@@ -42,55 +60,109 @@ def one_hot_encode(location, locations_list):
             encoding[index] = 1
     return encoding
 
-def process_file(filepath, output_h5_path, pred, impact_location, ubric_hitiq):
+def build_impact(group_name, time, profile, pred, impact_location, ubric_hitiq, augment=True, instr=NULL,
+                 sample_rate=None):
     """
-    Processes a single input CSV file and saves all its augmented
-    permutations to a single HDF5 file.
+    Computes the UBrIC score, encoded location and augmented permutations of an impact
+    from its time vector and angular acceleration profile. With augment=False only the
+    raw profile is kept, for files that store the canonical profile. With sample_rate,
+    the profile is resampled to that rate (see resample) before it is augmented or
+    stored; the UBrIC score is computed from the recorded profile. Stage times are
+    added to instr.
     """
-    try:
-        df = pd.read_csv(filepath)
-        
-        # Calculate sampling frequency
-        time = df.iloc[:, 0].astype(float).to_numpy()
-        # fs = 1 / (time[1] - time[0]) # Unused variable
-        
-        # Assuming columns 4, 5, 6 correspond to angular acceleration X, Y, Z
-        # This matches preprocess.py: profile = df.iloc[:, [4, 5, 6]].to_numpy()
-        profile = df.iloc[:, [4, 5, 6]].to_numpy()
-        
-        cnn_length = 2000
-        axes_permutations = list(itertools.permutations([0, 1, 2]))
-        axes_labels = ["x", "y", "z"]
-        target_idx = cnn_length // 2
-        base_name = os.path.basename(filepath)
-        group_name, _ = os.path.splitext(base_name)
+    cnn_length = CNN_LENGTH
+    axes_permutations = list(itertools.permutations([0, 1, 2]))
+    axes_labels = ["x", "y", "z"]
+    target_idx = TARGET_IDX
 
+    with instr.stage("ubric"):
         ubric_score = calculate_ubric_from_profile(profile, time)
-        
-        # Encode impact location
-        encoded_location = one_hot_encode(impact_location, IMPACT_LOCATIONS)
-
-        with h5py.File(output_h5_path, "a") as hf:
-            if group_name in hf:
-                del hf[group_name]
-            group = hf.create_group(group_name)
-            group.attrs["pred"] = pred
-            group.attrs["impact_location"] = encoded_location
-            group.attrs["ubric_score"] = ubric_score
-            group.attrs["ubric_hitiq"] = ubric_hitiq
-            
-            for i, perm in enumerate(axes_permutations):
-                permuted = profile[:, perm]
-                conj_profile = conjugate_vrot_transform(permuted)
-                padded_profile = shift_and_pad(conj_profile, target_idx, cnn_length)
-                cnn_input = padded_profile.T[np.newaxis, :, :]
-                perm_name = "".join([axes_labels[p] for p in perm])
-                dataset_name = f"perm_{perm_name}"
-                group.create_dataset(dataset_name, data=cnn_input)
+
+    # Same rate for every CNN input, whatever the device recorded at
+    if sample_rate is not None:
+        with instr.stage("resample"):
+            time, profile = resample_profile(time, profile, sample_rate)
+    
+    # Encode impact location
+    encoded_location = one_hot_encode(impact_location, IMPACT_LOCATIONS)
+
+    # Conjugate transform and shift_and_pad for all permutations in one pass
+    datasets = {}
+    if augment:
+        with instr.stage("augment"):
+            cnn_inputs = augment_batch(profile[np.newaxis], target_idx, cnn_length)[0]
+        for i, perm in enumerate(axes_permutations):
+            cnn_input = cnn_inputs[i][np.newaxis, :, :]
+            perm_name = "".join([axes_labels[p] for p in perm])
+            datasets[f"perm_{perm_name}"] = cnn_input
+
+    return {
+        "group_name": group_name,
+        "attrs": {
+            "pred": pred,
+            "impact_location": encoded_location,
+            "ubric_score": ubric_score,
+            "ubric_hitiq": ubric_hitiq,
+        },
+        "datasets": datasets,
+        "profile": profile,
+    }
+
+def prepare_impact(filepath, pred, impact_location, ubric_hitiq, augment=True, instr=NULL, sample_rate=None):
+    """
+    Reads a single input CSV file and computes all its augmented permutations
+    without touching any HDF5 file (see build_impact). Stage times are added to instr.
+    """
+    # Time and angular acceleration X, Y, Z, from the trajectory cache when it is up to date
+    with instr.stage("read_trajectory"):
+        time, profile = read_trajectory(filepath)
+
+    group_name, _ = os.path.splitext(os.path.basename(filepath))
+    return build_impact(group_name, time, profile, pred, impact_location, ubric_hitiq, augment, instr, sample_rate)
+
+def compute_impact(group_name, time, profile, pred, impact_location, ubric_hitiq, augment=True, sample_rate=None,
+                   timed=False, profiled=False):
+    """
+    build_impact for a worker process. With timed=True the stage times are returned too,
+    and with profiled=True a cProfile of the computation, to be merged into the run's
+    Instrumentation.
+
+    Returns:
+        tuple: The impact, the stage times and the profile (or None).
+    """
+    instr = Instrumentation(profile_target=group_name if profiled else None) if timed else NULL
+    with instr.profile(group_name):
+        impact = build_impact(group_name, time, profile, pred, impact_location, ubric_hitiq, augment, instr, sample_rate)
+    return impact, instr.stages, instr.profile_stats
+
+def process_file(filepath, output_h5_path, pred, impact_location, ubric_hitiq, writer=None, instr=NULL, storage=None,
+                 sample_rate=None):
+    """
+    Processes a single input CSV file and saves all its augmented
+    permutations to a single HDF5 file. If a ConsolidatedWriter is given,
+    the impact is appended to it instead of written as its own group.
+    Stage times and failures are recorded in instr. storage sets the dtype and
+    filters of the group datasets (see h5_storage), and sample_rate the rate the
+    profile is resampled to (see build_impact), which must match the rate of the
+    impacts already in the file.
+    """
+    try:
+        with instr.profile(filepath):
+            augment = writer is None or writer.profile_store == "augmented"
+            impact = prepare_impact(filepath, pred, impact_location, ubric_hitiq, augment, instr, sample_rate)
+            with instr.stage("h5_write"):
+                if writer is not None:
+                    record_sample_rate(writer.hf, sample_rate)
+                    writer.add(impact)
+                else:
+                    with h5py.File(output_h5_path, "a") as hf:
+                        record_sample_rate(hf, sample_rate)
+                        write_impact(hf, impact, verbose=False, storage=storage)
         
         return True
     except Exception as e:
         print(f"Error processing {filepath}: {e}")
+        instr.failure(filepath, e)
         return False
 
 def get_h5_path(team_dir, team_name, session_type):
@@ -100,121 +172,369 @@ def get_h5_path(team_dir, team_name, session_type):
         return os.path.join(team_dir, f"{team_name}_game.h5")
     return None
 
-def process_all_data():
+def list_impact_names(h5_path):
+    """
+    Returns the names of all impacts stored in an H5 file, in either layout.
+    """
+    if not os.path.exists(h5_path):
+        return set()
+    with h5py.File(h5_path, "r") as hf:
+        if is_consolidated(hf):
+            return {n.decode() if isinstance(n, bytes) else n for n in hf["name"][:]}
+        return set(hf.keys())
+
+def remove_stale_impacts(h5_path, current_names):
+    """
+    Removes impacts that are stored in an H5 file but not in current_names.
+
+    Returns:
+        list: Names of the removed impacts.
+    """
+    stale = sorted(list_impact_names(h5_path) - set(current_names))
+    if not stale:
+        return stale
+    with h5py.File(h5_path, "a") as hf:
+        if is_consolidated(hf):
+            ConsolidatedWriter(hf).remove(stale)
+        else:
+            for name in stale:
+                del hf[name]
+    return stale
+
+def session_type_of(session_name):
+    """
+    Returns 'Training' or 'Game' from a session folder name, or None if it is neither.
+    """
+    if any(x in session_name for x in ['_P', '_practice', '_T', '_Training']):
+        return 'Training'
+    elif any(x in session_name for x in ['_game', '_G']):
+        return 'Game'
+    return None
+
+def index_sessions(root_data_dir="data"):
+    """
+    Indexes every team and session under root_data_dir in a single os.scandir pass, so
+    processing needs no further directory listing or existence check. Entries keep the
+    order of os.listdir.
+
+    Args:
+        root_data_dir (str): Directory of the team folders.
+
+    Returns:
+        list: Per team, a dict with name, path and sessions. Every session is a dict with
+            name, path, type ('Training', 'Game' or None), metadata_file and trajectories_dir
+            (None if missing) and trajectory_files, the [size, mtime_ns] of every trajectory
+            CSV by file name.
+    """
+    teams = []
+    with os.scandir(root_data_dir) as team_entries:
+        for team_entry in team_entries:
+            if not team_entry.is_dir() or team_entry.name == 'metadata' or team_entry.name.startswith('.'):
+                continue
+            sessions = []
+            with os.scandir(team_entry.path) as session_entries:
+                for session_entry in session_entries:
+                    if not session_entry.is_dir() or session_entry.name.startswith('.'):
+                        continue
+                    session = {
+                        "name": session_entry.name,
+                        "path": session_entry.path,
+                        "type": session_type_of(session_entry.name),
+                        "metadata_file": None,
+                        "trajectories_dir": None,
+                        "trajectory_files": {},
+                    }
+                    sessions.append(session)
+                    if session["type"] is None:
+                        continue
+                    with os.scandir(session_entry.path) as entries:
+                        for entry in entries:
+                            if entry.name == "trajectories" and entry.is_dir():
+                                session["trajectories_dir"] = entry.path
+                            elif session["metadata_file"] is None and entry.name.endswith('.csv'):
+                                session["metadata_file"] = entry.path
+                    if session["trajectories_dir"] is not None:
+                        with os.scandir(session["trajectories_dir"]) as entries:
+                            for entry in entries:
+                                if entry.name.endswith('.csv') and entry.is_file():
+                                    stat = entry.stat()
+                                    session["trajectory_files"][entry.name] = [stat.st_size, stat.st_mtime_ns]
+            teams.append({"name": team_entry.name, "path": team_entry.path, "sessions": sessions})
+    return teams
+
+def process_all_data(layout="groups", incremental=True, manifest_path=MANIFEST_PATH, instr=NULL, storage=None,
+                     chunk_impacts=1, workers=None, read_threads=8, queue_size=64, sample_rate=None):
+    """
+    Processes every team and session under data/. With layout="consolidated"
+    each team's H5 files are written in the consolidated layout (see consolidated_h5),
+    with layout="canonical" in the consolidated layout storing only the raw
+    profile, augmented at load time by impact_loader, and with layout="ragged" in the
+    consolidated layout storing the CNN inputs without their padding.
+
+    The data folders are indexed once up front (see index_sessions). Each team's impacts
+    then run through a pipeline (see io_pipeline): read_threads threads hash and read the
+    trajectories, workers processes compute the UBrIC scores and permutations, and this
+    process writes them to the H5 files in metadata order, so reads, computation and
+    writes overlap. workers=0 computes in this process.
+
+    With incremental=True, a manifest of content hashes (see manifest.py) is used to
+    only process new or changed impacts and to remove impacts that are no longer in
+    the data. The manifest is saved every CHECKPOINT_EVERY impacts, so an interrupted
+    run resumes where it stopped.
+
+    Pass an enabled Instrumentation as instr to time every stage and count processed,
+    unchanged, missing, failed and id-less impacts per team and session.
+
+    storage and chunk_impacts set the dtype, filters and chunking of the profiles (see
+    h5_storage). Existing consolidated files keep their settings, rewrite them with
+    consolidated_h5.repack_h5 to change them.
+
+    With sample_rate, every profile is resampled to that rate before it is augmented
+    (see build_impact). The rate is recorded in the manifest, so changing it reprocesses
+    every impact.
+    """
     root_data_dir = "data"
     unknown_folders = []
-    
-    # Iterate over team directories
-    for team_name in os.listdir(root_data_dir):
-        team_path = os.path.join(root_data_dir, team_name)
-        if not os.path.isdir(team_path) or team_name == 'metadata' or team_name.startswith('.'):
-            continue
-            
-        print(f"Processing Team: {team_name}")
-        
-        team_metadata_rows = []
-        
-        # Iterate over session directories within team directory
-        for session_name in os.listdir(team_path):
-            session_path = os.path.join(team_path, session_name)
-            if not os.path.isdir(session_path) or session_name.startswith('.'):
-                continue
-                
-            # Determine if Training or Game
-            session_type = None
-            if any(x in session_name for x in ['_P', '_practice', '_T', '_Training']):
-                session_type = 'Training'
-            elif any(x in session_name for x in ['_game', '_G']):
-                session_type = 'Game'
-            
+    open_files = {}
+    writers = {}
+
+    params = {"cnn_length": CNN_LENGTH, "target_idx": TARGET_IDX, "layout": layout}
+    # Only when set, so manifests of runs at the recorded rate stay valid
+    if sample_rate is not None:
+        params["sample_rate"] = sample_rate
+    manifest = load_manifest(manifest_path) if incremental else {}
+    verified = set()
+    pending = []
+    augment = layout not in ("canonical", "ragged")
+
+    def checkpoint():
+        # Only record impacts once they are on disk
+        with instr.stage("h5_flush"):
+            for writer in writers.values():
+                writer.flush()
+            for hf in open_files.values():
+                hf.flush()
+        for h5_path, group_name, content_hash in pending:
+            manifest.setdefault(h5_path, {})[group_name] = content_hash
+        pending.clear()
+        if incremental:
+            with instr.stage("manifest_save"):
+                save_manifest(manifest, manifest_path)
+
+    def team_impacts(team, session_counts, seen, incomplete):
+        # Sets up each session in turn and yields its impacts, lazily as the pipeline asks for them
+        for session in team["sessions"]:
+            session_name = session["name"]
+            session_type = session["type"]
             if not session_type:
-                # Log unknown folders (skipping trajectories folder if checking session name)
-                # But wait, session names are directories like "2025-05-12_Game_1_vs_Merivale"
-                # If checking subdirs of team_path, they should be sessions.
-                # However, ensure we don't log 'training.h5' or other files, but we check isdir above.
                 print(f"Skipping unknown session type: {session_name}")
-                unknown_folders.append(os.path.join(team_name, session_name))
+                unknown_folders.append(os.path.join(team["name"], session_name))
                 continue
-                
-            h5_path = get_h5_path(team_path, team_name, session_type)
+
+            h5_path = get_h5_path(team["path"], team["name"], session_type)
             if not h5_path:
                 continue
-                
+
             print(f"  Session: {session_name} ({session_type}) -> {h5_path}")
-            
-            # Find metadata CSV
-            metadata_file = None
-            for f in os.listdir(session_path):
-                if f.endswith('.csv') and f != 'trajectories':
-                    metadata_file = os.path.join(session_path, f)
-                    break
-            
+
+            metadata_file = session["metadata_file"]
             if not metadata_file:
-                print(f"    No metadata CSV found in {session_path}")
+                print(f"    No metadata CSV found in {session['path']}")
+                incomplete.add(h5_path)
                 continue
-                
+
             try:
-                metadata_df = pd.read_csv(metadata_file)
+                with instr.stage("metadata_read"):
+                    metadata_df = pd.read_csv(metadata_file)
             except Exception as e:
                 print(f"    Error reading metadata {metadata_file}: {e}")
+                incomplete.add(h5_path)
                 continue
-            
-            # Look for trajectories folder
-            trajectories_dir = os.path.join(session_path, "trajectories")
-            if not os.path.exists(trajectories_dir):
-                print(f"    No trajectories folder in {session_path}")
+
+            trajectories_dir = session["trajectories_dir"]
+            if trajectories_dir is None:
+                print(f"    No trajectories folder in {session['path']}")
+                incomplete.add(h5_path)
                 continue
-                
+
+            # Parse new or changed trajectory CSVs into the binary cache once
+            try:
+                with instr.stage("trajectory_ingest"):
+                    ingest_directory(trajectories_dir, file_keys=session["trajectory_files"])
+            except OSError as e:
+                print(f"    Could not write trajectory cache for {trajectories_dir}: {e}")
+
             # Normalize column names for easier access
             metadata_df.columns = [c.strip() for c in metadata_df.columns]
-            
+
             # Map columns to standard names if possible
             # Prefer 'Id' > '_id'
             id_col = 'Id' if 'Id' in metadata_df.columns else ('_id' if '_id' in metadata_df.columns else None)
-            
+
             # Prefer 'Pred' > 'prediction'
             pred_col = 'Pred' if 'Pred' in metadata_df.columns else ('prediction' if 'prediction' in metadata_df.columns else None)
-            
+
             # Prefer 'Impact Location' > 'impact_location'
             loc_col = 'Impact Location' if 'Impact Location' in metadata_df.columns else ('impact_location' if 'impact_location' in metadata_df.columns else None)
-            
+
             # Prefer 'UBrIC' > 'ubric'
             ubric_col = 'UBrIC' if 'UBrIC' in metadata_df.columns else ('ubric' if 'ubric' in metadata_df.columns else None)
 
             if not id_col:
                 print(f"    No ID column found in metadata {metadata_file}")
+                incomplete.add(h5_path)
                 continue
 
-            # Process each impact in metadata
-            count = 0
+            # Drop manifest entries for impacts that are no longer in the H5 file. Impacts
+            # in flight belong to other H5 files, as this runs before the first of this one.
+            if incremental and h5_path not in verified:
+                with instr.stage("manifest_verify"):
+                    stored = writers[h5_path].rows if h5_path in writers else list_impact_names(h5_path)
+                manifest[h5_path] = {g: h for g, h in manifest.get(h5_path, {}).items() if g in stored}
+                verified.add(h5_path)
+
+            session_counts[session_name] = {"processed": 0, "unchanged": 0}
+            # iterrows, as the impact hashes and the aggregated CSV depend on its row values
             for idx, row in metadata_df.iterrows():
                 impact_id = row.get(id_col)
                 if pd.isna(impact_id):
+                    instr.count(team["name"], session_name, "no_id")
                     continue
-                
+
                 impact_id = str(impact_id).strip()
-                trajectory_file = os.path.join(trajectories_dir, f"{impact_id}.csv")
-                
-                if os.path.exists(trajectory_file):
-                    pred = row.get(pred_col) if pred_col else np.nan
-                    impact_loc = row.get(loc_col) if loc_col else 'Unknown'
-                    ubric_val = row.get(ubric_col) if ubric_col else np.nan
-                    
-                    if process_file(trajectory_file, h5_path, pred, impact_loc, ubric_val):
-                        count += 1
-                        team_metadata_rows.append(row)
-                else:
+                if f"{impact_id}.csv" not in session["trajectory_files"]:
                     # Optional: print missing files
-                    # print(f"    Trajectory file not found: {trajectory_file}")
-                    pass
-            print(f"    Processed {count} impacts")
-        
-        # Save aggregated metadata for the team
-        if team_metadata_rows:
-            team_agg_df = pd.DataFrame(team_metadata_rows)
-            agg_csv_path = os.path.join(team_path, f"{team_name}_all_impacts.csv")
-            team_agg_df.to_csv(agg_csv_path, index=False)
-            print(f"  Saved aggregated metadata to {agg_csv_path}")
+                    # print(f"    Trajectory file not found: {impact_id}.csv")
+                    instr.count(team["name"], session_name, "missing")
+                    continue
+
+                seen.setdefault(h5_path, set()).add(impact_id)
+                yield {
+                    "session": session_name,
+                    "h5_path": h5_path,
+                    "group_name": impact_id,
+                    "trajectory_file": os.path.join(trajectories_dir, f"{impact_id}.csv"),
+                    "pred": row.get(pred_col) if pred_col else np.nan,
+                    "impact_location": row.get(loc_col) if loc_col else 'Unknown',
+                    "ubric_hitiq": row.get(ubric_col) if ubric_col else np.nan,
+                    "row": row,
+                }
+
+    def read_impact(task):
+        # Reader thread: hash the impact and, unless it is unchanged, read its trajectory
+        content_hash = None
+        if incremental:
+            with instr.stage("hash"):
+                content_hash = impact_hash(task["trajectory_file"], task["row"], params)
+            if manifest.get(task["h5_path"], {}).get(task["group_name"]) == content_hash:
+                return content_hash, None
+        with instr.stage("read_trajectory"):
+            time, profile = read_trajectory(task["trajectory_file"])
+        profiled = instr.is_profile_target(task["trajectory_file"])
+        return content_hash, (task["group_name"], time, profile, task["pred"], task["impact_location"],
+                              task["ubric_hitiq"], augment, sample_rate, instr.enabled, profiled)
+
+    def write_impact_to(h5_path, impact):
+        if h5_path not in open_files:
+            open_files[h5_path] = h5py.File(h5_path, "a")
+            # The manifest covers the rate, so every impact of the file is rewritten when it changes
+            record_sample_rate(open_files[h5_path], sample_rate, replace=True)
+            if layout in ("consolidated", "canonical", "ragged"):
+                profile_store = "augmented" if layout == "consolidated" else layout
+                writers[h5_path] = ConsolidatedWriter(
+                    open_files[h5_path], cnn_length=CNN_LENGTH, chunk_impacts=chunk_impacts,
+                    profile_store=profile_store, storage=storage
+                )
+        if h5_path in writers:
+            writers[h5_path].add(impact)
+        else:
+            write_impact(open_files[h5_path], impact, verbose=False, storage=storage)
+
+    # spawn, as the reader threads are already running when the pool starts its processes
+    pool = ProcessPoolExecutor(workers, get_context("spawn")) if workers != 0 else None
+    try:
+        for team in index_sessions(root_data_dir):
+            team_name = team["name"]
+            team_path = team["path"]
+            print(f"Processing Team: {team_name}")
+
+            team_metadata_rows = []
+            session_counts = {}
+            seen = {}
+            incomplete = set()
+
+            impacts = team_impacts(team, session_counts, seen, incomplete)
+            for task, content_hash, result, error in pipelined(impacts, read_impact, compute_impact, pool,
+                                                                read_threads, queue_size):
+                session_name = task["session"]
+                counts = session_counts[session_name]
+                if error is not None:
+                    print(f"Error processing {task['trajectory_file']}: {error}")
+                    instr.failure(task["trajectory_file"], error)
+                    instr.count(team_name, session_name, "failed")
+                    continue
+                if result is None:
+                    counts["unchanged"] += 1
+                    instr.count(team_name, session_name, "unchanged")
+                    team_metadata_rows.append(task["row"])
+                    continue
+
+                impact, stages, profile_stats = result
+                instr.merge(stages, profile_stats)
+                try:
+                    with instr.stage("h5_write"):
+                        write_impact_to(task["h5_path"], impact)
+                except Exception as e:
+                    print(f"Error processing {task['trajectory_file']}: {e}")
+                    instr.failure(task["trajectory_file"], e)
+                    instr.count(team_name, session_name, "failed")
+                    continue
+                counts["processed"] += 1
+                instr.count(team_name, session_name, "processed")
+                team_metadata_rows.append(task["row"])
+                if incremental:
+                    pending.append((task["h5_path"], task["group_name"], content_hash))
+                    if len(pending) >= CHECKPOINT_EVERY:
+                        checkpoint()
+
+            for session_name, counts in session_counts.items():
+                print(f"    {session_name}: processed {counts['processed']} impacts, {counts['unchanged']} unchanged")
+
+            # Flush and close this team's files
+            checkpoint()
+            with instr.stage("h5_flush"):
+                for h5_path in list(open_files):
+                    if h5_path in writers:
+                        writers.pop(h5_path).close()
+                    open_files.pop(h5_path).close()
+
+            # Remove impacts that are no longer in the data, unless a session could not be read
+            if incremental:
+                for session_type in ['Training', 'Game']:
+                    h5_path = get_h5_path(team_path, team_name, session_type)
+                    if h5_path in incomplete or not os.path.exists(h5_path):
+                        continue
+                    current = seen.get(h5_path, set())
+                    with instr.stage("remove_stale"):
+                        stale = remove_stale_impacts(h5_path, current)
+                    if stale:
+                        print(f"  Removed {len(stale)} stale impacts from {h5_path}")
+                    manifest[h5_path] = {g: h for g, h in manifest.get(h5_path, {}).items() if g in current}
+                checkpoint()
+
+            # Save aggregated metadata for the team
+            if team_metadata_rows:
+                team_agg_df = pd.DataFrame(team_metadata_rows)
+                agg_csv_path = os.path.join(team_path, f"{team_name}_all_impacts.csv")
+                team_agg_df.to_csv(agg_csv_path, index=False)
+                print(f"  Saved aggregated metadata to {agg_csv_path}")
+    finally:
+        for writer in writers.values():
+            writer.close()
+        for hf in open_files.values():
+            hf.close()
+        if pool is not None:
+            pool.shutdown(cancel_futures=True)
 
     # Save unknown folders log
     if unknown_folders:
@@ -224,4 +544,34 @@ def process_all_data():
         print(f"Logged {len(unknown_folders)} unknown folders to data/unknown_folders.txt")
 
 if __name__ == "__main__":
-    process_all_data()
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Process all teams and sessions for CNN input")
+    parser.add_argument("--layout", type=str, default="groups", choices=["groups", "consolidated", "canonical", "ragged"])
+    parser.add_argument("--full", action="store_true", help="Reprocess every impact and ignore the manifest")
+    parser.add_argument("--report", type=str, default=None, help="Write a JSON run report with stage timings and counters")
+    parser.add_argument("--profile_impact", type=str, default=None, help="cProfile the UBrIC and augmentation of this impact (Id or trajectory path) into the report")
+    parser.add_argument("--sample_rate", type=float, default=None, help="Resample every profile to this rate [Hz] before augmenting it")
+    parser.add_argument("--workers", type=int, default=None, help="Processes computing the impacts, defaults to the CPU count; 0 computes in this process")
+    parser.add_argument("--read_threads", type=int, default=8, help="Threads hashing and reading trajectories")
+    parser.add_argument("--queue_size", type=int, default=64, help="Impacts queued for reading and for computing")
+    add_storage_arguments(parser)
+
+    args = parser.parse_args()
+    if args.profile_impact and not args.report:
+        parser.error("--profile_impact requires --report")
+
+    instr = Instrumentation(profile_target=args.profile_impact) if args.report else NULL
+    try:
+        process_all_data(
+            args.layout, incremental=not args.full, instr=instr,
+            storage=storage_from_args(args), chunk_impacts=args.chunk_impacts,
+            workers=args.workers, read_threads=args.read_threads, queue_size=args.queue_size,
+            sample_rate=args.sample_rate
+        )
+    finally:
+        # Also report runs that were interrupted
+        if args.report:
+            instr.write(args.report)
+            print(instr.summary())
+            print(f"Wrote run report to {args.report}")
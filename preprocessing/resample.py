@@ -0,0 +1,283 @@
+"""
+Resampling of angular acceleration profiles to a canonical sample rate.
+
+Mouthguards with different firmware record at different rates, so the fixed-length CNN
+input covers a different duration per device. Profiles are resampled before the conjugate
+transform and shift_and_pad, so every CNN input has the same rate:
+
+    time, profile = resample_profile(time, profile, 1000.0)
+
+resample_batch groups a batch of impacts by source rate and resamples each group with one
+polyphase filter pass (scipy.signal.upfirdn). The anti-aliasing filter of every rate
+ratio is designed once and cached. Profiles are extended with their edge values rather
+than zeros, so the resampled edges match the constant padding of shift_and_pad; the
+result equals scipy.signal.resample_poly(..., padtype="edge") per impact.
+
+The rate a preprocessed HDF5 file was written at is recorded in its "sample_rate"
+attribute (see record_sample_rate), and the rate a model was trained at in a JSON file
+next to it (see write_model_sample_rate), so scoring and serving can resample to the same
+rate and refuse a rate the model was not trained at (see resolve_sample_rate).
+"""
+
+import json
+import math
+import os
+from fractions import Fraction
+from functools import lru_cache
+
+import numpy as np
+from scipy.signal import firwin, upfirdn
+
+# Largest denominator of the up / down ratio approximating target / source rate
+MAX_DENOMINATOR = 1000
+SAMPLE_RATE_ATTR = "sample_rate"
+
+
+def sample_rate(time):
+    """
+    Returns the sample rate of a uniformly sampled time vector, rounded so float noise
+    in the timestamps maps to the same rate, or None if the sampling is not uniform.
+    """
+    dts = np.diff(time)
+    if len(dts) == 0 or not np.allclose(dts, dts[0], rtol=1e-6, atol=0):
+        return None
+    return float(f"{1 / np.mean(dts):.9g}")
+
+
+def resample_factors(source_rate, target_rate, max_denominator=MAX_DENOMINATOR):
+    """
+    Returns the (up, down) factors of the polyphase filter from source_rate to target_rate.
+    """
+    ratio = Fraction(target_rate / source_rate).limit_denominator(max_denominator)
+    return ratio.numerator, ratio.denominator
+
+
+@lru_cache(maxsize=None)
+def polyphase_filter(up, down):
+    """
+    Designs the anti-aliasing filter of a rate ratio, as resample_poly does (Kaiser
+    window, beta 5), zero-padded so the output samples sit at the filter center.
+
+    Returns:
+        tuple: Filter taps, number of leading output samples to drop and number of input
+            samples of edge padding on either side.
+    """
+    max_rate = max(up, down)
+    half_len = 10 * max_rate
+    h = firwin(2 * half_len + 1, 1.0 / max_rate, window=("kaiser", 5.0)) * up
+    n_pre_pad = down - half_len % down
+    h = np.concatenate([np.zeros(n_pre_pad), h])
+    # Whole multiples of down, so the padding shifts the output by whole samples
+    pad = down * (math.ceil(len(h) / (up * down)) + 1)
+    n_pre_remove = (half_len + n_pre_pad) // down + pad * up // down
+    return h, n_pre_remove, pad
+
+
+def _resample_group(profiles, lengths, up, down):
+    # profiles is G x N x 3 with lengths valid samples each
+    h, n_pre_remove, pad = polyphase_filter(up, down)
+    G, N, C = profiles.shape
+
+    # Edge padding as a gather: sample j of the extended profile is clip(j - pad, 0, length - 1)
+    src = np.arange(N + 2 * pad) - pad
+    src = np.clip(src[np.newaxis, :], 0, (lengths - 1)[:, np.newaxis])
+    extended = np.take_along_axis(profiles, src[..., np.newaxis], axis=1)
+
+    n_out = -(-lengths * up // down)
+    filtered = upfirdn(h, extended, up, down, axis=1)
+    return filtered[:, n_pre_remove:n_pre_remove + n_out.max()], n_out
+
+
+def resample_batch(profiles, rates, target_rate, lengths=None):
+    """
+    Resamples a batch of impacts to target_rate, grouped by source rate.
+
+    Args:
+        profiles (np.ndarray): B x N x 3 array of angular acceleration profiles.
+        rates (np.ndarray): Source sample rate of every impact (B,).
+        target_rate (float): Canonical sample rate [Hz].
+        lengths (np.ndarray): Number of valid samples per impact (B,), for ragged
+            batches padded to a common N. Defaults to N.
+
+    Returns:
+        tuple: B x N' x 3 resampled profiles, zero past each impact's length, and the
+            resampled length of every impact (B,).
+    """
+    profiles = np.asarray(profiles, dtype=float)
+    B, N, C = profiles.shape
+    lengths = np.full(B, N) if lengths is None else np.asarray(lengths, dtype=int)
+    factors = [resample_factors(rate, target_rate) for rate in rates]
+
+    groups = {}
+    for b, factor in enumerate(factors):
+        groups.setdefault(factor, []).append(b)
+
+    new_lengths = np.array([-(-length * up // down) for length, (up, down) in zip(lengths, factors)], dtype=int)
+    out = np.zeros((B, new_lengths.max() if B else 0, C))
+    for (up, down), idx in groups.items():
+        idx = np.asarray(idx)
+        # Only as long as the longest impact of the group
+        n_max = lengths[idx].max()
+        if up == down:
+            out[idx, :n_max] = profiles[idx, :n_max]
+            continue
+        resampled, n_out = _resample_group(profiles[idx, :n_max], lengths[idx], up, down)
+        out[idx, :resampled.shape[1]] = resampled
+    out[np.arange(out.shape[1]) >= new_lengths[:, np.newaxis]] = 0.0
+    return out, new_lengths
+
+
+def resample_profile(time, profile, target_rate):
+    """
+    Resamples one impact to target_rate. Non-uniformly sampled impacts are linearly
+    interpolated onto a uniform time grid instead.
+
+    Args:
+        time (np.ndarray): Time vector (N,) [s].
+        profile (np.ndarray): N x 3 angular acceleration profile.
+        target_rate (float): Canonical sample rate [Hz].
+
+    Returns:
+        tuple: Resampled time vector and profile, starting at time[0].
+    """
+    rate = sample_rate(time)
+    if rate is None:
+        new_time = time[0] + np.arange(int(np.floor((time[-1] - time[0]) * target_rate)) + 1) / target_rate
+        new_profile = np.column_stack([np.interp(new_time, time, profile[:, c]) for c in range(profile.shape[1])])
+        return new_time, new_profile
+
+    up, down = resample_factors(rate, target_rate)
+    if up == down:
+        return time, profile
+    resampled, lengths = resample_batch(profile[np.newaxis], [rate], target_rate)
+    return time[0] + np.arange(lengths[0]) / target_rate, resampled[0, :lengths[0]]
+
+
+def resample_padded(times, profiles, target_rate, lengths=None):
+    """
+    Resamples a batch of impacts padded to a common length, resample_batch for the
+    uniformly sampled ones and resample_profile for the others.
+
+    Args:
+        times (np.ndarray): B x N time vectors [s].
+        profiles (np.ndarray): B x N x 3 angular acceleration profiles.
+        target_rate (float): Canonical sample rate [Hz].
+        lengths (np.ndarray): Number of valid samples per impact (B,), defaults to N.
+
+    Returns:
+        tuple: B x N' x 3 resampled profiles, zero past each impact's length, and the
+            resampled length of every impact (B,).
+    """
+    profiles = np.asarray(profiles, dtype=float)
+    B, N, C = profiles.shape
+    lengths = np.full(B, N) if lengths is None else np.asarray(lengths, dtype=int)
+    rates = [sample_rate(times[b, :lengths[b]]) for b in range(B)]
+
+    uniform = [b for b in range(B) if rates[b] is not None]
+    resampled = {}
+    if uniform:
+        out, new_lengths = resample_batch(profiles[uniform], [rates[b] for b in uniform], target_rate, lengths[uniform])
+        resampled.update({b: out[i, :new_lengths[i]] for i, b in enumerate(uniform)})
+    for b in range(B):
+        if rates[b] is None:
+            resampled[b] = resample_profile(times[b, :lengths[b]], profiles[b, :lengths[b]], target_rate)[1]
+
+    new_lengths = np.array([len(resampled[b]) for b in range(B)], dtype=int)
+    out = np.zeros((B, new_lengths.max() if B else 0, C))
+    for b in range(B):
+        out[b, :new_lengths[b]] = resampled[b]
+    return out, new_lengths
+
+
+def _rate_name(rate):
+    return "the recorded rate" if rate is None else f"{rate:g} Hz"
+
+
+def h5_sample_rate(hf):
+    """
+    Returns the rate [Hz] the impacts of an open HDF5 file were resampled to, or None if
+    they keep the recorded rate.
+    """
+    rate = hf.attrs.get(SAMPLE_RATE_ATTR)
+    return None if rate is None else float(rate)
+
+
+def record_sample_rate(hf, rate, replace=False):
+    """
+    Records the rate [Hz] the impacts written to an open HDF5 file are resampled to, None
+    for the recorded rate. Raises a ValueError if the file already holds impacts at
+    another rate, unless replace is set because every impact is rewritten.
+    """
+    from consolidated_h5 import is_consolidated
+
+    current = h5_sample_rate(hf)
+    n_impacts = hf["name"].shape[0] if is_consolidated(hf) else len(hf)
+    if current != rate and n_impacts and not replace:
+        print(f"{hf.filename} holds impacts at {_rate_name(current)}, not {_rate_name(rate)}")
+        raise ValueError(f"Sample rate mismatch in {hf.filename}: {current} != {rate}")
+    if rate is None:
+        hf.attrs.pop(SAMPLE_RATE_ATTR, None)
+    else:
+        hf.attrs[SAMPLE_RATE_ATTR] = float(rate)
+
+
+def h5_paths_sample_rate(h5_paths):
+    """
+    Returns the common rate [Hz] of some preprocessed HDF5 files, None for the recorded
+    rate. Raises a ValueError if they were resampled to different rates.
+    """
+    import h5py
+
+    rates = {}
+    for h5_path in h5_paths:
+        with h5py.File(h5_path, "r") as hf:
+            rates[h5_path] = h5_sample_rate(hf)
+    if len(set(rates.values())) > 1:
+        print("HDF5 files at different sample rates:")
+        for h5_path, rate in rates.items():
+            print(f"  {h5_path}: {_rate_name(rate)}")
+        raise ValueError("HDF5 files at different sample rates")
+    return next(iter(rates.values()), None)
+
+
+def model_metadata_path(model_path):
+    """
+    Returns the JSON file next to a model that holds its sample rate.
+    """
+    return f"{model_path}.json"
+
+
+def read_model_sample_rate(model_path):
+    """
+    Returns the rate [Hz] a model was trained at, or None if it was trained at the
+    recorded rate or its rate was not recorded.
+    """
+    metadata_path = model_metadata_path(model_path)
+    if not os.path.exists(metadata_path):
+        return None
+    with open(metadata_path) as f:
+        return json.load(f).get(SAMPLE_RATE_ATTR)
+
+
+def write_model_sample_rate(model_path, rate):
+    """
+    Records the rate [Hz] a model was trained at, None for the recorded rate.
+    """
+    with open(model_metadata_path(model_path), "w") as f:
+        json.dump({SAMPLE_RATE_ATTR: rate}, f, indent=1)
+
+
+def resolve_sample_rate(model_path, rate=None):
+    """
+    Returns the rate [Hz] to resample impacts to before a model scores them: the rate it
+    was trained at, or rate if that was not recorded. Raises a ValueError if rate differs
+    from the recorded one.
+    """
+    metadata_path = model_metadata_path(model_path)
+    if not os.path.exists(metadata_path):
+        return rate
+    trained = read_model_sample_rate(model_path)
+    if rate is not None and rate != trained:
+        print(f"{model_path} was trained at {_rate_name(trained)}, not {_rate_name(rate)}")
+        raise ValueError(f"Sample rate mismatch for {model_path}: {rate} != {trained}")
+    return trained
@@ -0,0 +1,331 @@
+"""
+Real-time impact detection on a continuous angular acceleration stream.
+
+Samples are pushed in chunks as they arrive from the sensor and kept in a ring buffer. An
+impact starts when the resultant (as in resultant_val) exceeds a threshold, and the event
+keeps up to pre_samples samples from before the trigger, but never reaches back into the
+previously emitted impact, so close impacts are scored separately. Once
+cnn_length - target_idx - 1 samples have arrived after the highest peak of the event, the
+window shift_and_pad centers on that peak is complete and the impact is emitted straight
+away.
+
+With sample_rate, every impact is resampled to that rate before its CNN inputs are
+computed, as in preprocessing, and pre_samples and the window after the peak are counted
+at that rate, by sample time, so streams at any rate give the same CNN window.
+
+Angular velocity and the UBrIC peaks are updated incrementally with a running trapezoid
+as samples arrive, in the same operation order as cumulative_trapezoid, so the emitted
+UBrIC equals calculate_ubric_from_profile on the impact segment exactly and scoring an
+impact at emission is O(1).
+
+    python preprocessing/stream_detector.py --csv session_stream.csv --chunk_size 100
+"""
+
+import time as wallclock
+
+import numpy as np
+from augment_batch import augment_batch
+from calculate_ubric import ubric_from_peaks
+from resample import resample_profile
+
+# Resultant angular acceleration that starts an impact [rad/s^2]
+DEFAULT_THRESHOLD = 1000.0
+
+
+class StreamingImpactDetector:
+    """
+    Detects impacts in a continuous stream and scores them as soon as they are complete.
+
+    Args:
+        threshold (float): Resultant angular acceleration that starts an impact.
+        rearm_threshold (float): Resultant below which a new impact can start after one
+            was emitted, defaults to threshold.
+        target_idx (int): Index the peak is shifted to by shift_and_pad.
+        cnn_length (int): Length of the CNN input window.
+        pre_samples (int): Samples before the trigger kept in the impact, defaults to target_idx.
+        max_event_samples (int): Samples after which an impact is emitted even if its peak
+            keeps rising, defaults to 4 * cnn_length.
+        compute_inputs (bool): Compute the six CNN inputs of every impact with augment_batch.
+        sample_rate (float): Resample every impact to this rate [Hz] before computing its
+            CNN inputs, keeps the stream rate by default. pre_samples and the samples after
+            the peak are then counted at this rate; max_event_samples stays at the stream rate.
+    """
+
+    def __init__(self, threshold=DEFAULT_THRESHOLD, rearm_threshold=None, target_idx=1000, cnn_length=2000,
+                 pre_samples=None, max_event_samples=None, compute_inputs=True, sample_rate=None):
+        self.threshold = threshold
+        self.rearm_threshold = threshold if rearm_threshold is None else rearm_threshold
+        self.target_idx = target_idx
+        self.cnn_length = cnn_length
+        self.post_samples = cnn_length - target_idx - 1
+        self.pre_samples = target_idx if pre_samples is None else pre_samples
+        self.max_event_samples = 4 * cnn_length if max_event_samples is None else max_event_samples
+        self.compute_inputs = compute_inputs
+        self.sample_rate = sample_rate
+
+        # Longest chunk written to the ring at once, so an event never overwrites itself
+        self.max_chunk = cnn_length
+        self.capacity = self.pre_samples + self.max_event_samples + self.max_chunk
+        self.ring = np.zeros((self.capacity, 4))
+        self.n_samples = 0
+        # Last sample of the previously emitted impact
+        self.last_end = -1
+        self.armed = True
+        self.event = None
+
+    def push(self, time, profile):
+        """
+        Adds samples to the stream.
+
+        Args:
+            time (np.ndarray): Time of each sample (n,), increasing.
+            profile (np.ndarray): n x 3 angular acceleration.
+
+        Returns:
+            list: Impacts completed by these samples, see _emit.
+        """
+        arrival = wallclock.perf_counter()
+        time = np.asarray(time, dtype=float)
+        profile = np.asarray(profile, dtype=float).reshape(-1, 3)
+        impacts = []
+        for start in range(0, len(time), self.max_chunk):
+            self._push_chunk(time[start:start + self.max_chunk], profile[start:start + self.max_chunk], arrival, impacts)
+        return impacts
+
+    def flush(self):
+        """
+        Ends the stream, emitting an impact in progress with the samples it has.
+
+        Returns:
+            list: The impact in progress, if any.
+        """
+        if self.event is None:
+            return []
+        return [self._emit(self.n_samples - 1, wallclock.perf_counter())]
+
+    def _push_chunk(self, time, profile, arrival, impacts):
+        g0 = self.n_samples
+        rows = (g0 + np.arange(len(time))) % self.capacity
+        self.ring[rows, 0] = time
+        self.ring[rows, 1:] = profile
+        self.n_samples += len(time)
+
+        # Same operation order as resultant_val
+        res = np.sqrt(profile[:, 0] ** 2 + profile[:, 1] ** 2 + profile[:, 2] ** 2)
+
+        i = 0
+        while i < len(time):
+            if self.event is not None:
+                i = self._advance_event(time, profile, res, g0, i, arrival, impacts)
+            elif not self.armed:
+                below = np.flatnonzero(res[i:] < self.rearm_threshold)
+                if not len(below):
+                    return
+                i += below[0]
+                self.armed = True
+            else:
+                above = np.flatnonzero(res[i:] > self.threshold)
+                if not len(above):
+                    return
+                i += above[0]
+                self._start_event(g0 + i)
+
+    def _start_event(self, trigger):
+        earliest = max(self.n_samples - self.capacity, self.last_end + 1, 0)
+        if self.sample_rate is None:
+            start = max(trigger - self.pre_samples, earliest)
+        else:
+            # Skip the samples more than pre_samples CNN samples before the trigger
+            times = self.ring[np.arange(earliest, trigger) % self.capacity, 0]
+            offsets = np.round((self.ring[trigger % self.capacity, 0] - times) * self.sample_rate)
+            start = earliest + int(np.count_nonzero(offsets > self.pre_samples))
+        self.event = {
+            "start": start,
+            "peak_idx": trigger,
+            "peak_val": -np.inf,
+            "vel": None,
+            "a_max": None,
+            "w_max": None,
+            "t_prev": None,
+            "a_prev": None,
+        }
+        if start < trigger:
+            pre = self.ring[np.arange(start, trigger) % self.capacity]
+            self._integrate(pre[:, 0], pre[:, 1:])
+
+    def _advance_event(self, time, profile, res, g0, i, arrival, impacts):
+        event = self.event
+        r = res[i:]
+        idx = g0 + i + np.arange(len(r))
+
+        # Running peak of the event at every sample, first occurrence as in np.argmax
+        running = np.maximum.accumulate(np.concatenate([[event["peak_val"]], r]))[:-1]
+        peak_at = np.maximum.accumulate(np.where(r > running, idx, event["peak_idx"]))
+        if self.sample_rate is None:
+            after_peak = idx - peak_at
+        else:
+            # One sample of slack, as the peak may fall between two resampled samples
+            after_peak = np.round((time[i:] - self.ring[peak_at % self.capacity, 0]) * self.sample_rate) - 1
+        done = (after_peak >= self.post_samples) | (idx - event["start"] + 1 >= self.max_event_samples)
+        stop = int(np.argmax(done)) + 1 if done.any() else len(r)
+
+        self._integrate(time[i:i + stop], profile[i:i + stop])
+        event["peak_idx"] = int(peak_at[stop - 1])
+        event["peak_val"] = max(event["peak_val"], r[:stop].max())
+
+        if done.any():
+            impacts.append(self._emit(int(idx[stop - 1]), arrival))
+            self.armed = False
+        return i + stop
+
+    def _integrate(self, time, acc):
+        # Running trapezoid, matching cumulative_trapezoid(acc, time, initial=0) sample for sample
+        event = self.event
+        if len(time) == 0:
+            return
+        if event["t_prev"] is None:
+            event["vel"] = np.zeros(3)
+            event["a_max"] = np.abs(acc[0])
+            event["w_max"] = np.zeros(3)
+            event["t_prev"], event["a_prev"] = time[0], acc[0]
+            time, acc = time[1:], acc[1:]
+            if len(time) == 0:
+                return
+
+        d = np.diff(np.concatenate([[event["t_prev"]], time]))
+        increments = d[:, np.newaxis] * (acc + np.concatenate([event["a_prev"][np.newaxis], acc[:-1]])) / 2.0
+        vel = np.cumsum(np.concatenate([event["vel"][np.newaxis], increments]), axis=0)[1:]
+
+        event["a_max"] = np.maximum(event["a_max"], np.abs(acc).max(axis=0))
+        event["w_max"] = np.maximum(event["w_max"], np.abs(vel).max(axis=0))
+        event["vel"] = vel[-1]
+        event["t_prev"], event["a_prev"] = time[-1], acc[-1]
+
+    def _emit(self, end, arrival):
+        """
+        Emits the event ending at sample end (inclusive).
+
+        Returns:
+            dict: start_time, peak_time, peak_resultant, ubric_score, the time and n x 3
+                profile of the impact segment, its 6 x 3 x cnn_length cnn_inputs (None if
+                compute_inputs is off) and the latency in seconds from the arrival of the
+                completing samples to the score.
+        """
+        event = self.event
+        self.event = None
+        self.last_end = end
+        segment = self.ring[np.arange(event["start"], end + 1) % self.capacity]
+
+        ubric_score = ubric_from_peaks(event["a_max"][np.newaxis], event["w_max"][np.newaxis])[0]
+        cnn_inputs = None
+        if self.compute_inputs:
+            profile = segment[:, 1:]
+            peak_idx = event["peak_idx"] - event["start"]
+            if self.sample_rate is not None:
+                time, profile = resample_profile(segment[:, 0], profile, self.sample_rate)
+                # Sample nearest the peak time, moved to the resampled peak it blurred into
+                peak_idx = min(int(round((segment[peak_idx, 0] - time[0]) * self.sample_rate)), len(time) - 1)
+                lo, hi = max(peak_idx - 2, 0), min(peak_idx + 3, len(time))
+                peak_idx = lo + int(np.argmax(np.sqrt((profile[lo:hi] ** 2).sum(axis=1))))
+            # Centered on the detected peak, which need not be the segment argmax
+            cnn_inputs = augment_batch(profile[np.newaxis], self.target_idx, self.cnn_length, peak_idx=[peak_idx])[0]
+
+        return {
+            "start_time": segment[0, 0],
+            "peak_time": self.ring[event["peak_idx"] % self.capacity, 0],
+            "peak_resultant": event["peak_val"],
+            "ubric_score": ubric_score,
+            "time": segment[:, 0],
+            "profile": segment[:, 1:],
+            "cnn_inputs": cnn_inputs,
+            "latency": wallclock.perf_counter() - arrival,
+        }
+
+
+def stream_from_socket(host, port, chunk_size):
+    """
+    Yields (time, profile) chunks from "time,ang_x,ang_y,ang_z" lines sent over TCP.
+    """
+    import socket
+
+    with socket.create_connection((host, port)) as sock, sock.makefile("r") as lines:
+        chunk = []
+        for line in lines:
+            values = line.strip().split(",")
+            if len(values) != 4:
+                continue
+            try:
+                chunk.append([float(v) for v in values])
+            except ValueError:
+                continue
+            if len(chunk) >= chunk_size:
+                data = np.array(chunk)
+                chunk = []
+                yield data[:, 0], data[:, 1:]
+        if chunk:
+            data = np.array(chunk)
+            yield data[:, 0], data[:, 1:]
+
+
+def stream_from_csv(csv_path, chunk_size, realtime=False):
+    """
+    Yields (time, profile) chunks of a recorded stream, optionally at its recorded rate.
+    """
+    from trajectory_store import read_trajectory
+
+    time, profile = read_trajectory(csv_path)
+    start = wallclock.perf_counter()
+    for i in range(0, len(time), chunk_size):
+        if realtime:
+            # Wait until the last sample of the chunk would have been recorded
+            delay = time[min(i + chunk_size, len(time)) - 1] - time[0] - (wallclock.perf_counter() - start)
+            if delay > 0:
+                wallclock.sleep(delay)
+        yield time[i:i + chunk_size], profile[i:i + chunk_size]
+
+
+if __name__ == "__main__":
+    import argparse
+
+    import pandas as pd
+
+    parser = argparse.ArgumentParser(description="Detect and score impacts in a continuous angular acceleration stream")
+    parser.add_argument("--csv", type=str, default=None, help="Recorded stream to replay")
+    parser.add_argument("--host", type=str, default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=None, help="Read time,ang_x,ang_y,ang_z lines from this TCP port")
+    parser.add_argument("--chunk_size", type=int, default=100)
+    parser.add_argument("--realtime", action="store_true", help="Replay the CSV at its recorded rate")
+    parser.add_argument("--threshold", type=float, default=DEFAULT_THRESHOLD)
+    parser.add_argument("--sample_rate", type=float, default=None,
+                        help="Resample every impact to this rate [Hz] before computing its CNN inputs")
+    parser.add_argument("--output", type=str, default=None, help="CSV of the detected impacts")
+
+    args = parser.parse_args()
+
+    if args.port is not None:
+        chunks = stream_from_socket(args.host, args.port, args.chunk_size)
+    elif args.csv is not None:
+        chunks = stream_from_csv(args.csv, args.chunk_size, args.realtime)
+    else:
+        parser.error("Either --csv or --port is required")
+
+    detector = StreamingImpactDetector(threshold=args.threshold, sample_rate=args.sample_rate)
+    detected = []
+    for time_chunk, profile_chunk in chunks:
+        for impact in detector.push(time_chunk, profile_chunk):
+            print(f"Impact at {impact['peak_time']:.4f} s: UBrIC {impact['ubric_score']:.4f}, "
+                  f"peak {impact['peak_resultant']:.0f} rad/s^2, latency {impact['latency'] * 1e3:.1f} ms")
+            detected.append(impact)
+    for impact in detector.flush():
+        print(f"Impact at {impact['peak_time']:.4f} s (end of stream): UBrIC {impact['ubric_score']:.4f}")
+        detected.append(impact)
+
+    if detected:
+        latencies = np.array([impact["latency"] for impact in detected]) * 1e3
+        print(f"Detected {len(detected)} impacts, latency p50 {np.percentile(latencies, 50):.1f} ms, "
+              f"p99 {np.percentile(latencies, 99):.1f} ms")
+    else:
+        print("No impacts detected")
+    if args.output:
+        columns = ["start_time", "peak_time", "peak_resultant", "ubric_score", "latency"]
+        pd.DataFrame([{key: impact[key] for key in columns} for impact in detected], columns=columns).to_csv(args.output, index=False)
@@ -0,0 +1,81 @@
+"""
+Synthetic rugby head impacts for benchmarks and load tests.
+
+Each impact is a smooth angular acceleration pulse (a raised half-sine, as used for
+idealized head impact pulses) along a random rotation axis, with a smaller opposite
+rebound and sensor noise. Durations, peaks and sample rates span the range of
+instrumented mouthguard recordings.
+"""
+
+import os
+
+import numpy as np
+import pandas as pd
+
+# Sample rates of common instrumented mouthguards [Hz]
+SAMPLE_RATES = [1000.0, 3200.0, 10000.0]
+
+
+def synthetic_impact(rng, n_samples=1000, fs=3200.0, peak=None, duration=None):
+    """
+    Generates one synthetic impact.
+
+    Args:
+        rng (np.random.Generator): Random generator.
+        n_samples (int): Number of samples.
+        fs (float): Sample rate [Hz].
+        peak (float): Peak resultant angular acceleration [rad/s^2], random in 1-12 krad/s^2 by default.
+        duration (float): Pulse duration [s], random in 5-30 ms by default.
+
+    Returns:
+        tuple: Time vector (N,) and N x 3 angular acceleration profile.
+    """
+    time = np.arange(n_samples) / fs
+    peak = rng.uniform(1e3, 12e3) if peak is None else peak
+    duration = rng.uniform(5e-3, 30e-3) if duration is None else duration
+    onset = rng.uniform(0.3, 0.5) * time[-1]
+
+    axis = rng.normal(size=3)
+    axis /= np.linalg.norm(axis)
+
+    # Main pulse followed by a rebound of opposite sign
+    phase = (time - onset) / duration
+    pulse = np.where((phase >= 0) & (phase <= 1), np.sin(np.pi * np.clip(phase, 0, 1)) ** 2, 0.0)
+    rebound_phase = (time - onset - duration) / (1.5 * duration)
+    rebound = np.where((rebound_phase >= 0) & (rebound_phase <= 1), np.sin(np.pi * np.clip(rebound_phase, 0, 1)) ** 2, 0.0)
+    signal = pulse - rng.uniform(0.2, 0.5) * rebound
+
+    profile = peak * signal[:, np.newaxis] * axis + rng.normal(0, 0.01 * peak, (n_samples, 3))
+    return time, profile
+
+
+def write_impact_csv(path, time, profile, rng=None):
+    """
+    Writes an impact in the trajectory CSV format (time, lin_x, lin_y, lin_z, ang_x, ang_y, ang_z).
+    Linear acceleration is a scaled copy of the angular pulse.
+    """
+    rng = np.random.default_rng(0) if rng is None else rng
+    linear = profile[:, rng.permutation(3)] * 0.01
+    pd.DataFrame({
+        "time": time,
+        "lin_x": linear[:, 0], "lin_y": linear[:, 1], "lin_z": linear[:, 2],
+        "ang_x": profile[:, 0], "ang_y": profile[:, 1], "ang_z": profile[:, 2],
+    }).to_csv(path, index=False)
+
+
+def write_impact_csvs(out_dir, n_impacts, n_samples=1000, fs=3200.0, seed=0):
+    """
+    Writes n_impacts synthetic impact CSVs to out_dir.
+
+    Returns:
+        list: Paths of the written CSVs.
+    """
+    rng = np.random.default_rng(seed)
+    os.makedirs(out_dir, exist_ok=True)
+    paths = []
+    for i in range(n_impacts):
+        path = os.path.join(out_dir, f"impact_{i:06d}.csv")
+        time, profile = synthetic_impact(rng, n_samples, fs)
+        write_impact_csv(path, time, profile, rng)
+        paths.append(path)
+    return paths
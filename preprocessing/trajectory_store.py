@@ -0,0 +1,209 @@
+"""
+Binary cache of raw trajectory CSVs and the single reader used by every stage.
+
+ingest_directory parses the trajectory CSVs of one directory (a session's trajectories
+folder, or the impact_data folder of the old structure) once and stores their time and
+angular acceleration columns in a hidden cache folder next to them:
+
+    .trajectory_cache/trajectories.npy   (total samples, 4) float64: time, ang_x, ang_y, ang_z
+    .trajectory_cache/index.json         file name -> [offset, length, size, mtime_ns]
+
+read_trajectory returns a slice of the memory-mapped cache when the CSV is unchanged
+since it was ingested, and parses the CSV otherwise, so a missing or stale cache only
+costs speed. Values are kept as float64, so every result is identical to parsing the CSV.
+"""
+
+import json
+import os
+
+import numpy as np
+import pandas as pd
+
+CACHE_DIRNAME = ".trajectory_cache"
+CACHE_VERSION = 1
+ANGULAR_COLUMNS = ["ang_x", "ang_y", "ang_z"]
+
+# Positions of the angular acceleration columns in files without a header match
+ANGULAR_POSITIONS = [4, 5, 6]
+
+# Opened caches, keyed by directory
+_stores = {}
+
+
+def parse_trajectory_csv(csv_path):
+    """
+    Parses a trajectory CSV.
+
+    The first column is the time. The angular acceleration columns are selected by
+    name (ang_x, ang_y, ang_z) and fall back to columns 4, 5 and 6.
+
+    Args:
+        csv_path (str): Path to the trajectory CSV.
+
+    Returns:
+        tuple: Time vector (N,) and N x 3 angular acceleration profile.
+    """
+    df = pd.read_csv(csv_path)
+    time = df.iloc[:, 0].astype(float).to_numpy()
+    if all(col in df.columns for col in ANGULAR_COLUMNS):
+        profile = df[ANGULAR_COLUMNS].astype(float).to_numpy()
+    else:
+        profile = df.iloc[:, ANGULAR_POSITIONS].astype(float).to_numpy()
+    return time, profile
+
+
+def _file_key(csv_path):
+    stat = os.stat(csv_path)
+    return [stat.st_size, stat.st_mtime_ns]
+
+
+def _cache_paths(csv_dir):
+    csv_dir = os.path.abspath(csv_dir)
+    cache_dir = os.path.join(csv_dir, CACHE_DIRNAME)
+    return cache_dir, os.path.join(cache_dir, "trajectories.npy"), os.path.join(cache_dir, "index.json")
+
+
+def _open_store(csv_dir):
+    """
+    Returns the file index and memory-mapped data of a directory's cache, or None if it
+    has none. Reopens the cache if it was rewritten since it was opened.
+    """
+    csv_dir = os.path.abspath(csv_dir)
+    _, data_path, index_path = _cache_paths(csv_dir)
+    try:
+        index_mtime = os.stat(index_path).st_mtime_ns
+    except FileNotFoundError:
+        _stores.pop(csv_dir, None)
+        return None
+
+    store = _stores.get(csv_dir)
+    if store is None or store["index_mtime"] != index_mtime:
+        with open(index_path) as f:
+            index = json.load(f)
+        if index.get("version") != CACHE_VERSION:
+            return None
+        store = {
+            "index_mtime": index_mtime,
+            "files": index["files"],
+            "data": np.load(data_path, mmap_mode="r"),
+        }
+        _stores[csv_dir] = store
+    return store
+
+
+def ingest_directory(csv_dir, refresh=False, file_keys=None):
+    """
+    Writes or updates the binary cache of the trajectory CSVs in a directory. Only new or
+    modified CSVs are parsed, and the cache is replaced atomically.
+
+    Args:
+        csv_dir (str): Directory containing trajectory CSVs.
+        refresh (bool): Re-parse every CSV.
+        file_keys (dict): [size, mtime_ns] of every CSV by file name, as already listed by
+            the caller; the directory is listed and every CSV stat-ed when None.
+
+    Returns:
+        int: Number of parsed CSVs.
+    """
+    csv_dir = os.path.abspath(csv_dir)
+    if file_keys is None:
+        filenames = sorted(f for f in os.listdir(csv_dir) if f.endswith(".csv"))
+        keys = {f: _file_key(os.path.join(csv_dir, f)) for f in filenames}
+    else:
+        filenames = sorted(file_keys)
+        keys = {f: list(file_keys[f]) for f in filenames}
+
+    store = None if refresh else _open_store(csv_dir)
+    cached = store["files"] if store is not None else {}
+    if set(cached) == set(filenames) and all(cached[f][2:] == keys[f] for f in filenames):
+        return 0
+
+    blocks = []
+    files = {}
+    offset = 0
+    parsed = 0
+    for filename in filenames:
+        entry = cached.get(filename)
+        if entry is not None and entry[2:] == keys[filename]:
+            block = np.asarray(store["data"][entry[0]:entry[0] + entry[1]])
+        else:
+            try:
+                time, profile = parse_trajectory_csv(os.path.join(csv_dir, filename))
+            except Exception:
+                # Not a trajectory (e.g. a metadata CSV), read_trajectory will parse it directly
+                continue
+            block = np.column_stack((time, profile))
+            parsed += 1
+        files[filename] = [offset, len(block), *keys[filename]]
+        blocks.append(block)
+        offset += len(block)
+
+    cache_dir, data_path, index_path = _cache_paths(csv_dir)
+    os.makedirs(cache_dir, exist_ok=True)
+    data = np.concatenate(blocks) if blocks else np.empty((0, 4))
+
+    # Write both files under temporary names first; the index is replaced last, so
+    # readers never see an index pointing into a different data file
+    tmp_data_path = f"{data_path}.{os.getpid()}.tmp.npy"
+    tmp_index_path = f"{index_path}.{os.getpid()}.tmp"
+    np.save(tmp_data_path, data)
+    with open(tmp_index_path, "w") as f:
+        json.dump({"version": CACHE_VERSION, "files": files}, f)
+    _stores.pop(csv_dir, None)
+    if os.path.exists(index_path):
+        os.remove(index_path)
+    os.replace(tmp_data_path, data_path)
+    os.replace(tmp_index_path, index_path)
+    return parsed
+
+
+def ingest_tree(root_dir, refresh=False):
+    """
+    Ingests every directory below root_dir that contains trajectory CSVs.
+
+    Returns:
+        int: Number of parsed CSVs.
+    """
+    parsed = 0
+    for dirpath, dirnames, filenames in os.walk(root_dir):
+        dirnames[:] = [d for d in dirnames if d != CACHE_DIRNAME]
+        if any(f.endswith(".csv") for f in filenames):
+            try:
+                parsed += ingest_directory(dirpath, refresh)
+            except OSError as e:
+                print(f"Could not write trajectory cache for {dirpath}: {e}")
+    return parsed
+
+
+def read_trajectory(csv_path):
+    """
+    Reads the time vector and angular acceleration profile of a trajectory, from the
+    binary cache if it is up to date and from the CSV otherwise.
+
+    Args:
+        csv_path (str): Path to the trajectory CSV.
+
+    Returns:
+        tuple: Time vector (N,) and N x 3 angular acceleration profile.
+    """
+    csv_dir, filename = os.path.split(os.path.abspath(csv_path))
+    store = _open_store(csv_dir)
+    if store is not None:
+        entry = store["files"].get(filename)
+        if entry is not None and entry[2:] == _file_key(csv_path):
+            block = np.array(store["data"][entry[0]:entry[0] + entry[1]])
+            return block[:, 0], block[:, 1:]
+    return parse_trajectory_csv(csv_path)
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Build the binary cache of all trajectory CSVs below a directory")
+    parser.add_argument("--root_dir", type=str, default="data")
+    parser.add_argument("--refresh", action="store_true", help="Re-parse every CSV")
+
+    args = parser.parse_args()
+
+    parsed = ingest_tree(args.root_dir, args.refresh)
+    print(f"Parsed {parsed} trajectory CSVs")
@@ -0,0 +1,74 @@
+import os
+import sys
+
+import numpy as np
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "preprocessing"))
+from augment_batch import augment_batch
+from calculate_ubric import calculate_ubric_from_profile
+from resample import resample_profile
+from stream_detector import StreamingImpactDetector
+
+FS = 1000.0
+
+
+def _pulse(n, peak, amplitude, width, axis_weights):
+    # Gaussian resultant pulse spread over the three axes
+    shape = amplitude * np.exp(-0.5 * ((np.arange(n) - peak) / width) ** 2)
+    weights = np.asarray(axis_weights, dtype=float)
+    return shape[:, np.newaxis] * weights / np.linalg.norm(weights)
+
+
+def test_close_impacts_do_not_share_samples():
+    # The second impact triggers closer to the first one than pre_samples, so its
+    # pre-trigger window would reach back over the first impact's peak
+    n = 800
+    time = np.arange(n) / FS
+    profile = _pulse(n, 300, 5000.0, 3.0, [1.0, 0.5, 0.2]) + _pulse(n, 420, 2000.0, 3.0, [0.2, 1.0, 0.4])
+
+    detector = StreamingImpactDetector(threshold=1000.0, target_idx=100, cnn_length=200, pre_samples=150)
+    impacts = []
+    for start in range(0, n, 50):
+        impacts.extend(detector.push(time[start:start + 50], profile[start:start + 50]))
+    impacts.extend(detector.flush())
+
+    assert len(impacts) == 2
+    first, second = impacts
+    assert second["start_time"] > first["time"][-1]
+    assert second["peak_time"] == time[420]
+    assert np.isclose(second["peak_resultant"], 2000.0)
+
+    # Scored on its own samples only
+    start = np.searchsorted(time, second["start_time"])
+    end = start + len(second["time"])
+    assert second["ubric_score"] == calculate_ubric_from_profile(profile[start:end], time[start:end])
+
+    # CNN inputs centered on the second impact's peak
+    expected = augment_batch(profile[np.newaxis, start:end], 100, 200)[0]
+    np.testing.assert_array_equal(second["cnn_inputs"], expected)
+    resultant = np.sqrt((second["cnn_inputs"] ** 2).sum(axis=1))
+    assert (np.argmax(resultant, axis=-1) == 100).all()
+
+
+def test_resampled_window_matches_preprocessing():
+    # A 2000 Hz stream scored by a CNN trained at 1000 Hz: the window before and after
+    # the peak is counted at 1000 Hz, and the inputs match preprocessing's resampling
+    n = 2000
+    time = np.arange(n) / (2 * FS)
+    profile = _pulse(n, 1000, 3000.0, 8.0, [1.0, 0.6, 0.3])
+
+    detector = StreamingImpactDetector(threshold=500.0, target_idx=100, cnn_length=200, sample_rate=FS)
+    impacts = []
+    for start in range(0, n, 64):
+        impacts.extend(detector.push(time[start:start + 64], profile[start:start + 64]))
+    impacts.extend(detector.flush())
+
+    assert len(impacts) == 1
+    impact = impacts[0]
+    trigger = time[np.argmax(np.sqrt((profile ** 2).sum(axis=1)) > 500.0)]
+    assert abs(impact["start_time"] - (trigger - 100 / FS)) <= 1 / (2 * FS)
+    _, resampled = resample_profile(impact["time"], impact["profile"], FS)
+    assert len(resampled) - 1 - np.argmax(np.sqrt((resampled ** 2).sum(axis=1))) >= 99
+
+    expected = augment_batch(resampled[np.newaxis], 100, 200)[0]
+    np.testing.assert_array_equal(impact["cnn_inputs"], expected)